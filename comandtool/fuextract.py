@@ -7,53 +7,297 @@
 #
 #**********************************************************************************************************************
 
+import argparse
+import concurrent.futures
+import csv
 import datetime
+import io
+import mmap
 import os
 import re
+import sqlite3
 import struct
 import sys
 import time
 import uuid
 import zipfile
 
-# ソースファイルをオープンする。
-args = sys.argv
-if len (args) < 2:
-        print ("ソースファイルが指定されていません。", file = sys.stderr)
-        sys.exit (1)
-if len (args) > 3:
-        print ("ソースファイルが複数指定されています。", file = sys.stderr)
-        sys.exit (1)
-bin_filename = args[1]
+# ファイル内の一部分を，先頭から始まるファイルのように読ませるビュー。
+# mmap したオブジェクトファイルのソースコード部分を，コピーせずに zipfile.ZipFile に渡すために用いる。
+
+class BoundedView (io.RawIOBase):
+
+        # バッファ buf の start バイト目以降を対象とする。
+        def __init__ (self, buf, start):
+                self.buf = memoryview (buf)[start:]
+                self.pos = 0
+
+        def readable (self):
+                return True
+
+        def seekable (self):
+                return True
+
+        def tell (self):
+                return self.pos
+
+        def seek (self, offset, whence = 0):
+                if whence == 0:
+                        self.pos = offset
+                elif whence == 1:
+                        self.pos += offset
+                else:
+                        self.pos = len (self.buf) + offset
+                return self.pos
+
+        def read (self, size = -1):
+                if size == None or size < 0:
+                        end = len (self.buf)
+                else:
+                        end = min (self.pos + size, len (self.buf))
+                data = self.buf[self.pos:end].tobytes ()
+                self.pos = max (self.pos, end)
+                return data
+
+        def readinto (self, b):
+                data = self.read (len (b))
+                b[:len (data)] = data
+                return len (data)
+
+        def close (self):
+                self.buf.release ()
+                super ().close ()
+
+#**********************************************************************************************************************
+# 索引の作成（--index）
+#**********************************************************************************************************************
+
+# ファイル先頭の固定部（8sIII，20バイト）とアセンブル環境情報（16s16s16sdddd，80バイト）の大きさ
+preamble_size = struct.calcsize ("<8sIII")
+environment_size = struct.calcsize ("<16s16s16sdddd")
+
+# UUID1 の時刻（1582年10月15日からの 100ns 単位）を UNIX 時刻に換算するための差
+uuid1_epoch = 0x01b21dd213814000
+
+# 時刻の比較で許す誤差（秒）
+time_slack = 2.0
+
+# UUID1 の時刻とアセンブル時刻の差の上限（秒）
+uuid1_slack = 60.0
+
+# オブジェクトファイル path の先頭の固定部とアセンブル環境情報だけを読み込み，索引の1行（辞書）を返す。
+
+def read_header (path):
+        entry = { "path": path, "size": None, "user": None, "uuid1": None, "uuid4": None, "uuid1_time": None,
+                "asm_time": None, "ctime": None, "atime": None, "mtime": None, "file_mtime": None, "error": None }
+        try:
+                with open (path, "rb") as bin_file:
+                        st = os.fstat (bin_file.fileno ())
+                        entry["size"] = st.st_size
+                        entry["file_mtime"] = st.st_mtime
+                        data = bin_file.read (preamble_size + environment_size)
+                        if len (data) < preamble_size:
+                                entry["error"] = "FURV 形式ではありません。"
+                                return entry
+                        (magic, header_pos, binfile_pos, asmfile_pos) = struct.unpack_from ("<8sIII", data, 0)
+                        if header_pos != preamble_size:
+                                bin_file.seek (header_pos)
+                                data = data[0:preamble_size] + bin_file.read (environment_size)
+                        if not magic.startswith (b"FURV") or len (data) < preamble_size + environment_size:
+                                entry["error"] = "FURV 形式ではありません。"
+                                return entry
+        except OSError:
+                entry["error"] = "ファイルをオープンできません。"
+                return entry
+        (uuid1, uuid4, username, asmtime, ctime, atime, mtime) = struct.unpack_from ("<16s16s16sdddd", data, preamble_size)
+        uuid1 = uuid.UUID (bytes = uuid1)
+        entry["user"] = username.rstrip (b"\0").decode ('utf-8', 'replace')
+        entry["uuid1"] = str (uuid1)
+        entry["uuid4"] = str (uuid.UUID (bytes = uuid4))
+        if uuid1.version == 1:
+                entry["uuid1_time"] = (uuid1.time - uuid1_epoch) / 1e7
+        (entry["asm_time"], entry["ctime"], entry["atime"], entry["mtime"]) = (asmtime, ctime, atime, mtime)
+        return entry
+
+# 索引 entries の各行に，不審な点を表すフラグのリスト（flags）と，同じ UUID を持つファイルの数（copies）と
+# その中で最初の他のファイル（duplicate_of）を付ける。
+# 　duplicate-uuid1，duplicate-uuid4：他のファイルと UUID が同じ（オブジェクトファイルの複製）
+# 　user-mismatch：アセンブルユーザが，パスから user_pat で取り出したユーザ名と異なる
+# 　source-after-assembly：ソースファイルの各時刻がアセンブル時刻より後
+# 　assembly-after-file：アセンブル時刻がオブジェクトファイルの更新時刻より後
+# 　uuid1-time：UUID1 の時刻とアセンブル時刻が大きく異なる
+
+def check_entries (entries, directory, user_pat):
+        owners = {}
+        for entry in entries:
+                entry["flags"] = []
+                entry["copies"] = 1
+                entry["duplicate_of"] = None
+                if entry["error"] != None:
+                        continue
+                for key in ("uuid1", "uuid4"):
+                        owners.setdefault ((key, entry[key]), []).append (entry)
+        for ((key, value), group) in owners.items ():
+                if len (group) > 1:
+                        for entry in group:
+                                entry["flags"].append ("duplicate-" + key)
+                                entry["copies"] = max (entry["copies"], len (group))
+                                if entry["duplicate_of"] == None:
+                                        entry["duplicate_of"] = group[1 if entry is group[0] else 0]["path"]
+        for entry in entries:
+                if entry["error"] != None:
+                        continue
+                flags = entry["flags"]
+                match = user_pat.search (os.path.relpath (entry["path"], directory).replace (os.sep, "/"))
+                if match and match.group ('user').encode ('utf-8')[0:16].decode ('utf-8', 'ignore') != entry["user"]:
+                        flags.append ("user-mismatch")
+                if max (entry["ctime"], entry["atime"], entry["mtime"]) > entry["asm_time"] + time_slack:
+                        flags.append ("source-after-assembly")
+                if entry["asm_time"] > entry["file_mtime"] + time_slack:
+                        flags.append ("assembly-after-file")
+                if entry["uuid1_time"] == None or abs (entry["uuid1_time"] - entry["asm_time"]) > uuid1_slack:
+                        flags.append ("uuid1-time")
+
+# 索引の列名
+index_columns = ["path", "size", "user", "uuid1", "uuid4", "asm_time", "ctime", "atime", "mtime", "file_mtime", "flags", "copies", "duplicate_of", "error"]
+
+# 時刻の列名
+time_columns = { "asm_time", "ctime", "atime", "mtime", "file_mtime" }
+
+# 索引 entries を CSV 形式でファイル out_file に書き出す。時刻は fuextract の表示と同じ形式とする。
+
+def write_index_csv (entries, out_file):
+        writer = csv.writer (out_file)
+        writer.writerow (index_columns)
+        for entry in entries:
+                row = []
+                for column in index_columns:
+                        value = entry[column]
+                        if column in time_columns and value != None:
+                                value = time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (value))
+                        elif column == "flags":
+                                value = " ".join (value)
+                        row.append ("" if value == None else value)
+                writer.writerow (row)
+
+# 索引 entries を SQLite のデータベース filename の表 bins に書き出す。時刻は UNIX 時刻とする。
+
+def write_index_sqlite (entries, filename):
+        with sqlite3.connect (filename) as db:
+                db.execute ("DROP TABLE IF EXISTS bins")
+                db.execute ("CREATE TABLE bins (path TEXT PRIMARY KEY, size INTEGER, user TEXT, uuid1 TEXT, uuid4 TEXT, "
+                        "asm_time REAL, ctime REAL, atime REAL, mtime REAL, file_mtime REAL, flags TEXT, copies INTEGER, duplicate_of TEXT, error TEXT)")
+                db.executemany ("INSERT INTO bins VALUES ({0})".format (", ".join ("?" * len (index_columns))),
+                        [[" ".join (entry[column]) if column == "flags" else entry[column] for column in index_columns] for entry in entries])
+                db.execute ("CREATE INDEX bins_uuid4 ON bins (uuid4)")
+        db.close ()
+
+# ディレクトリ directory 以下のオブジェクトファイルの索引を作成し，output（None なら標準出力）に書き出す。
+
+def make_index (directory, output, user_pat, jobs):
+        start = time.perf_counter ()
+        paths = []
+        for (dirpath, dirnames, filenames) in os.walk (directory):
+                dirnames.sort ()
+                for filename in sorted (filenames):
+                        if filename.lower ().endswith (".bin"):
+                                paths.append (os.path.join (dirpath, filename))
+        with concurrent.futures.ThreadPoolExecutor (max_workers = jobs) as pool:
+                entries = list (pool.map (read_header, paths))
+        check_entries (entries, directory, user_pat)
+        if output == None:
+                write_index_csv (entries, sys.stdout)
+        elif re.search (r'\.(sqlite|sqlite3|db)$', output.lower ()):
+                write_index_sqlite (entries, output)
+        else:
+                with open (output, "w", newline = "", encoding = "utf-8") as out_file:
+                        write_index_csv (entries, out_file)
+        flagged = sum (1 for entry in entries if len (entry["flags"]) > 0)
+        errors = sum (1 for entry in entries if entry["error"] != None)
+        print ("{0} ファイルの索引を {1:.3f} 秒で作成しました。（不審 {2} ファイル，エラー {3} ファイル）".format (len (entries), time.perf_counter () - start, flagged, errors), file = sys.stderr)
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
+
+# 引数を解析する。
+parser = argparse.ArgumentParser (description = "FURV 形式のオブジェクトファイルからアセンブル環境情報とソースコードを取り出す。")
+parser.add_argument ("bin_filename", nargs = "?", help = "オブジェクトファイル")
+parser.add_argument ("destdir", nargs = "?", default = ".", help = "ソースコードの展開先ディレクトリ（既定はカレントディレクトリ）")
+mode = parser.add_mutually_exclusive_group ()
+mode.add_argument ("-l", "--list", action = "store_true", help = "ソースコードのファイル一覧を表示する。")
+mode.add_argument ("-p", "--print", dest = "member", help = "指定したファイルの内容を標準出力に書き出す。")
+mode.add_argument ("-n", "--no-extract", action = "store_true", help = "アセンブル環境情報だけを表示し，ソースコードを展開しない。")
+mode.add_argument ("--index", metavar = "DIR", help = "ディレクトリ以下の .bin ファイルのアセンブル環境情報だけを読み，不審な点を付けた索引を作成する。")
+parser.add_argument ("-o", "--output", help = "--index の索引の出力先（拡張子が .sqlite，.sqlite3，.db なら SQLite，それ以外は CSV。既定は標準出力に CSV）")
+parser.add_argument ("--user-pattern", default = r"^(?P<user>[^/]+)/", help = "--index で，DIR からの相対パスからユーザ名（user グループ）を取り出す正規表現（既定は最初のディレクトリ名）")
+parser.add_argument ("-j", "--jobs", type = int, default = 16, help = "--index で並行して読み込むスレッド数")
+args = parser.parse_args ()
+
+# 索引を作成する。
+if args.index != None:
+        if not os.path.isdir (args.index):
+                print ("ディレクトリ {0} が見つかりません。".format (args.index), file = sys.stderr)
+                sys.exit (1)
+        try:
+                user_pat = re.compile (args.user_pattern)
+        except re.error:
+                parser.error ("--user-pattern の正規表現が不正です。")
+        if "user" not in user_pat.groupindex:
+                parser.error ("--user-pattern に user グループがありません。")
+        make_index (args.index, args.output, user_pat, args.jobs)
+        sys.exit (0)
+if args.bin_filename == None:
+        parser.error ("オブジェクトファイルを指定してください。")
+
+# オブジェクトファイルをオープンし，メモリにマップする。
+bin_filename = args.bin_filename
 try:
 	bin_file = open (bin_filename, "rb")
-except IOError:
+	bin_image = mmap.mmap (bin_file.fileno (), 0, access = mmap.ACCESS_READ)
+except (IOError, ValueError):
         print ("ファイル {0} をオープンできません。".format (bin_filename), file = sys.stderr)
         sys.exit (1)
 
-(magic, header_pos, binfile_pos, asmfile_pos) = struct.unpack ("8sIII", bin_file.read (20))
-
-bin_file.seek (header_pos, 0)
-uuid1 = struct.unpack ("16s", bin_file.read (16))[0]
-uuid4 = struct.unpack ("16s", bin_file.read (16))[0]
-username = struct.unpack ("16s", bin_file.read (16))
-(asmtime, ctime, atime, mtime) = struct.unpack ("4d", bin_file.read (32))
-print ("アセンブルユーザ： ", username[0].decode ('utf-8'))
-print ("UUID1           ： ", uuid.UUID (bytes = uuid1))
-print ("UUID4           ： ", uuid.UUID (bytes = uuid4))
-print ("アセンブル日時　： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (asmtime)))
-print ("ファイル生成日時： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (ctime)))
-print ("ファイル参照日時： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (atime)))
-print ("ファイル更新日時： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (mtime)))
-
-destdir = os.sys.argv[2]
-with open ("$$$out$$$.zip", "wb") as out_file:
-    while True:
-        by = bin_file.read (1)
-        if not by:
-            break
-        out_file.write (by)
-with zipfile.ZipFile('$$$out$$$.zip') as zipf:
-    zipf.extractall (destdir)
-os.remove ("$$$out$$$.zip")
+if len (bin_image) < 20:
+        print ("ファイル {0} は FURV 形式ではありません。".format (bin_filename), file = sys.stderr)
+        sys.exit (1)
+(magic, header_pos, binfile_pos, asmfile_pos) = struct.unpack_from ("8sIII", bin_image, 0)
+if not magic.startswith (b"FURV") or header_pos + 80 > len (bin_image) or asmfile_pos > len (bin_image):
+        print ("ファイル {0} は FURV 形式ではありません。".format (bin_filename), file = sys.stderr)
+        sys.exit (1)
+
+# アセンブル環境情報を表示する。
+# 一覧や内容を標準出力に書き出す場合は，それと混ざらないよう標準エラー出力に表示する。
+(uuid1, uuid4, username) = struct.unpack_from ("16s16s16s", bin_image, header_pos)
+(asmtime, ctime, atime, mtime) = struct.unpack_from ("4d", bin_image, header_pos + 48)
+info_file = sys.stderr if args.list or args.member != None else sys.stdout
+print ("アセンブルユーザ： ", username.decode ('utf-8'), file = info_file)
+print ("UUID1           ： ", uuid.UUID (bytes = uuid1), file = info_file)
+print ("UUID4           ： ", uuid.UUID (bytes = uuid4), file = info_file)
+print ("アセンブル日時　： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (asmtime)), file = info_file)
+print ("ファイル生成日時： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (ctime)), file = info_file)
+print ("ファイル参照日時： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (atime)), file = info_file)
+print ("ファイル更新日時： ", time.strftime ("%Y-%m-%d %H:%M:%S", time.localtime (mtime)), file = info_file)
+
+if args.no_extract:
+        sys.exit (0)
+
+# ソースコードの ZIP を一時ファイルにコピーせず，オブジェクトファイル上でそのまま開く。
+try:
+        with zipfile.ZipFile (BoundedView (bin_image, asmfile_pos)) as zipf:
+                if args.list:
+                        for zinfo in zipf.infolist ():
+                                print ("%10d  %s  %s" % (zinfo.file_size, "%04d-%02d-%02d %02d:%02d:%02d" % zinfo.date_time, zinfo.filename))
+                elif args.member != None:
+                        try:
+                                sys.stdout.buffer.write (zipf.read (args.member))
+                        except KeyError:
+                                print ("ファイル {0} は添付されていません。".format (args.member), file = sys.stderr)
+                                sys.exit (1)
+                else:
+                        zipf.extractall (args.destdir)
+except zipfile.BadZipFile:
+        print ("ファイル {0} のソースコードを読み出せません。".format (bin_filename), file = sys.stderr)
+        sys.exit (1)
 sys.exit (0)
@@ -0,0 +1,263 @@
+#-*- python -*-
+#**********************************************************************************************************************
+#
+# FUSimilar
+#
+# Copyright (C) 2019 Tsuneo Nakanishi (Fukuoka University)
+#
+# FURV 形式のオブジェクトファイルのバイナリどうしの類似度を調べ，コピーが疑われる組を見つける。
+# バイナリを逆アセンブルし（minadis.py），レジスタ番号と分岐先（ラベルのアドレス）に依存しない形に正規化した命令列から
+# k-gram のハッシュ値を求め，winnowing で選んだハッシュ値（指紋）を SQLite の転置索引に登録する。
+# 新しいオブジェクトファイルは，指紋を共有するものだけを転置索引から引いて比較するので，
+# 登録済みのオブジェクトファイルの総数に比例する時間はかからない。NumPy が必要である。
+#
+#**********************************************************************************************************************
+
+import argparse
+import os
+import sqlite3
+import struct
+import sys
+import time
+
+import numpy
+
+sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+import minadis
+
+# k-gram の命令数と winnowing の窓の大きさの既定値
+default_k = 8
+default_window = 8
+
+# これより多くのオブジェクトファイルに現れる指紋は，課題の雛形などの共通部分とみなして比較に用いない。
+default_common = 50
+
+# 候補として報告する類似度の既定値
+default_threshold = 0.3
+
+# ハッシュ値の計算に用いる定数（64ビットの奇数）
+hash_base = numpy.uint64 (0x100000001b3)
+mix_mnemonic = numpy.uint64 (0x9e3779b97f4a7c15)
+mix_shape = numpy.uint64 (0xc2b2ae3d27d4eb4f)
+mix_imm = numpy.uint64 (0x165667b19e3779f9)
+
+# 分岐先や上位アドレスを即値に持つ（ラベルのアドレスに依存する）命令のニーモニック名の添字
+address_mnemonics = [index for (index, mnemonic) in enumerate (minadis.mnemonics)
+        if mnemonic in minadis.minas.cond_branch_dict or mnemonic in minadis.minas.data_xfer_dict or mnemonic == "jal"]
+
+#**********************************************************************************************************************
+# 指紋の計算
+#**********************************************************************************************************************
+
+# 逆アセンブル結果 insns の命令ごとに，正規化した命令を表す 64ビットの値（uint64 の配列）を返す。
+# 　レジスタ番号は用いず，命令内のレジスタの一致関係（rd = rs1 など）と x0 かどうかだけを用いる。
+# 　条件分岐命令，jal 命令，lui/auipc 命令の即値は用いない。判別できないワード（データ）はワードの値を用いる。
+
+def normalize (insns):
+        # 命令形式で使わないフィールドは，どのレジスタとも一致しない値にする。
+        opcode = insns["opcode"]
+        rd = numpy.where ((opcode == 0b0100011) | (opcode == 0b1100011), 32, insns["rd"])
+        rs1 = numpy.where ((opcode == 0b0110111) | (opcode == 0b0010111) | (opcode == 0b1101111), 33, insns["rs1"])
+        rs2 = numpy.where ((opcode == 0b0110011) | (opcode == 0b0100011) | (opcode == 0b1100011), insns["rs2"], 34)
+        shape = (rd == rs1).astype (numpy.uint64) | ((rs1 == rs2).astype (numpy.uint64) << 1) | ((rd == rs2).astype (numpy.uint64) << 2) | \
+                ((rd == 0).astype (numpy.uint64) << 3) | ((rs1 == 0).astype (numpy.uint64) << 4) | ((rs2 == 0).astype (numpy.uint64) << 5)
+        mnemonic = insns["mnemonic"]
+        imm = numpy.where (numpy.isin (mnemonic, address_mnemonics), 0, insns["imm"]).astype (numpy.int64).view (numpy.uint64)
+        tokens = (mnemonic.astype (numpy.int64).view (numpy.uint64) + numpy.uint64 (1)) * mix_mnemonic + shape * mix_shape + imm * mix_imm
+        return numpy.where (mnemonic < 0, insns["word"].astype (numpy.uint64) * mix_imm, tokens)
+
+# 正規化した命令の配列 tokens から k-gram のハッシュ値を求め，winnowing で選んだ（ハッシュ値の配列，先頭の命令の位置の配列）の組を返す。
+
+def fingerprints (tokens, k = default_k, window = default_window):
+        count = len (tokens) - k + 1
+        if count <= 0:
+                return (numpy.zeros (0, dtype = numpy.uint64), numpy.zeros (0, dtype = numpy.int64))
+        hashes = numpy.zeros (count, dtype = numpy.uint64)
+        for offset in range (k):
+                hashes = hashes * hash_base + tokens[offset:offset + count]
+        # 各窓で最小（同じなら最も右）のハッシュ値を選ぶ。
+        if count <= window:
+                positions = numpy.array ([count - 1 - int (numpy.argmin (hashes[::-1]))])
+        else:
+                windows = numpy.lib.stride_tricks.sliding_window_view (hashes, window)
+                positions = numpy.arange (len (windows)) + (window - 1 - numpy.argmin (windows[:, ::-1], axis = 1))
+                positions = numpy.unique (positions)
+        return (hashes[positions], positions)
+
+# FURV 形式のオブジェクトイメージ bin_image の（アセンブルユーザ，UUID4 の16進表記，ハッシュ値の配列，位置の配列）の組を返す。
+# 形式が不正なら ValueError を送出する。
+
+def image_fingerprints (bin_image, k = default_k, window = default_window):
+        (words, tail) = minadis.code_words (bin_image)
+        (header_pos,) = struct.unpack_from ("<I", bin_image, 8)
+        (uuid4, username) = struct.unpack_from ("<16s16s", bin_image, header_pos + 16)
+        (hashes, positions) = fingerprints (normalize (minadis.disassemble (words)), k, window)
+        return (username.rstrip (b"\0").decode ('utf-8', 'replace'), uuid4.hex (), hashes, positions)
+
+#**********************************************************************************************************************
+# 転置索引
+#**********************************************************************************************************************
+
+# 類似度索引：
+# 　SQLite のデータベース filename（":memory:" ならメモリ上）に，オブジェクトファイルの一覧（docs）と，
+# 　指紋をキーとする転置索引（fingerprints）を持つ。k と window は索引の作成時に記録し，以後は同じ値を用いる。
+
+class SimilarityIndex:
+
+        def __init__ (self, filename = ":memory:", k = default_k, window = default_window):
+                self.db = sqlite3.connect (filename)
+                self.db.execute ("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+                self.db.execute ("CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, user TEXT, uuid4 TEXT, count INTEGER)")
+                self.db.execute ("CREATE TABLE IF NOT EXISTS fingerprints (hash INTEGER, doc INTEGER, pos INTEGER)")
+                self.db.execute ("CREATE INDEX IF NOT EXISTS fingerprints_hash ON fingerprints (hash)")
+                for (key, value) in (("k", k), ("window", window)):
+                        self.db.execute ("INSERT OR IGNORE INTO meta VALUES (?, ?)", (key, value))
+                meta = dict (self.db.execute ("SELECT key, value FROM meta"))
+                (self.k, self.window) = (meta["k"], meta["window"])
+
+        def close (self):
+                self.db.commit ()
+                self.db.close ()
+
+        # 登録済みのオブジェクトファイルの数を返す。
+        def __len__ (self):
+                return self.db.execute ("SELECT COUNT(*) FROM docs").fetchone ()[0]
+
+        # オブジェクトファイル path の指紋を登録し，番号を返す。同じ path が登録済みなら置き換える。
+        def add (self, path, user, uuid4, hashes, positions):
+                row = self.db.execute ("SELECT id FROM docs WHERE path = ?", (path,)).fetchone ()
+                if row != None:
+                        self.db.execute ("DELETE FROM fingerprints WHERE doc = ?", row)
+                        self.db.execute ("DELETE FROM docs WHERE id = ?", row)
+                doc = self.db.execute ("INSERT INTO docs (path, user, uuid4, count) VALUES (?, ?, ?, ?)",
+                        (path, user, uuid4, len (numpy.unique (hashes)))).lastrowid
+                self.db.executemany ("INSERT INTO fingerprints VALUES (?, ?, ?)",
+                        zip (hashes.view (numpy.int64).tolist (), [doc] * len (hashes), positions.tolist ()))
+                return doc
+
+        # 番号 doc のオブジェクトファイルの（パス，アセンブルユーザ，UUID4，指紋の数）の組を返す。
+        def document (self, doc):
+                return self.db.execute ("SELECT path, user, uuid4, count FROM docs WHERE id = ?", (doc,)).fetchone ()
+
+        # 指紋（hashes，positions）を共有する登録済みのオブジェクトファイルを引き，
+        # 番号をキー，共有する指紋の（こちらの位置，相手の位置，ハッシュ値）のリストを値とする辞書を返す。
+        # common 個より多くのオブジェクトファイルに現れる指紋は用いない。exclude の番号は除く。
+        def lookup (self, hashes, positions, common = default_common, exclude = None):
+                own = {}
+                for (value, pos) in zip (hashes.view (numpy.int64).tolist (), positions.tolist ()):
+                        own.setdefault (value, []).append (pos)
+                postings = {}
+                values = list (own)
+                for start in range (0, len (values), 500):
+                        chunk = values[start:start + 500]
+                        query = "SELECT hash, doc, pos FROM fingerprints WHERE hash IN ({0})".format (", ".join ("?" * len (chunk)))
+                        for (value, doc, pos) in self.db.execute (query, chunk):
+                                if doc != exclude:
+                                        postings.setdefault (value, []).append ((doc, pos))
+                candidates = {}
+                for (value, entries) in postings.items ():
+                        if len ({ doc for (doc, pos) in entries }) > common:
+                                continue
+                        for (doc, pos) in entries:
+                                for own_pos in own[value]:
+                                        candidates.setdefault (doc, []).append ((own_pos, pos, value))
+                return candidates
+
+#**********************************************************************************************************************
+# 候補の評価
+#**********************************************************************************************************************
+
+# 共有する指紋の（こちらの位置，相手の位置，ハッシュ値）のリスト matches から，
+# 一致するアドレス範囲の（こちらの開始，こちらの終了，相手の開始，相手の終了）のリストを返す。
+# 位置が両方で同じ向きに近い間隔で並ぶ指紋をまとめて1つの範囲とする。
+
+def match_ranges (matches, k, window):
+        ranges = []
+        gap = k + window
+        for (pos_a, pos_b, value) in sorted (matches):
+                if len (ranges) > 0:
+                        (start_a, end_a, start_b, end_b, last_b) = ranges[-1]
+                        if 0 <= pos_a - end_a <= gap and 0 < pos_b - last_b <= pos_a - end_a + gap:
+                                ranges[-1] = (start_a, pos_a, start_b, max (end_b, pos_b), pos_b)
+                                continue
+                ranges.append ((pos_a, pos_a, pos_b, pos_b, pos_b))
+        return [(4 * start_a, 4 * (end_a + k), 4 * start_b, 4 * (end_b + k)) for (start_a, end_a, start_b, end_b, last_b) in ranges]
+
+# 指紋の数 count のオブジェクトファイルと登録済みのオブジェクトファイルの候補 candidates（lookup の結果）を評価し，
+# （類似度，番号，一致するアドレス範囲のリスト）の組を類似度の高い順に返す。
+# 類似度は，共有する指紋の種類の数を，指紋の少ない方の種類の数で割った値とする。
+
+def rank (index, count, candidates, threshold = default_threshold):
+        results = []
+        for (doc, matches) in candidates.items ():
+                shared = len ({ value for (pos_a, pos_b, value) in matches })
+                score = shared / max (1, min (count, index.document (doc)[3]))
+                if score >= threshold:
+                        results.append ((score, doc, match_ranges (matches, index.k, index.window)))
+        results.sort (key = lambda result: (-result[0], result[1]))
+        return results
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
+
+# 引数 paths のファイルとディレクトリ以下の .bin ファイルのパスのリストを返す。
+
+def bin_paths (paths):
+        result = []
+        for path in paths:
+                if os.path.isdir (path):
+                        for (dirpath, dirnames, filenames) in os.walk (path):
+                                dirnames.sort ()
+                                result += [os.path.join (dirpath, filename) for filename in sorted (filenames) if filename.lower ().endswith (".bin")]
+                else:
+                        result.append (path)
+        return result
+
+def main ():
+        # 引数を解析する。
+        parser = argparse.ArgumentParser (prog = "fusimilar", description = "FURV 形式のオブジェクトファイルのバイナリの類似度を調べ，コピーが疑われる組を一致するアドレス範囲とともに報告する。")
+        parser.add_argument ("paths", nargs = "+", help = "オブジェクトファイルまたはそれを含むディレクトリ")
+        parser.add_argument ("--db", default = ":memory:", help = "類似度索引の SQLite データベース（既定はメモリ上で，終了時に破棄する。）")
+        parser.add_argument ("--query", action = "store_true", help = "索引と比較するだけで，索引に登録しない。")
+        parser.add_argument ("-k", type = int, default = default_k, help = "k-gram の命令数（索引の作成時だけ有効）")
+        parser.add_argument ("-w", "--window", type = int, default = default_window, help = "winnowing の窓の大きさ（索引の作成時だけ有効）")
+        parser.add_argument ("--common", type = int, default = default_common, help = "これより多くのオブジェクトファイルに現れる指紋を無視する。")
+        parser.add_argument ("--threshold", type = float, default = default_threshold, help = "報告する類似度の下限（0～1）")
+        args = parser.parse_args ()
+
+        index = SimilarityIndex (args.db, args.k, args.window)
+        start = time.perf_counter ()
+        paths = bin_paths (args.paths)
+        reported = 0
+        status = 0
+        # 1ファイルずつ，登録済みのものと比較してから登録する。
+        print ("score\tpath\tuser\tearlier\tearlier_user\tranges")
+        for path in paths:
+                try:
+                        with open (path, "rb") as bin_file:
+                                (user, uuid4, hashes, positions) = image_fingerprints (bin_file.read (), index.k, index.window)
+                except IOError:
+                        print ("ファイル {0} をオープンできません。".format (path), file = sys.stderr)
+                        status = 1
+                        continue
+                except (ValueError, struct.error):
+                        print ("ファイル {0} は FURV 形式ではありません。".format (path), file = sys.stderr)
+                        status = 1
+                        continue
+                row = index.db.execute ("SELECT id FROM docs WHERE path = ?", (path,)).fetchone ()
+                candidates = index.lookup (hashes, positions, args.common, row[0] if row != None else None)
+                for (score, doc, ranges) in rank (index, len (numpy.unique (hashes)), candidates, args.threshold):
+                        (other_path, other_user, other_uuid4, other_count) = index.document (doc)
+                        text = " ".join ("0x{0:08x}-0x{1:08x}~0x{2:08x}-0x{3:08x}".format (*matched) for matched in ranges)
+                        print ("{0:.3f}\t{1}\t{2}\t{3}\t{4}\t{5}".format (score, path, user, other_path, other_user, text))
+                        reported += 1
+                if not args.query:
+                        index.add (path, user, uuid4, hashes, positions)
+        registered = len (index)
+        index.close ()
+        print ("{0} ファイルを {1:.3f} 秒で調べ，{2} 組を報告しました。（索引の登録数 {3}）".format (len (paths), time.perf_counter () - start, reported, registered), file = sys.stderr)
+        return status
+
+if __name__ == "__main__":
+        sys.exit (main ())
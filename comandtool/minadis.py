@@ -0,0 +1,278 @@
+#-*- python -*-
+#**********************************************************************************************************************
+#
+# RISC-V Minimum Disassembler
+#
+# Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)
+#
+# minas.py が生成した FURV 形式のオブジェクトファイルのバイナリを逆アセンブルする。
+# バイナリを uint32 の配列として読み込み，全ワードのフィールドの取り出しと命令の判別を NumPy の配列演算でまとめて行う。
+# 命令は minas.py のオペコード辞書（minsim.py の解読表）で判別し，判別できないワードは .dd で表す。
+# ラベル名は，ラベル一覧のファイル（minas.py が出力する「ラベル = 0x...」の形式）か，
+# オブジェクトファイルに添付されたソースコードをアセンブルし直して求める。NumPy が必要である。
+#
+#**********************************************************************************************************************
+
+import argparse
+import io
+import os
+import re
+import struct
+import sys
+import time
+import zipfile
+
+import numpy
+
+sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+import minas
+import minsim
+
+# レジスタ名のリスト（レジスタ番号ごとの ABI 名）
+reg_names = [None] * 32
+for (name, index) in minas.reg_dict.items ():
+        if not name.startswith ("x") and name != "fp" and reg_names[index] == None:
+                reg_names[index] = name
+
+# ニーモニック名のリスト（逆アセンブル結果の mnemonic はこのリストの添字で，判別できなければ -1 とする。）
+mnemonics = []
+
+# 判別表：
+# 　（マスク，マスクした命令語の昇順の配列，対応するニーモニック名の添字の配列）の組のリスト。マスクの長いものから順に引く。
+classify_table = []
+for (mask, codes) in minsim.decode_table:
+        keys = sorted (codes)
+        for key in keys:
+                if codes[key] not in mnemonics:
+                        mnemonics.append (codes[key])
+        classify_table.append ((mask, numpy.array (keys, dtype = numpy.uint32),
+                numpy.array ([mnemonics.index (codes[key]) for key in keys], dtype = numpy.int16)))
+
+# minas.py で即値を符号なし（0～4095）で書く命令のニーモニック名
+unsigned_imm_mnemonics = { "andi", "ori", "xori", "sltiu" }
+
+# 逆アセンブル結果の構造化配列の型：
+# 　imm はソースコードに書く形の即値（lui/auipc 命令では上位 20ビット），
+# 　target は条件分岐命令と jal 命令の分岐先アドレスである。
+insn_dtype = numpy.dtype ([
+        ("addr", "<u4"),
+        ("word", "<u4"),
+        ("opcode", "u1"),
+        ("rd", "u1"),
+        ("funct3", "u1"),
+        ("rs1", "u1"),
+        ("rs2", "u1"),
+        ("funct7", "u1"),
+        ("imm", "<i4"),
+        ("mnemonic", "<i2"),
+        ("target", "<u4"),
+        ])
+
+#**********************************************************************************************************************
+# 逆アセンブル
+#**********************************************************************************************************************
+
+# FURV 形式のオブジェクトイメージ bin_image のバイナリを，（uint32 の配列，ワードに満たない末尾のバイト列）の組で返す。
+# 配列はコピーせずに bin_image を参照する。形式が不正なら ValueError を送出する。
+
+def code_words (bin_image):
+        if len (bin_image) < minas.binary_pos:
+                raise ValueError ("FURV 形式ではありません。")
+        (magic, header_pos, binfile_pos, asmfile_pos) = struct.unpack_from ("<8sIII", bin_image, 0)
+        if not magic.startswith (b"FURV") or binfile_pos > asmfile_pos or asmfile_pos > len (bin_image):
+                raise ValueError ("FURV 形式ではありません。")
+        count = (asmfile_pos - binfile_pos) // 4
+        words = numpy.frombuffer (bin_image, dtype = "<u4", count = count, offset = binfile_pos)
+        return (words, bytes (bin_image[binfile_pos + 4 * count:asmfile_pos]))
+
+# アドレス base から並ぶ命令語の配列 words を逆アセンブルし，構造化配列（insn_dtype）を返す。
+
+def disassemble (words, base = 0):
+        words = numpy.asarray (words, dtype = numpy.uint32)
+        insns = numpy.zeros (len (words), dtype = insn_dtype)
+        addr = numpy.arange (base, base + 4 * len (words), 4, dtype = numpy.uint32)
+        insns["addr"] = addr
+        insns["word"] = words
+
+        # 各フィールドを取り出す。
+        opcode = words & 0x7f
+        insns["opcode"] = opcode
+        insns["rd"] = (words >> 7) & 0x1f
+        insns["funct3"] = (words >> 12) & 0x7
+        insns["rs1"] = (words >> 15) & 0x1f
+        insns["rs2"] = (words >> 20) & 0x1f
+        insns["funct7"] = words >> 25
+
+        # 命令を判別する。
+        mnemonic = numpy.full (len (words), -1, dtype = numpy.int16)
+        for (mask, keys, indexes) in classify_table:
+                masked = words & numpy.uint32 (mask)
+                position = numpy.minimum (numpy.searchsorted (keys, masked), len (keys) - 1)
+                found = (keys[position] == masked) & (mnemonic < 0)
+                mnemonic[found] = indexes[position[found]]
+        insns["mnemonic"] = mnemonic
+
+        # 形式ごとの即値を求め，オペコードで選ぶ。
+        signed = words.view (numpy.int32)
+        i_imm = signed >> 20
+        s_imm = ((signed >> 25) << 5) | ((words >> 7) & 0x1f).astype (numpy.int32)
+        b_imm = ((signed >> 31) << 12) | (((words >> 7) & 1) << 11).astype (numpy.int32) | \
+                (((words >> 25) & 0x3f) << 5).astype (numpy.int32) | (((words >> 8) & 0xf) << 1).astype (numpy.int32)
+        j_imm = ((signed >> 31) << 20) | (words & 0x000ff000).astype (numpy.int32) | \
+                (((words >> 20) & 1) << 11).astype (numpy.int32) | (((words >> 21) & 0x3ff) << 1).astype (numpy.int32)
+        shift = opcode == 0b0010011
+        shift &= (insns["funct3"] == 0b001) | (insns["funct3"] == 0b101)
+        insns["imm"] = numpy.select (
+                [shift, (opcode == 0b0010011) | (opcode == 0b0000011) | (opcode == 0b1100111), opcode == 0b0100011,
+                        opcode == 0b1100011, opcode == 0b1101111, (opcode == 0b0110111) | (opcode == 0b0010111)],
+                [insns["rs2"].astype (numpy.int32), i_imm, s_imm, b_imm, j_imm, (words >> 12).astype (numpy.int32)],
+                0)
+
+        # 分岐先アドレスを求める。（jal 命令は minas.py と同じく 1MB の領域内の絶対アドレスとする。）
+        insns["target"] = numpy.select (
+                [opcode == 0b1100011, opcode == 0b1101111],
+                [addr + b_imm.view (numpy.uint32), (addr & 0xfff00000) | (j_imm.view (numpy.uint32) & 0x000fffff)],
+                0)
+        return insns
+
+# 逆アセンブルリストの書式：
+# 　ニーモニック名の添字ごとの（書式，分岐先を用いるか，即値のマスク）の組のリスト。
+# 　書式の {0}～{4} は rd，rs1，rs2 のレジスタ名，即値，分岐先である。
+listing_formats = []
+for mnemonic in mnemonics:
+        if mnemonic in minas.reg_reg_arith_dict:
+                operands = "{0}, {1}, {2}"
+        elif mnemonic in minas.reg_imm_arith_dict or mnemonic in minas.reg_imm_shift_dict:
+                operands = "{0}, {1}, {3}"
+        elif mnemonic in minas.load_store_dict:
+                operands = "{2}, {3}({1})" if mnemonic.startswith ("s") else "{0}, {3}({1})"
+        elif mnemonic in minas.data_xfer_dict:
+                operands = "{0}, 0x{3:05x}"
+        elif mnemonic in minas.cond_branch_dict:
+                operands = "{1}, {2}, {4}"
+        else:
+                operands = "{0}, {4}"
+        listing_formats.append (("{0:<6} ".format (mnemonic) + operands, "{4}" in operands,
+                0xfff if mnemonic in unsigned_imm_mnemonics else -1))
+
+# 逆アセンブル結果 insns のリストを行ごとに返す。
+# labels にラベル名をキー，アドレスを値とする辞書を指定すると，ラベルの行を挿入し，分岐先をラベル名で表す。
+
+def listing (insns, labels = {}):
+        names = {}
+        for (label, address) in labels.items ():
+                names.setdefault (address, []).append (label)
+        columns = [insns[field].tolist () for field in ("addr", "word", "rd", "rs1", "rs2", "imm", "mnemonic", "target")]
+        for (addr, word, rd, rs1, rs2, imm, index, target) in zip (*columns):
+                if addr in names:
+                        for label in names[addr]:
+                                yield label + ":"
+                if index < 0:
+                        text = ".dd 0x{0:08x}".format (word)
+                else:
+                        (template, branch, mask) = listing_formats[index]
+                        dest = None
+                        if branch:
+                                dest = names[target][0] if target in names else "0x{0:08x}".format (target)
+                        text = template.format (reg_names[rd], reg_names[rs1], reg_names[rs2], imm & mask, dest)
+                yield "        {0:<32}# 0x{1:08x}: {2:08x}".format (text, addr, word)
+
+#**********************************************************************************************************************
+# ラベル名の復元
+#**********************************************************************************************************************
+
+# ラベル一覧のファイル filename（1行に「ラベル名 = アドレス」）を読み込み，ラベル名をキー，アドレスを値とする辞書を返す。
+
+label_line_pat = re.compile (r"^\s*(?P<label>[A-Za-z_][0-9A-Za-z_]*)\s*=\s*(?P<addr>0x[0-9A-Fa-f]+|[0-9]+)\s*$")
+
+def read_labels (filename):
+        labels = {}
+        with open (filename, encoding = "utf-8") as labels_file:
+                for line in labels_file:
+                        match = label_line_pat.match (line)
+                        if match:
+                                labels[match.group ('label')] = int (match.group ('addr'), 0)
+        return labels
+
+# オブジェクトイメージ bin_image に添付されたソースコードをアセンブルし直し，ラベル名をキー，アドレスを値とする辞書を返す。
+# ソースコードが添付されていないか，アセンブルし直したバイナリが元のバイナリと異なる場合は None を返す。
+
+def source_labels (bin_image):
+        (asmfile_pos,) = struct.unpack_from ("<I", bin_image, 16)
+        try:
+                with zipfile.ZipFile (io.BytesIO (bin_image[asmfile_pos:])) as zipf:
+                        members = zipf.infolist ()
+                        if len (members) != 1:
+                                return None
+                        source = zipf.read (members[0])
+        except zipfile.BadZipFile:
+                return None
+        result = minas.Assembler ().assemble (source, filename = members[0].filename)
+        if not result.success or result.code != memoryview (bin_image)[minas.binary_pos:asmfile_pos]:
+                return None
+        return result.labels
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
+
+def main ():
+        # 引数を解析する。
+        parser = argparse.ArgumentParser (prog = "minadis", description = "FURV 形式のオブジェクトファイルのバイナリを逆アセンブルする。")
+        parser.add_argument ("bin_filenames", nargs = "+", help = "オブジェクトファイル")
+        parser.add_argument ("--labels", metavar = "FILE", help = "ラベル一覧のファイル（1つのオブジェクトファイルを逆アセンブルする場合）")
+        parser.add_argument ("--no-source", action = "store_true", help = "添付されたソースコードからラベル名を復元しない。")
+        parser.add_argument ("--npz", metavar = "FILE", help = "逆アセンブル結果の構造化配列をファイル名ごとに保存する .npz ファイル")
+        parser.add_argument ("-q", "--quiet", action = "store_true", help = "逆アセンブルリストを出力しない。")
+        args = parser.parse_args ()
+        if args.labels != None and len (args.bin_filenames) != 1:
+                parser.error ("--labels は1つのオブジェクトファイルにだけ指定できます。")
+
+        arrays = {}
+        status = 0
+        start = time.perf_counter ()
+        for bin_filename in args.bin_filenames:
+                # オブジェクトファイルを読み込み，逆アセンブルする。
+                try:
+                        with open (bin_filename, "rb") as bin_file:
+                                bin_image = bin_file.read ()
+                        (words, tail) = code_words (bin_image)
+                except IOError:
+                        print ("ファイル {0} をオープンできません。".format (bin_filename), file = sys.stderr)
+                        status = 1
+                        continue
+                except ValueError:
+                        print ("ファイル {0} は FURV 形式ではありません。".format (bin_filename), file = sys.stderr)
+                        status = 1
+                        continue
+                insns = disassemble (words)
+                arrays[bin_filename] = insns
+                if args.quiet:
+                        continue
+
+                # ラベル名を求める。
+                labels = {}
+                if args.labels != None:
+                        try:
+                                labels = read_labels (args.labels)
+                        except IOError:
+                                print ("ファイル {0} をオープンできません。".format (args.labels), file = sys.stderr)
+                                return 1
+                elif not args.no_source:
+                        labels = source_labels (bin_image) or {}
+
+                # 逆アセンブルリストを出力する。
+                if len (args.bin_filenames) > 1:
+                        print ("# {0}".format (bin_filename))
+                sys.stdout.writelines (line + "\n" for line in listing (insns, labels))
+                if len (tail) > 0:
+                        print ("        .db {0}".format (", ".join ("0x{0:02x}".format (byte) for byte in tail)))
+
+        # 構造化配列を保存する。
+        if args.npz != None:
+                numpy.savez (args.npz, **arrays)
+        print ("{0} ファイル，{1} ワードを {2:.3f} 秒で逆アセンブルしました。".format (len (arrays), sum (len (insns) for insns in arrays.values ()), time.perf_counter () - start), file = sys.stderr)
+        return status
+
+if __name__ == "__main__":
+        sys.exit (main ())
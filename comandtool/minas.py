@@ -16,34 +16,55 @@
 # - 最後の行が改行ではなく，EOFで終わっていた場合に文法エラーが出るバグを修正した。
 # 1.03:
 # - 乗除算命令（M標準拡張仕様）に対応した。
+# 1.04:
+# - パス2でソースファイルを読み直さず，パス1で解析した文リストからコード生成するようにした。
+# - ニーモニック（ディレクティブ）の表引きで解析方法を決めるようにした。
+# - オブジェクトファイルをメモリ上で組み立て，一括して置き換えるようにした。
+# - ソースコードの ZIP を一時ファイルを介さずに添付するようにした。
+# - アセンブラを Assembler クラスとして他のプログラムから利用できるようにした。
+# - 複数のソースファイルを並列にアセンブルするバッチモード（--batch）を追加した。
+# - Unix ドメインソケットで要求を受け付ける常駐モード（--serve）と，そのクライアント minasc.py を追加した。
+# - ソースコードごとにコードとラベル辞書を保存するアセンブルキャッシュ（--cache）を追加した。
+# - 変更された行だけをアセンブルし直す IncrementalAssembler を追加し，常駐モードで用いるようにした。
+# - 各段階の所要時間と文の種類ごとの数などを JSON で出力するプロファイル（--profile）を追加した。
+# - インクルード（.include）と引数付きマクロ（.macro，.endm）に対応した。
+# - インクルードファイルの字句解析の結果をプロセス内で再利用するようにした。
+# - 疑似命令（li，la，mv，j，call，ret，nop など）に対応した。li は最短の命令列を選ぶ。
+# - 範囲外の条件分岐命令を逆条件の分岐命令と jal 命令に，範囲外の jal 命令を lui 命令と jalr 命令に置き換えるようにした。
+# - 疑似命令 .space，.zero，.fill，.align，.incbin を追加した。
+# - データ定義疑似命令と文字列定義疑似命令のデータをまとめて変換し，一括して書き込むようにした。
+# - メモリイメージ，Intel HEX，$readmemh 形式，ELF32 で出力する出力形式（--format）を追加した。
+# - 1つの大きなソースファイルを分割して並列にアセンブルする ParallelAssembler（--parallel）を追加した。
+# - ソースコードを標準入力から読み（-），オブジェクトイメージを標準出力に書き出せる（-o -）ようにした。
+# - ソースコードの添付を省略するオプション（--no-source）と，記録する時刻とユーザ名を指定するオプション（--timestamp，--source-date-epoch，--user）を追加した。
+# - アセンブルに用いないモジュールのインポートと正規表現のコンパイルを初めて用いるときまで遅らせ，起動を速くした。
+# - 1ファイルで実行できる zipapp を作る minaspack.py を追加した。
 #**********************************************************************************************************************
 
-from datetime import datetime
-import getpass
+import array
+import bisect
+import collections
+import io
+import itertools
 import os
 import re
+import stat
 import struct
 import sys
 import time
-import uuid
-import zipfile
+import types
 
-# ソースファイル名
-asm_filename = ""
+# 起動を速くするため，次のモジュールはアセンブルそのものには用いないので，用いる関数の中でインポートする。
+# 　argparse（main），asyncio，errno，signal，socket（常駐モード），concurrent.futures，csv，glob（バッチモード），
+# 　getpass，uuid，zipfile（アセンブル環境情報とソースコードの添付），mmap（map_code），multiprocessing（ParallelAssembler），
+# 　hashlib，json（キャッシュ，インクルード，プロファイル，常駐モード）
 
-# アセンブル中の行番号
-asm_line_number = 1
+# バージョン
+version = "1.04"
 
-# ロケーション
-binary_loc = 0
-
-# エラーフラグ
-error_flag = False
-
-# ラベル辞書：
-# 　ラベル名（小文字）をキー，アドレスを値とする辞書。
-label_dict = {
-        }
+# ファイル内の各部の位置
+header_pos = 0x00000014 # アセンブル環境情報
+binary_pos = 0x00000064 # バイナリ
 
 # レジスタ名辞書：
 # 　レジスタ名（小文字）をキー，レジスタ番号を値とする辞書。
@@ -132,947 +153,2937 @@ cond_branch_dict = {
         "bgeu": 0b0_000000_00000_00000_111_0000_0_1100011,
         }
 
-# 予約語リスト：
-# 　ラベル名として使用できない予約語を格納するリスト。
-reserved_words = {}
-for dict in [reg_dict, reg_reg_arith_dict, reg_imm_arith_dict, reg_imm_shift_dict, load_store_dict, data_xfer_dict, cond_branch_dict]:
-        for kw in dict:
-                reserved_words[kw] = None
+# 疑似命令辞書：
+# 　1命令に置き換える疑似命令のニーモニック名（小文字）をキー，（オペランドの数，置き換える命令のニーモニック，オペランドの書式）の組を値とする辞書。
+# 　書式の {0}，{1}，… を疑似命令のオペランドで置き換えたものを，置き換える命令のオペランドとして解析する。
+pseudo_dict = {
+        "nop"  : (0, "addi", "zero, zero, 0"),
+        "mv"   : (2, "addi", "{0}, {1}, 0"),
+        "not"  : (2, "xori", "{0}, {1}, 4095"),
+        "neg"  : (2, "sub", "{0}, zero, {1}"),
+        "seqz" : (2, "sltiu", "{0}, {1}, 1"),
+        "snez" : (2, "sltu", "{0}, zero, {1}"),
+        "sltz" : (2, "slt", "{0}, {1}, zero"),
+        "sgtz" : (2, "slt", "{0}, zero, {1}"),
+        "j"    : (1, "jal", "zero, {0}"),
+        "call" : (1, "jal", "ra, {0}"),
+        "jr"   : (1, "jalr", "zero, {0}, 0"),
+        "ret"  : (0, "jalr", "zero, ra, 0"),
+        "beqz" : (2, "beq", "{0}, zero, {1}"),
+        "bnez" : (2, "bne", "{0}, zero, {1}"),
+        "bltz" : (2, "blt", "{0}, zero, {1}"),
+        "bgez" : (2, "bge", "{0}, zero, {1}"),
+        "blez" : (2, "bge", "zero, {0}, {1}"),
+        "bgtz" : (2, "blt", "zero, {0}, {1}"),
+        "bgt"  : (3, "blt", "{1}, {0}, {2}"),
+        "ble"  : (3, "bge", "{1}, {0}, {2}"),
+        "bgtu" : (3, "bltu", "{1}, {0}, {2}"),
+        "bleu" : (3, "bgeu", "{1}, {0}, {2}"),
+        }
+
+# 予約語の集合：
+# 　ラベル名として使用できない予約語を格納する集合。
+# 　起動のたびに各辞書を1語ずつ走査しないよう，辞書のキーの和集合として一度に作る。
+reserved_words = frozenset ().union (reg_dict, reg_reg_arith_dict, reg_imm_arith_dict, reg_imm_shift_dict, load_store_dict, data_xfer_dict, cond_branch_dict)
 
 #**********************************************************************************************************************
-# 構文解析関数群
+# 構文解析用の正規文法
 #**********************************************************************************************************************
 
-# 文頭の正規文法（パターン）
-beginning_pat = \
-        r"^(?P<label>[A-Za-z_][0-9A-Za-z_]*:)?\s*"
+# 文頭の正規文法（パターン）：
+# 　行頭のラベルと，ニーモニック（またはディレクティブ）を取り出す。
+# 　マクロ名を取り出せるよう，ニーモニックには数字と「_」も許す。
+statement_pat = \
+        r"^(?P<label>[A-Za-z_][0-9A-Za-z_]*:)?\s*" \
+        r"((?P<keyword>\.?[A-Za-z_][0-9A-Za-z_]*)(?![0-9A-Za-z_])\s*)?"
+
+# 以下はニーモニック（またはディレクティブ）に続くオペランドの正規文法（パターン）である。
 
 # レジスタ対レジスタ算術論理演算命令の正規文法（パターン）
 reg_reg_arith_pat = \
-        r"(?P<mnemonic>[A-Za-z]+)\s+" \
         r"(?P<rd>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"(?P<rs1>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"(?P<rs2>[A-Za-z][0-9A-Za-z]*)\s*$"
 
 # レジスタ対即値算術論理演算命令の正規文法（パターン）
 reg_imm_arith_pat = \
-        r"(?P<mnemonic>[A-Za-z]+)\s+" \
         r"(?P<rd>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"(?P<rs1>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"((?P<dec>[+-]?[0-9]+)|(?P<hex>0x[0-9A-Fa-f]+)|(%lo\((?P<ref>[A-Za-z_][0-9A-Za-z_]*)\))|(%lo\((?P<lohex>0x[0-9A-Fa-f]+)\)))\s*$"
 
 # 即値シフト命令の正規文法（パターン）
 reg_imm_shift_pat = \
-        r"(?P<mnemonic>[A-Za-z]+)\s+" \
         r"(?P<rd>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"(?P<rs1>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"((?P<dec>[+-]?[0-9]+)|(?P<hex>0x[0-9A-Fa-f]+))\s*$"
 
 # ロード／ストア命令の正規文法（パターン）
 load_store_pat = \
-        r"(?P<mnemonic>[A-Za-z]+)\s+" \
         r"(?P<reg>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
-        r"((?P<dec>[+-]?[0-9]+)|(?P<hex>0x[0-9A-Fa-f]+)|(%lo\((?P<ref>[A-Za-z_][0-9A-Za-z_]*)\))|(%lo(\(?P<lohex>0x[0-9A-Fa-f]+)\)))\s*" \
+        r"((?P<dec>[+-]?[0-9]+)|(?P<hex>0x[0-9A-Fa-f]+)|(%lo\((?P<ref>[A-Za-z_][0-9A-Za-z_]*)\))|(%lo\((?P<lohex>0x[0-9A-Fa-f]+)\)))\s*" \
         r"\((?P<rs1>[A-Za-z][0-9A-Za-z]*)\)\s*$"
 
 # データ転送命令の正規文法（パターン）
 data_xfer_pat = \
-        r"(?P<mnemonic>[A-Za-z]+)\s+" \
         r"(?P<rd>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"((?P<dec>[+-]?[0-9]+)|(?P<hex>0x[0-9A-Fa-f]+)|(%hi\((?P<ref>[A-Za-z_][0-9A-Za-z_]*)\))|(%hi\((?P<hihex>0x[0-9A-Fa-f]+)\)))\s*$"
 
 # 条件分岐命令の正規文法（パターン）
 cond_branch_pat = \
-        r"(?P<mnemonic>[A-Za-z]+)\s+" \
-        R"(?P<rs1>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
+        r"(?P<rs1>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"(?P<rs2>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
-        r"(?P<dest>[A-Za-z_][0-9A-Za-z_]*)$"
+        r"(?P<dest>[A-Za-z_][0-9A-Za-z_]*)\s*$"
 
 # jal 命令の正規文法（パターン）
 jal_pat = \
-        r"(?P<mnemonic>[A-Za-z]+)\s+" \
         r"(?P<rd>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
         r"(?P<dest>[A-Za-z_][0-9A-Za-z_]*)\s*$"
 
 # データ定義疑似命令の正規文法（パターン）
 defdata_pat = \
-        r"(?P<directive>\.[A-Za-z]+)\s+" \
-        r"(?P<datalist>(([+-]?[0-9]+)|(0x[0-9A-Fa-f]+)|([A-Za-z_][0-9A-Za-z_]*))(\s*,\s*(([+-]?[0-9]+)|(0x[0-9A-Fa-f]+)|([A-Za-z_][0-9A-Za-z_]*)))*)\s*$"
+        r"(?P<datalist>(?:0x[0-9A-Fa-f]+|[+-]?[0-9]+|[A-Za-z_][0-9A-Za-z_]*)(?:\s*,\s*(?:0x[0-9A-Fa-f]+|[+-]?[0-9]+|[A-Za-z_][0-9A-Za-z_]*))*)\s*$"
 
 # 文字列定義疑似命令の正規文法（パターン）
 cstr_pat = \
-        r"(?P<directive>\.[A-Za-z]+)\s+" \
         r"\"(?P<str>[ !#-~]*)\"\s*$"
 
-# ラベル文の正規文法（パターン）
-label_pat = \
-        r"^(?P<label>[A-Za-z_][0-9A-Za-z_]*:)\s*$"
-
-# 空文の正規文法（パターン）
-null_pat = \
-        r"^\s*$"
-
-# 各パターンをコンパイルする。
-reg_reg_arith_pat = re.compile (beginning_pat + reg_reg_arith_pat)
-reg_imm_arith_pat = re.compile (beginning_pat + reg_imm_arith_pat)
-reg_imm_shift_pat = re.compile (beginning_pat + reg_imm_shift_pat)
-load_store_pat = re.compile (beginning_pat + load_store_pat)
-data_xfer_pat = re.compile (beginning_pat + data_xfer_pat)
-cond_branch_pat = re.compile (beginning_pat + cond_branch_pat)
-jal_pat = re.compile (beginning_pat + jal_pat)
-defdata_pat = re.compile (beginning_pat + defdata_pat)
-cstr_pat = re.compile (beginning_pat + cstr_pat)
-label_pat = re.compile (label_pat)
-null_pat = re.compile (null_pat)
-
-# エラーメッセージを出力する。
-# ファイル名を filename，エラー行番号を lineno，エラーメッセージを msg に指定する。
-
-def print_error (filename, lineno, msg):
-        print ("{0}, line {1}, {2}".format (filename, lineno, msg), file = sys.stderr)
-
-# パディング量を返す。
-def padding_size (unitsize):
-        size = 0
-        if binary_loc % unitsize != 0:
-                size = unitsize - binary_loc % unitsize
-        return size
-
-# 指定量のパディングをする。
-def insert_padding (padsize):
-        global binary_loc
-        for i in range (padsize):
-                bin_file.write (struct.pack ('B', 0))
-                binary_loc += 1
-        
-# レジスタ対レジスタ算術論理演算命令を解析する。
-
-def parse_reg_reg_arith (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = reg_reg_arith_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        # ニーモニックを検証する。
-        mnemonic = match.group ('mnemonic')
-        opcode = reg_reg_arith_dict.get (mnemonic.lower ())
-        if opcode == None:
-                return None
-        # ディスティネーションレジスタを検証する。
-        rdreg = match.group ('rd')
-        rdindex = reg_dict.get (rdreg.lower ())
-        if rdindex == None:
-                print_error (asm_filename, asm_line_number, "不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
-                error_flag = True
-        # ソースレジスタ1を検証する。
-        rs1reg = match.group ('rs1')
-        rs1index = reg_dict.get (rs1reg.lower ())
-        if rs1index == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs1reg))
-                error_flag = True
-        # ソースレジスタ2を検証する。
-        rs2reg = match.group ('rs2')
-        rs2index = reg_dict.get (rs2reg.lower ())
-        if rs2index == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs2reg))
-                error_flag = True
-        # コードを生成する。
-        if not error_flag:
-                insert_padding (padding_size (4))
-                opcode |= ((rdindex << 7) | (rs1index << 15) | (rs2index << 20)) & 0xffffffff
-                bin_file.write (struct.pack ("<I", opcode))
-                binary_loc += 4
-        return True
+# 領域確保疑似命令（.space）の正規文法（パターン）
+space_pat = \
+        r"((?P<size>[+-]?[0-9]+)|(?P<sizehex>0x[0-9A-Fa-f]+))" \
+        r"(\s*,\s*((?P<value>[+-]?[0-9]+)|(?P<valuehex>0x[0-9A-Fa-f]+)))?\s*$"
+
+# 領域確保疑似命令（.zero）の正規文法（パターン）
+zero_pat = \
+        r"((?P<size>[+-]?[0-9]+)|(?P<sizehex>0x[0-9A-Fa-f]+))\s*$"
+
+# 繰り返しデータ定義疑似命令の正規文法（パターン）
+fill_pat = \
+        r"((?P<repeat>[+-]?[0-9]+)|(?P<repeathex>0x[0-9A-Fa-f]+))" \
+        r"(\s*,\s*((?P<size>[+-]?[0-9]+)|(?P<sizehex>0x[0-9A-Fa-f]+))" \
+        r"(\s*,\s*((?P<value>[+-]?[0-9]+)|(?P<valuehex>0x[0-9A-Fa-f]+)))?)?\s*$"
+
+# 境界合わせ疑似命令の正規文法（パターン）
+align_pat = \
+        r"((?P<align>[+-]?[0-9]+)|(?P<alignhex>0x[0-9A-Fa-f]+))\s*$"
+
+# バイナリファイル取り込み疑似命令の正規文法（パターン）
+incbin_pat = \
+        r"\"(?P<path>[^\"]+)\"" \
+        r"(\s*,\s*((?P<skip>[+-]?[0-9]+)|(?P<skiphex>0x[0-9A-Fa-f]+))" \
+        r"(\s*,\s*((?P<count>[+-]?[0-9]+)|(?P<counthex>0x[0-9A-Fa-f]+)))?)?\s*$"
+
+# li 疑似命令の正規文法（パターン）
+li_pat = \
+        r"(?P<rd>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
+        r"((?P<dec>[+-]?[0-9]+)|(?P<hex>0x[0-9A-Fa-f]+))\s*$"
 
-# レジスタ対レジスタ算術論理演算命令をパス1用に解析する。
-
-def preparse_reg_reg_arith (asm_line):
-        # マッチしなければ何もしない。
-        match = reg_reg_arith_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 4, padding_size (4))
-
-# レジスタ対即値算術論理演算命令を解析する。
-
-def parse_reg_imm_arith (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = reg_imm_arith_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        # ニーモニックを検証する。
-        mnemonic = match.group ('mnemonic')
-        opcode = reg_imm_arith_dict.get (mnemonic.lower ())
-        if opcode == None:
-                return None
-        # ディスティネーションレジスタを検証する。
-        rdreg = match.group ('rd')
-        rdindex = reg_dict.get (rdreg.lower ())
-        if rdindex == None:
-                print_error (asm_filename, asm_line_number, "不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
-                error_flag = True
-        # ソースレジスタを検証する。
-        rs1reg = match.group ('rs1')
-        rs1index = reg_dict.get (rs1reg.lower ())
-        if rs1index == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs1reg))
-                error_flag = True
-        # 即値を検証する。
-        if match.group ('dec') != None:
-                imm = int (match.group ('dec'))
-                if mnemonic.lower () in { "addi", "slti", "jalr" }:
-                        min = -2048
-                        max = 2047
-                if mnemonic.lower () in { "andi", "ori", "xori", "sltiu" }:
-                        min = 0
-                        max = 4095
-                if (imm < min) or (imm > max):
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（{0}～{1}）外の即値が指定されています。".format (min, max))
-                        error_flag = True
-        elif match.group ('hex') != None:
-                imm = int (match.group ('hex'), 16)
-                if (imm < 0) or (imm > 0xfff):
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（0x000～0xfff）外の即値が指定されています。")
-                        error_flag = True
-        elif match.group ('ref') != None:
-                ref = match.group ("ref")
-                imm = label_dict.get (ref)
-                if imm == None:
-                        print_error (asm_filename, asm_line_number, "ラベル {0} は未定義です。".format (ref))
-                        error_flag = True
+# la 疑似命令の正規文法（パターン）
+la_pat = \
+        r"(?P<rd>[A-Za-z][0-9A-Za-z]*)\s*,\s*" \
+        r"(?P<ref>[A-Za-z_][0-9A-Za-z_]*)\s*$"
+
+# インクルード疑似命令の正規文法（パターン）
+include_pat = \
+        r"^\s*\"(?P<path>[^\"]+)\"\s*$"
+
+# マクロ定義疑似命令の正規文法（パターン）：
+# 　マクロ名と，「,」または空白で区切った仮引数名を取り出す。
+macro_pat = \
+        r"^\s*(?P<name>[A-Za-z_][0-9A-Za-z_]*)((\s*,\s*|\s+)(?P<params>[A-Za-z_][0-9A-Za-z_]*(\s*,?\s*[A-Za-z_][0-9A-Za-z_]*)*))?\s*$"
+
+# マクロ定義の終わりの正規文法（パターン）
+endm_pat = \
+        r"^\s*\.endm\s*(#.*)?$"
+
+# マクロ本体の仮引数の参照（「\仮引数名」）の正規文法（パターン）
+macro_param_pat = \
+        r"\\([A-Za-z_][0-9A-Za-z_]*)"
+
+# 初めて用いるときにコンパイルする正規表現：
+# 　パターン pattern とフラグ flags を保持し，照合メソッドなどの属性を初めて参照したときにコンパイルする。
+# 　コンパイルした後は re.Pattern の照合メソッドを自身の属性として持つので，照合の速さは re.Pattern と変わらない。
+# 　用いない命令や疑似命令のパターンは，起動時にも実行中にもコンパイルしない。
+
+class LazyPattern:
+
+        def __init__ (self, pattern, flags = 0):
+                self.pattern = pattern
+                self.flags = flags
+
+        def __getattr__ (self, name):
+                if name.startswith ("__"):
+                        raise AttributeError (name)
+                compiled = re.compile (self.pattern, self.flags)
+                for method in ("match", "fullmatch", "search", "sub", "subn", "split", "findall", "finditer", "groupindex", "groups"):
+                        setattr (self, method, getattr (compiled, method))
+                return getattr (compiled, name)
+
+# 各パターンを，初めて用いるときにコンパイルするようにする。
+statement_pat = LazyPattern (statement_pat)
+reg_reg_arith_pat = LazyPattern (reg_reg_arith_pat)
+reg_imm_arith_pat = LazyPattern (reg_imm_arith_pat)
+reg_imm_shift_pat = LazyPattern (reg_imm_shift_pat)
+load_store_pat = LazyPattern (load_store_pat)
+data_xfer_pat = LazyPattern (data_xfer_pat)
+cond_branch_pat = LazyPattern (cond_branch_pat)
+jal_pat = LazyPattern (jal_pat)
+defdata_pat = LazyPattern (defdata_pat)
+cstr_pat = LazyPattern (cstr_pat)
+space_pat = LazyPattern (space_pat)
+zero_pat = LazyPattern (zero_pat)
+fill_pat = LazyPattern (fill_pat)
+align_pat = LazyPattern (align_pat)
+incbin_pat = LazyPattern (incbin_pat)
+li_pat = LazyPattern (li_pat)
+la_pat = LazyPattern (la_pat)
+include_pat = LazyPattern (include_pat)
+macro_pat = LazyPattern (macro_pat)
+endm_pat = LazyPattern (endm_pat, re.IGNORECASE)
+macro_param_pat = LazyPattern (macro_param_pat)
+
+#**********************************************************************************************************************
+# アセンブラ
+#**********************************************************************************************************************
+
+# 命令の符号化：
+# 　条件分岐命令のオペコード opcode にレジスタ番号と相対アドレス offset を，
+# 　jal 命令にレジスタ番号と分岐先アドレス target（分岐元と同じ 1MB の領域内の絶対アドレス）を，
+# 　I 形式，U 形式の命令にレジスタ番号と即値を埋め込んだ命令語を返す。
+
+def encode_branch (opcode, rs1index, rs2index, offset):
+        if offset < 0:
+                offset += 8192
+        opcode |= ((rs1index << 15) | (rs2index << 20)) & 0xffffffff
+        opcode |= ((offset & 0b00000000_00000000_00000000_00011110) << 7) & 0xffffffff
+        opcode |= ((offset & 0b00000000_00000000_00000111_11100000) << 20) & 0xffffffff
+        opcode |= ((offset & 0b00000000_00000000_00001000_00000000) >> 4) & 0xffffffff
+        opcode |= ((offset & 0b00000000_00000000_00010000_00000000) << 19) & 0xffffffff
+        return opcode
+
+def encode_jal (rdindex, target):
+        opcode = 0b0_0000000000_0_00000000_00000_1101111
+        opcode |= rdindex << 7;
+        opcode |= ((target & 0b00000000_00010000_00000000_00000000) << 11) & 0xffffffff
+        opcode |= ((target & 0b00000000_00001111_11110000_00000000)      ) & 0xffffffff
+        opcode |= ((target & 0b00000000_00000000_00001000_00000000) << 9) & 0xffffffff
+        opcode |= ((target & 0b00000000_00000000_00000111_11111110) << 20) & 0xffffffff
+        return opcode
+
+def encode_itype (opcode, rdindex, rs1index, imm):
+        return (opcode | (rdindex << 7) | (rs1index << 15) | ((imm & 0xfff) << 20)) & 0xffffffff
+
+def encode_utype (opcode, rdindex, imm):
+        return (opcode | (rdindex << 7) | (imm & 0xfffff000)) & 0xffffffff
+
+# 32ビットの値 value を lui 命令と addi 命令（jalr 命令）で作る場合の，lui 命令の即値（上位20ビットを12ビット左に詰めた値）と
+# addi 命令の即値（符号付き12ビット）の組を返す。addi 命令の即値は符号拡張されるので，上位を繰り上げる。
+
+def split_hi_lo (value):
+        hi = (value + 0x800) & 0xfffff000
+        lo = ((value & 0xfff) ^ 0x800) - 0x800
+        return (hi, lo)
+
+# 診断メッセージ：
+# 　ファイル名 filename，行番号 lineno，メッセージ message からなる。
+
+class Diagnostic:
+
+        def __init__ (self, filename, lineno, message):
+                self.filename = filename
+                self.lineno = lineno
+                self.message = message
+
+        def __str__ (self):
+                return "{0}, line {1}, {2}".format (self.filename, self.lineno, self.message)
+
+# アセンブル結果：
+# 　image はオブジェクトファイルの内容（失敗した場合は None），labels はラベル辞書，
+# 　diagnostics は診断メッセージのリスト，cached はキャッシュを再利用したか，profile は AssemblyProfile である。
+
+class AssemblyResult:
+
+        def __init__ (self, image, labels, diagnostics, cached = False, profile = None):
+                self.image = image
+                self.labels = labels
+                self.diagnostics = diagnostics
+                self.cached = cached
+                self.profile = profile
+
+        # アセンブルに成功したかを返す。
+        @property
+        def success (self):
+                return self.image != None
+
+        # バイナリ（コード部分）をコピーせずに返す。
+        @property
+        def code (self):
+                (asmfile_pos,) = struct.unpack_from ("<I", self.image, 16)
+                return memoryview (self.image)[binary_pos:asmfile_pos]
+
+# アセンブルのプロファイル：
+# 　各段階の所要時間（秒），文の種類ごとの数，正規表現の照合回数と一致回数，パディング量，エラー数を集計する。
+# 　段階はソースファイルの読み込み（open），パス1（pass1），パス2（pass2），ソースコードの ZIP の添付（attach），
+# 　オブジェクトファイルの書き出し（flush）とする。open と flush は assemble_file で計測する。
+# 　文の種類は文テーブルのサイズを求めるメソッドとコード生成メソッドの名前で表し，ラベルのみの文は label とする。
+# 　オペランドの正規表現はコード生成メソッドの名前で表し，文頭は statement とする。
+
+class AssemblyProfile:
+
+        def __init__ (self):
+                # 段階ごとの所要時間
+                self.times = {}
+                # サイズを求めるメソッドごと，コード生成メソッドごとの文の数
+                self.preparse = {}
+                self.parse = {}
+                # 正規表現ごとの（照合回数，一致回数）のリスト
+                self.regex = {}
+                # 字句解析した行数
+                self.lines = 0
+                # パディング量（バイト）
+                self.padding = 0
+                # エラー数
+                self.errors = 0
+
+        # 段階 phase の所要時間に start からの経過時間を加え，現在の時刻を返す。
+        def lap (self, phase, start):
+                now = time.perf_counter ()
+                self.times[phase] = self.times.get (phase, 0.0) + now - start
+                return now
+
+        # 正規表現 pattern を string の位置 pos から照合し，key の照合回数と一致回数を数える。
+        def match (self, key, pattern, string, pos = 0):
+                match = pattern.match (string, pos)
+                counts = self.regex.get (key)
+                if counts == None:
+                        counts = self.regex[key] = [0, 0]
+                counts[0] += 1
+                if match:
+                        counts[1] += 1
+                return match
+
+        # サイズを求めるメソッド preparse，コード生成メソッド parse の文を数える。
+        def count (self, preparse, parse):
+                if preparse == None and parse == None:
+                        self.preparse["label"] = self.preparse.get ("label", 0) + 1
+                        return
+                if preparse != None:
+                        self.preparse[preparse] = self.preparse.get (preparse, 0) + 1
+                if parse != None:
+                        self.parse[parse] = self.parse.get (parse, 0) + 1
+
+        # JSON に変換できる辞書を返す。
+        def as_dict (self):
+                name = lambda key: key if isinstance (key, str) else key.__name__
+                return {
+                        "times"     : { phase: self.times.get (phase, 0.0) for phase in ("open", "pass1", "pass2", "attach", "flush") },
+                        "statements": {
+                                "preparse": { name (key): count for (key, count) in self.preparse.items () },
+                                "parse"   : { name (key): count for (key, count) in self.parse.items () },
+                                },
+                        "regex"     : { name (key): { "attempts": attempts, "hits": hits } for (key, (attempts, hits)) in self.regex.items () },
+                        "lines"     : self.lines,
+                        "padding"   : self.padding,
+                        "errors"    : self.errors,
+                        }
+
+# アセンブラ：
+# 　状態はアセンブルごとに Assembly オブジェクトに持たせるので，1つのプロセスで何度でも呼び出せる。
+# 　log にファイルを指定すると，進捗と診断メッセージを発生順に出力する。
+# 　cache に AssemblyCache を指定すると，同じソースコードのコードとラベル辞書を再利用する。
+
+class Assembler:
+
+        def __init__ (self, log = None, cache = None):
+                self.log = log
+                self.cache = cache
+                # コード生成に影響するオプション（キャッシュのキーに含める。）
+                self.options = {}
+                # ソースファイル名が相対パスの場合に，インクルードファイルを探す基準のディレクトリ（None ならカレントディレクトリ）
+                self.directory = None
+                # オブジェクトイメージにソースコードを添付するか
+                self.attach = True
+                # アセンブル環境情報に記録する時刻（エポックからの秒数。None なら実際のアセンブル時刻とファイルの各時刻）
+                self.timestamp = None
+
+        # ソースコード source（str または bytes）をアセンブルして AssemblyResult を返す。
+        # ソースファイル名を filename，ソースファイルの os.stat の結果を stat，アセンブルユーザ名を user に指定する。
+        # stat を省略した場合，ファイルの各時刻にはアセンブル時刻を記録する。
+        # user を省略した場合，このプロセスのユーザ名を記録する。
+        def assemble (self, source, filename = "source.s", stat = None, user = None):
+                assembly = self.new_assembly (source, filename, stat, user, self.log)
+                return assembly.run (self.cache, self.options)
+
+        # このアセンブラの設定（インクルードの基準のディレクトリ，ソースコードの添付，記録する時刻）で Assembly を作る。
+        def new_assembly (self, source, filename, stat, user, log):
+                assembly = Assembly (source, filename, stat, user, log)
+                assembly.directory = self.directory
+                assembly.attach = self.attach
+                assembly.asm_time = self.timestamp
+                return assembly
+
+# キャッシュの保存量が上限を越えたときに削除して減らす，上限に対する割合（走査が保存のたびに起きないよう，上限より少なくする。）
+cache_evict_ratio = 0.9
+
+# アセンブルキャッシュ：
+# 　ソースコード，アセンブラのバージョン，オプションのハッシュ値をキーとして，コードとラベル辞書をディレクトリ directory に保存する。
+# 　保存量が max_size バイトを越えると，最後に使用した時刻（ファイルの更新時刻）が古いものから削除する。
+# 　複数のプロセスで同じディレクトリを共有してよい。
+# 　保存量はディレクトリ直下のファイル size に記録しておき，保存のたびに加算する。上限を越えた（または記録がない）場合だけ
+# 　全ファイルを走査して実際の保存量を求め，上限の cache_evict_ratio の割合まで削除する。
+# 　複数のプロセスが同時に加算すると記録が実際より少なくなることがあるが，次の走査で正される。
+
+class AssemblyCache:
+
+        def __init__ (self, directory, max_size = 256 * 1024 * 1024):
+                self.directory = directory
+                self.max_size = max_size
+                self.hits = 0
+                self.misses = 0
+                os.makedirs (directory, exist_ok = True)
+
+        # キーを返す。
+        def key (self, source, options):
+                import hashlib
+                import json
+                digest = hashlib.sha256 ()
+                digest.update (version.encode ('utf-8'))
+                digest.update (json.dumps (options, sort_keys = True).encode ('utf-8'))
+                digest.update (source)
+                return digest.hexdigest ()
+
+        # キーに対応するファイル名を返す。
+        def path (self, key):
+                return os.path.join (self.directory, key[0:2], key + ".furvc")
+
+        # キーに対応する（コード，ラベル辞書）の組を返す。なければ None を返す。
+        def get (self, key):
+                import json
+                path = self.path (key)
+                try:
+                        with open (path, "rb") as cache_file:
+                                data = cache_file.read ()
+                        (magic, header_size) = struct.unpack_from ("<8sI", data, 0)
+                        if magic != b"FURVC000":
+                                raise ValueError (path)
+                        labels = json.loads (data[12:12 + header_size].decode ('utf-8'))
+                        code = data[12 + header_size:]
+                        os.utime (path)
+                except (OSError, ValueError, struct.error):
+                        self.misses += 1
+                        return None
+                self.hits += 1
+                return (code, labels)
+
+        # 保存量を記録するファイル名を返す。
+        def size_path (self):
+                return os.path.join (self.directory, "size")
+
+        # 記録した保存量を返す。記録がなければ None を返す。
+        def read_size (self):
+                try:
+                        with open (self.size_path (), "r", encoding = "ascii") as size_file:
+                                return int (size_file.read ())
+                except (OSError, ValueError):
+                        return None
+
+        # 保存量 total を記録する。
+        def write_size (self, total):
+                try:
+                        with open (self.size_path (), "w", encoding = "ascii") as size_file:
+                                size_file.write (str (total))
+                except OSError:
+                        pass
+
+        # キーに対応するコード code とラベル辞書 labels を保存する。
+        def put (self, key, code, labels):
+                import json
+                path = self.path (key)
+                header = json.dumps (labels).encode ('utf-8')
+                data = struct.pack ("<8sI", b"FURVC000", len (header)) + header + code
+                try:
+                        old_size = os.stat (path).st_size
+                except OSError:
+                        old_size = 0
+                try:
+                        os.makedirs (os.path.dirname (path), exist_ok = True)
+                        write_image (path, data)
+                except OSError:
+                        return
+                total = self.read_size ()
+                if total == None or total + len (data) - old_size > self.max_size:
+                        self.evict ()
                 else:
-                        imm &= 0x00000fff
-        elif match.group ('lohex') != None:
-                imm = int (match.group ('lohex'), 16)
-                if (imm < 0) or (imm > 0xffffffff):
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（0x00000000～0xffffffff）外の即値が指定されています。")
-                        error_flag = True
-                imm &= 0x00000fff
-        else:
-                pass
-        # コードを生成する。
-        if not error_flag:
-                insert_padding (padding_size (4))
-                opcode |= ((rdindex << 7) | (rs1index << 15) | (imm << 20)) & 0xffffffff
-                bin_file.write (struct.pack ("<I", opcode))
-                binary_loc += 4
-        return True
+                        self.write_size (total + len (data) - old_size)
+
+        # 全ファイルを走査して保存量を求め，上限を越えていれば，古いものから上限の cache_evict_ratio の割合まで削除する。
+        # 求めた保存量は記録する。
+        def evict (self):
+                entries = []
+                total = 0
+                for subdir in os.scandir (self.directory):
+                        if not subdir.is_dir ():
+                                continue
+                        for entry in os.scandir (subdir.path):
+                                if entry.name.endswith (".furvc"):
+                                        try:
+                                                st = entry.stat ()
+                                        except OSError:
+                                                continue
+                                        entries.append ((st.st_mtime, st.st_size, entry.path))
+                                        total += st.st_size
+                if total > self.max_size:
+                        entries.sort ()
+                        for (mtime, size, path) in entries:
+                                if total <= self.max_size * cache_evict_ratio:
+                                        break
+                                try:
+                                        os.remove (path)
+                                except OSError:
+                                        pass
+                                total -= size
+                self.write_size (total)
+
+# インクルードファイルの解析キャッシュ：
+# 　インクルードファイルの絶対パスをキーとして，字句解析した文のリストをプロセス内に保持する。
+# 　各エントリは，依存するファイル（入れ子のインクルードを含む）の（絶対パス，更新時刻，大きさ，SHA-256）のリスト，
+# 　外部で定義されたマクロのうち展開したもの，定義したマクロ，（位置，字句解析の結果）の組のリストからなる。
+# 　依存するファイルの更新時刻と大きさが変わっていなければそのまま用い，変わっていれば内容のハッシュ値を比べる。
+# 　展開した外部のマクロの定義が変わった場合も用いない。
+# 　エントリ数が max_entries を越えると，最後に使用したのが古いものから破棄する。
+
+class ParseCache:
+
+        def __init__ (self, max_entries = 256):
+                self.max_entries = max_entries
+                self.entries = {}
+                self.hits = 0
+                self.misses = 0
+
+        # ファイル path のエントリを，マクロ辞書 macros のもとで有効なら返す。なければ None を返す。
+        def get (self, path, macros):
+                entry = self.entries.pop (path, None)
+                if entry == None or not self.valid (entry, macros):
+                        self.misses += 1
+                        return None
+                self.entries[path] = entry
+                self.hits += 1
+                return entry
+
+        # ファイル path のエントリ entry を登録する。
+        def put (self, path, entry):
+                self.entries.pop (path, None)
+                self.entries[path] = entry
+                while len (self.entries) > self.max_entries:
+                        del self.entries[next (iter (self.entries))]
+
+        # エントリ entry がマクロ辞書 macros のもとで有効かを返す。
+        def valid (self, entry, macros):
+                (deps, uses, defines, records) = entry
+                for (name, macro) in uses.items ():
+                        if macros.get (name) != macro:
+                                return False
+                for (path, mtime, size, digest) in deps:
+                        try:
+                                st = os.stat (path)
+                                if (st.st_mtime_ns, st.st_size) == (mtime, size):
+                                        continue
+                                import hashlib
+                                with open (path, "rb") as include_file:
+                                        if hashlib.sha256 (include_file.read ()).digest () != digest:
+                                                return False
+                        except OSError:
+                                return False
+                return True
 
-# レジスタ対即値算術論理演算命令のサイズを返す。
-
-def preparse_reg_imm_arith (asm_line):
-        # マッチしなければ何もしない。
-        match = reg_imm_arith_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 4, padding_size (4))
-
-# 即値シフト命令を解析する。
-
-def parse_reg_imm_shift (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = reg_imm_shift_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        # ニーモニックを検証する。
-        mnemonic = match.group ('mnemonic')
-        opcode = reg_imm_shift_dict.get (mnemonic.lower ())
-        if opcode == None:
-                return None
-        # ディスティネーションレジスタを検証する。
-        rdreg = match.group ('rd')
-        rdindex = reg_dict.get (rdreg.lower ())
-        if rdindex == None:
-                print_error (asm_filename, asm_line_number, "不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
-                error_flag = True
-        # ソースレジスタを検証する。
-        rs1reg = match.group ('rs1')
-        rs1index = reg_dict.get (rs1reg.lower ())
-        if rs1index == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs1reg))
-                error_flag = True
-        # シフト量を検証する。
+# プロセス内で共有する解析キャッシュ（バッチアセンブルの各ワーカプロセスと常駐モードで，ファイルをまたいで用いる。）
+parse_cache = ParseCache ()
+
+# マクロ：
+# 　名前 name，仮引数名のタプル params，本体の（行番号，行）の組のタプル body，定義したファイル名 filename からなる。
+# 　定義が同じかは == で比べる。
+
+Macro = collections.namedtuple ("Macro", ["name", "params", "body", "filename"])
+
+# マクロの展開の入れ子の上限
+macro_depth_limit = 64
+
+# 領域確保疑似命令と繰り返しデータ定義疑似命令で確保できるサイズの上限（バイト）
+space_size_limit = 0x1000000
+
+# 境界合わせ疑似命令で指定できる値（2を底とする指数）の上限
+align_limit = 20
+
+# ソースコード source（bytes）がアセンブルキャッシュを使えるかを返す。
+# インクルードファイルの内容はキーに含まれないので，インクルードするソースコードはキャッシュしない。
+# バイナリファイルを取り込むソースコードも同様である。
+
+def cacheable (source):
+        return re.search (rb"\.inc(lude|bin)", source, re.IGNORECASE) == None
+
+# li 疑似命令のオペランドのマッチ結果 match から即値を返す。
+
+def li_value (match):
         if match.group ('dec') != None:
-                shamt = int (match.group ('dec'))
-        elif match.group ('hex') != None:
-                shamt = int (match.group ('hex'), 16)
-        else:
-                pass
-        if (shamt < 0) or (shamt > 31):
-                print_error (asm_filename, asm_line_number, "妥当な範囲（0～31）外のシフト量が指定されています。。")
-                error_flag = True
-        # コードを生成する。
-        if not error_flag:
-                insert_padding (padding_size (4))
-                opcode |= ((rdindex << 7) | (rs1index << 15) | (shamt << 20)) & 0xffffffff
-                bin_file.write (struct.pack ("<I", opcode))
-                binary_loc += 4
-        return True
+                return int (match.group ('dec'))
+        return int (match.group ('hex'), 16)
+
+# オペランドのマッチ結果 match の，10進数のグループ name または16進数のグループ name + "hex" の値を返す。
+# どちらもなければ default を返す。
+
+def operand_value (match, name, default = None):
+        if match.group (name) != None:
+                return int (match.group (name))
+        if match.group (name + "hex") != None:
+                return int (match.group (name + "hex"), 16)
+        return default
+
+# データ定義疑似命令ごとの（10進数の最小値，10進数の最大値，16進数の最大値，struct の形式，サイズ）の組
+defdata_formats = {
+        ".dd": (- 2**31, + 2**31 - 1, 0xffffffff, "i", 4),
+        ".dw": (-32768, +32767, 0xffff, "h", 2),
+        ".db": (-128, +127, 0xff, "b", 1),
+        }
 
-# 即値シフト命令のサイズを返す。
-
-def preparse_reg_imm_shift (asm_line):
-        # マッチしなければ何もしない。
-        match = reg_imm_shift_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 4, padding_size (4))
-
-# ロード／ストア命令を解析する。
-
-def parse_load_store (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        load_instructions = { "lw", "lh", "lhu", "lb", "lbu" }
-        store_instructions = { "sw", "sh", "sb" }
-        
-        # マッチしなければ何もしない。
-        match = load_store_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        # ニーモニックを検証する。
-        mnemonic = match.group ('mnemonic')
-        opcode = load_store_dict.get (mnemonic.lower ())
-        if opcode == None:
-                return None
-        # ロード／ストアの対象となるレジスタを検証する。
-        reg = match.group ('reg')
-        regindex = reg_dict.get (reg)
-        if regindex == None:
-                if mnemonic in load_instructions:
-                        regtype = "ディスティネーションレジスタ"
-                elif mnemonic in store_instructions:
-                        regtype = "ソースレジスタ"
+# 32ビットの値 value を符号付きの値として返す。
+
+def signed32 (value):
+        return ((value & 0xffffffff) ^ 0x80000000) - 0x80000000
+
+# 1回分のアセンブルの状態と処理。
+
+class Assembly:
+
+        def __init__ (self, source, filename, stat, user, log):
+                # ソースファイル名
+                self.asm_filename = filename
+                # ソースファイルの状態
+                self.asm_stat = stat
+                # アセンブル環境情報に記録する時刻（None なら実際のアセンブル時刻とファイルの各時刻）
+                self.asm_time = None
+                # オブジェクトイメージにソースコードを添付するか
+                self.attach = True
+                # アセンブルユーザ名（None ならオブジェクトイメージを確保するときにこのプロセスのユーザ名とする。）
+                self.asm_user = user
+                # ソースコード（添付用のバイト列と，解析用の文字列）
+                if isinstance (source, str):
+                        self.asm_source = source.encode ('utf-8')
+                        self.asm_text = io.StringIO (source, newline = None)
                 else:
-                        pass
-                print_error (asm_filename, asm_line_number, "不正な{0} {1} が指定されています。".format (regtype, reg))
-                error_flag = True
-        # オフセットを検証する。
-        if match.group ('dec') != None:
-                imm = int (match.group ('dec'))
-                if (imm < -2048) or (imm > 2047):
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（-2048～2047）外の即値が指定されています。")
-                        error_flag = True
-        elif match.group ('hex') != None:
-                imm = int (match.group ('hex'), 16)
-                if imm > 0xfff:
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（0x000～0xfff）外の即値が指定されています。")
-                        error_flag = True
-        elif match.group ('ref') != None:
-                ref = match.group ("ref")
-                imm = label_dict.get (ref)
-                if imm == None:
-                        print_error (asm_filename, asm_line_number, "ラベル {0} は未定義です。".format (ref))
-                        error_flag = True
+                        self.asm_source = bytes (source)
+                        self.asm_text = io.TextIOWrapper (io.BytesIO (self.asm_source))
+                # 進捗と診断メッセージの出力先
+                self.log = log
+                # 診断メッセージのリスト
+                self.diagnostics = []
+                # アセンブル中の行番号
+                self.asm_line_number = 1
+                # ロケーション
+                self.binary_loc = 0
+                # エラーフラグ
+                self.error_flag = False
+                # 文リスト：
+                # 　パス1で解析した文を（コード生成メソッド，ニーモニック，オペランドのマッチ結果，アドレス，パディング量，行番号）の組で格納するリスト。
+                # 　パス2はソースファイルを読み直さず，このリストに沿ってコード生成する。
+                self.statement_list = []
+                # ラベル辞書：
+                # 　ラベル名（小文字）をキー，アドレスを値とする辞書。
+                self.label_dict = {}
+                # オブジェクトイメージ：
+                # 　ファイルヘッダ，アセンブル環境情報，バイナリ，ソースコードを順に並べたオブジェクトファイルの内容。
+                # 　パス1の終了後に確保し，パス2で各文のコードを書き込む。
+                self.bin_image = bytearray ()
+                # プロファイル
+                self.profile = AssemblyProfile ()
+                # マクロ辞書：
+                # 　マクロ名（小文字）をキー，Macro を値とする辞書。
+                self.macros = {}
+                # インクルード中のファイルの絶対パスのリスト（再帰的なインクルードの検出に用いる。）
+                self.include_stack = []
+                # インクルード中のファイルごとの，依存するファイルのリスト，展開した外部のマクロ，定義したマクロの組のリスト
+                self.include_frames = []
+                # ソースファイル名が相対パスの場合に，インクルードファイルを探す基準のディレクトリ
+                self.directory = None
+                # 範囲外なら長い命令列に置き換える分岐命令の（文リストの番号，分岐先ラベル，種類）の組と，
+                # 4バイトを越える境界に合わせる境界合わせ疑似命令の（文リストの番号，境界のバイト数，種類）の組を，文リストの順に並べたリスト
+                self.relax_list = []
+                # ラベル名をキー，（直後の文の文リストの番号，境界合わせ疑似命令と同じ行で定義したか）の組を値とする辞書
+                self.label_index = {}
+                # 長い命令列に置き換えた分岐命令のアドレスの集合
+                self.long_forms = set ()
+                # インクルードファイルの解析キャッシュ（None ならキャッシュしない。）
+                self.parse_cache = parse_cache
+                # バイナリファイル取り込み疑似命令のオペランドのマッチ結果をキー，取り込む内容を値とする辞書
+                self.incbin_data = {}
+
+        # 進捗を出力する。
+        def print_log (self, msg):
+                if self.log != None:
+                        print (msg, file = self.log)
+
+        # エラーメッセージを記録し，出力する。
+        # 　インクルードファイルやマクロの本体の文では，行番号の代わりに（ファイル名，行番号，展開元）の組を位置とする。
+        def print_error (self, msg):
+                if isinstance (self.asm_line_number, tuple):
+                        (filename, lineno, via) = self.asm_line_number
+                        diagnostic = Diagnostic (filename, lineno, msg if via == None else "{0}（{1}）".format (msg, via))
                 else:
-                        imm &= 0x00000fff
-        elif match.group ('lohex') != None:
-                imm = match.group ("lohex")
-                if (imm < 0x00000000) or (imm > 0xffffffff):
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（0x00000000～0xffffffff）外の即値が指定されています。")
-                        error_flag = True
+                        diagnostic = Diagnostic (self.asm_filename, self.asm_line_number, msg)
+                self.diagnostics.append (diagnostic)
+                self.profile.errors += 1
+                self.print_log (diagnostic)
+
+        # パディング量を返す。
+        def padding_size (self, unitsize):
+                size = 0
+                if self.binary_loc % unitsize != 0:
+                        size = unitsize - self.binary_loc % unitsize
+                return size
+
+        # 指定量のパディングをする。
+        # オブジェクトイメージは0で初期化されているので，ロケーションを進めるだけでよい。
+        def insert_padding (self, padsize):
+                self.binary_loc += padsize
+                self.profile.padding += padsize
+
+        # アセンブルし，AssemblyResult を返す。
+        def run (self, cache = None, options = {}):
+                # キャッシュにあれば，パス1とパス2を省略してコードとラベル辞書を再利用する。
+                if cache != None and not cacheable (self.asm_source):
+                        cache = None
+                if cache != None:
+                        key = cache.key (self.asm_source, options)
+                        entry = cache.get (key)
+                        if entry != None:
+                                return self.reuse (entry)
+
+                # ラベルのアドレスを解決する。（パス1）
+                self.print_log ("*** PASS 1 ***")
+                start = time.perf_counter ()
+                self.pass1 ()
+                self.profile.lap ("pass1", start)
+                if self.error_flag:
+                        return AssemblyResult (None, self.label_dict, self.diagnostics, profile = self.profile)
+
+                # オブジェクトイメージを確保する。
+                self.allocate_image ()
+
+                # パス1で作成した文リストに沿ってコード生成する。（パス2）
+                self.print_log ("*** PASS 2 ***")
+                start = time.perf_counter ()
+                self.pass2 ()
+                self.profile.lap ("pass2", start)
+                if self.error_flag:
+                        return AssemblyResult (None, self.label_dict, self.diagnostics, profile = self.profile)
+
+                # コードとラベル辞書をキャッシュに登録する。
+                if cache != None:
+                        cache.put (key, memoryview (self.bin_image)[binary_pos:self.asmfile_pos], self.label_dict)
+                return self.attach_source ()
+
+        # キャッシュから取り出した（コード，ラベル辞書）の組 entry からオブジェクトイメージを作り，AssemblyResult を返す。
+        def reuse (self, entry):
+                (code, self.label_dict) = entry
+                self.print_log ("*** CACHE HIT ***")
+                self.binary_loc = len (code)
+                self.allocate_image ()
+                self.bin_image[binary_pos:binary_pos + len (code)] = code
+                return self.attach_source (cached = True)
+
+        # オブジェクトイメージをソースコードの末尾までの大きさで確保し，ファイルヘッダとアセンブル環境情報を記録する。
+        # バイナリの大きさはロケーション binary_loc とする。
+        # asm_time を指定した場合は，アセンブル時刻とファイルの各時刻にすべてその時刻を記録する。
+        # attach が偽なら，ソースコードを添付せず，オブジェクトイメージはバイナリの末尾で終わる。
+        def allocate_image (self):
+                import uuid
+                if self.asm_user == None:
+                        import getpass
+                        self.asm_user = getpass.getuser ()
+                if self.asm_time != None:
+                        asm_time = self.asm_time
+                        (ctime, atime, mtime) = (asm_time, asm_time, asm_time)
+                elif self.asm_stat != None:
+                        asm_time = time.time ()
+                        (ctime, atime, mtime) = (self.asm_stat.st_ctime, self.asm_stat.st_atime, self.asm_stat.st_mtime)
+                else:
+                        asm_time = time.time ()
+                        (ctime, atime, mtime) = (asm_time, asm_time, asm_time)
+
+                # ソースコードを ZIP 形式に圧縮する。
+                # 　一時ファイルを介さずメモリ上で圧縮し，ZIP 内のオフセットは従来どおり ZIP の先頭からの相対位置とする。
+                start = time.perf_counter ()
+                if self.attach:
+                        import zipfile
+                        zip_buffer = io.BytesIO ()
+                        with zipfile.ZipFile (zip_buffer, 'w', compression = zipfile.ZIP_DEFLATED) as zipf:
+                                zipf.writestr (source_zipinfo (self.asm_filename, self.asm_stat, mtime), self.asm_source)
+                        self.zip_image = zip_buffer.getbuffer ()
                 else:
+                        self.zip_image = b""
+                self.profile.lap ("attach", start)
+
+                # オブジェクトイメージを確保する。
+                self.asmfile_pos = binary_pos + self.binary_loc
+                self.bin_image = bytearray (self.asmfile_pos + len (self.zip_image))
+
+                # ファイルヘッダを記録する。
+                struct.pack_into ("<8sIII", self.bin_image, 0,
+                        "FURV0000".encode ('utf-8'), # マジックストリング
+                        header_pos, # アセンブル環境情報
+                        binary_pos, # バイナリ
+                        self.asmfile_pos) # ソースコード
+
+                # アセンブル環境情報を記録する。
+                # 　UUID はオブジェクトファイルを識別するためのものなので，時刻を指定した場合も毎回作る。
+                struct.pack_into ("<16s16s16sdddd", self.bin_image, header_pos,
+                        uuid.uuid1 ().bytes, # UUID1
+                        uuid.uuid4 ().bytes, # UUID4
+                        self.asm_user.encode ('utf-8')[0:15], # ユーザ名
+                        asm_time, # アセンブル時刻
+                        ctime, # ファイル生成時刻
+                        atime, # ファイル参照時刻
+                        mtime) # ファイル更新時刻
+
+        # ソースコードを添付し，AssemblyResult を返す。
+        def attach_source (self, cached = False):
+                start = time.perf_counter ()
+                self.bin_image[self.asmfile_pos:] = self.zip_image
+                self.profile.lap ("attach", start)
+                return AssemblyResult (self.bin_image, self.label_dict, self.diagnostics, cached, self.profile)
+
+        # ソースコードを1行ずつ解析し，ラベルのアドレスを解決して文リストを作成する。（パス1）
+        # 　インクルードとマクロは expand で展開する。
+        def pass1 (self):
+                self.include_stack = [os.path.abspath (os.path.join (self.directory or "", self.asm_filename))]
+                for (self.asm_line_number, statement) in self.expand (enumerate (self.asm_text, 1), None, None, 0):
+                        self.locate (statement)
+                if not self.error_flag:
+                        self.relax ()
+
+        # 分岐先が範囲外の分岐命令を長い命令列に置き換え，文リストとラベル辞書のアドレスを更新する。
+        # 　どの分岐命令も短い形で配置した状態から始め，範囲外の分岐命令を長い形（4バイト長い）に置き換えて配置し直すことを，
+        # 　置き換えるものがなくなるまで繰り返す。長い形を短い形に戻すことはないので，必ず収束する。
+        # 　置き換えで後ろの文は4バイトずれるだけで，4バイトを越える境界合わせ疑似命令のほかはパディング量は変わらない。
+        # 　このため，各アドレスは，それより前にある置き換えた分岐命令と境界合わせ疑似命令によるずれから二分探索で求め，
+        # 　文リストを配置し直さない。
+        def relax (self):
+                if len (self.relax_list) == 0:
+                        return
+                indexes = [index for (index, dest, parse) in self.relax_list]
+                grown = [False] * len (indexes)
+                # 文リストの番号 index の文（same が真なら，その境界合わせ疑似命令のパディングの後）のずれを返す。
+                def shift (index, same = False):
+                        k = bisect.bisect_left (indexes, index)
+                        if same and k < len (indexes) and indexes[k] == index:
+                                return shifts[k] + pads[k]
+                        return shifts[k]
+                while True:
+                        # shifts[k] は，k 番目の文より前にある置き換えた分岐命令と境界合わせ疑似命令によるずれ，
+                        # pads[k] は，k 番目の文が境界合わせ疑似命令ならパディング量の増分である。
+                        shifts = [0] * (len (indexes) + 1)
+                        pads = [0] * len (indexes)
+                        for (k, (index, dest, parse)) in enumerate (self.relax_list):
+                                if parse == Assembly.parse_align:
+                                        (address, padding) = self.statement_list[index][3:5]
+                                        pads[k] = (- (address - padding + shifts[k])) % dest - padding
+                                        shifts[k + 1] = shifts[k] + pads[k]
+                                else:
+                                        shifts[k + 1] = shifts[k] + (4 if grown[k] else 0)
+                        changed = False
+                        for (k, (index, dest, parse)) in enumerate (self.relax_list):
+                                if parse == Assembly.parse_align or grown[k]:
+                                        continue
+                                target = self.label_dict.get (dest)
+                                if target == None:
+                                        continue
+                                address = self.statement_list[index][3] + shifts[k]
+                                target += shift (*self.label_index[dest])
+                                if parse == Assembly.parse_cond_branch:
+                                        fits = -4096 <= target - address <= 4094
+                                else:
+                                        fits = (target & 0xfff00000) == (address & 0xfff00000)
+                                if not fits:
+                                        grown[k] = True
+                                        changed = True
+                        if not changed:
+                                break
+                if not any (grown):
+                        return
+
+                # 文リストとラベル辞書のアドレスを，置き換えた分岐命令の分だけずらす。（最初に置き換えた分岐命令までは変わらない。）
+                # 境界合わせ疑似命令のパディング量も更新する。
+                self.long_forms = { self.statement_list[index][3] + shifts[k] for (k, index) in enumerate (indexes) if grown[k] }
+                first = indexes[grown.index (True)] + 1
+                statement_list = []
+                for (index, (parse, keyword, match, address, padding, line_number)) in enumerate (itertools.islice (self.statement_list, first, None), first):
+                        if parse == Assembly.parse_align:
+                                k = bisect.bisect_left (indexes, index)
+                                if k < len (indexes) and indexes[k] == index:
+                                        statement_list.append ((parse, keyword, match, address + shifts[k] + pads[k], padding + pads[k], line_number))
+                                        continue
+                        statement_list.append ((parse, keyword, match, address + shift (index), padding, line_number))
+                self.statement_list[first:] = statement_list
+                for (label, address) in self.label_dict.items ():
+                        self.label_dict[label] = address + shift (*self.label_index[label])
+                self.binary_loc += shifts[-1]
+
+        # （行番号，行）の組の列 lines を字句解析し，インクルードとマクロを展開して，（位置，字句解析の結果）の組を順に返す。
+        # 位置は，ソースファイル（filename が None）の行なら行番号，それ以外は（ファイル名，行番号，展開元）の組とする。
+        # via はマクロの展開元の説明（展開したのでなければ None），depth はマクロの展開の入れ子の深さである。
+        def expand (self, lines, filename, via, depth):
+                macro = None
+                for (lineno, asm_line) in lines:
+                        location = lineno if filename == None else (filename, lineno, via)
+                        self.asm_line_number = location
+                        # マクロの定義中は，.endm までの行を本体として記録する。
+                        if macro != None:
+                                if endm_pat.match (asm_line):
+                                        self.define_macro (macro)
+                                        macro = None
+                                else:
+                                        macro[2].append ((lineno, asm_line))
+                                continue
+                        statement = self.tokenize (asm_line)
+                        if statement == None:
+                                continue
+                        # ニーモニックがあってコード生成メソッドがない文は，インクルードとマクロの文である。
+                        (label, keyword, operands, preparse, parse) = statement
+                        if keyword == None or parse != None:
+                                yield (location, statement)
+                                continue
+                        if label != None:
+                                yield (location, (label, None, None, None, None))
+                        if keyword == ".macro":
+                                match = macro_pat.match (operands)
+                                if not match:
+                                        self.print_error ("文法エラー: .macro {0}".format (operands.strip ()))
+                                        self.error_flag = True
+                                        continue
+                                params = tuple (re.split (r"\s*,\s*|\s+", match.group ('params').strip ())) if match.group ('params') != None else ()
+                                macro = (match.group ('name'), params, [], filename, location)
+                        elif keyword == ".endm":
+                                self.print_error (".endm に対応する .macro がありません。")
+                                self.error_flag = True
+                        elif keyword == ".include":
+                                match = include_pat.match (operands)
+                                if not match:
+                                        self.print_error ("文法エラー: .include {0}".format (operands.strip ()))
+                                        self.error_flag = True
+                                        continue
+                                yield from self.include (match.group ('path'), filename)
+                        else:
+                                yield from self.invoke (self.macros[keyword], operands, location, depth)
+                if macro != None:
+                        self.asm_line_number = macro[4]
+                        self.print_error ("マクロ {0} に対応する .endm がありません。".format (macro[0]))
+                        self.error_flag = True
+
+        # マクロの定義中の状態 macro（名前，仮引数名，本体，ファイル名，位置）からマクロを定義する。
+        def define_macro (self, macro):
+                (name, params, body, filename, location) = macro
+                self.asm_line_number = location
+                if name.lower () in statement_table or name.lower () in pseudo_dict or name.lower () in preprocess_keywords or name.lower () in reserved_words:
+                        self.print_error ("マクロ名に予約語 {0} が指定されています。".format (name))
+                        self.error_flag = True
+                        return
+                if len (set (params)) != len (params):
+                        self.print_error ("マクロ {0} の仮引数名が重複しています。".format (name))
+                        self.error_flag = True
+                        return
+                macro = Macro (name, params, tuple (body), filename if filename != None else self.asm_filename)
+                self.macros[name.lower ()] = macro
+                for frame in self.include_frames:
+                        frame[2][name.lower ()] = macro
+
+        # 位置 location で，マクロ macro を実引数 operands で展開し，（位置，字句解析の結果）の組を順に返す。
+        def invoke (self, macro, operands, location, depth):
+                # 外部で定義されたマクロを展開したことを，インクルード中のファイルに記録する。
+                for frame in self.include_frames:
+                        if macro.name.lower () not in frame[2]:
+                                frame[1][macro.name.lower ()] = macro
+                # 実引数を「,」（括弧の外のもの）で区切る。
+                args = [arg.strip () for arg in re.split (r",(?![^(]*\))", operands)] if operands.strip () != "" else []
+                if len (args) != len (macro.params):
+                        self.print_error ("マクロ {0} の引数は {1} 個ですが，{2} 個指定されています。".format (macro.name, len (macro.params), len (args)))
+                        self.error_flag = True
+                        return
+                if depth >= macro_depth_limit:
+                        self.print_error ("マクロ {0} の展開が深すぎます。".format (macro.name))
+                        self.error_flag = True
+                        return
+                values = { param: arg for (param, arg) in zip (macro.params, args) }
+                if isinstance (location, tuple):
+                        (filename, lineno, via) = location
+                else:
+                        (filename, lineno, via) = (self.asm_filename, location, None)
+                here = "{0}, line {1} のマクロ {2} から展開".format (filename, lineno, macro.name)
+                body = ((n, macro_param_pat.sub (lambda m: values.get (m.group (1), m.group (0)), line)) for (n, line) in macro.body)
+                yield from self.expand (body, macro.filename, here if via == None else "{0}，{1}".format (here, via), depth + 1)
+
+        # ファイル filename（ソースファイルなら None）に書いた相対パス path の，（表示用のパス，絶対パス）の組を返す。
+        def resolve (self, path, filename):
+                base = os.path.dirname (filename if filename != None else self.asm_filename)
+                if filename == None and self.directory != None:
+                        base = os.path.join (self.directory, base)
+                display = os.path.normpath (os.path.join (base, path))
+                return (display, os.path.abspath (display))
+
+        # インクルードファイル path（インクルードするファイル名 filename からの相対パス）の（位置，字句解析の結果）の組を順に返す。
+        # 解析キャッシュにあればそれを用い，なければ字句解析してキャッシュに登録する。
+        def include (self, path, filename):
+                (display, abspath) = self.resolve (path, filename)
+                if abspath in self.include_stack:
+                        self.print_error ("ファイル {0} が再帰的にインクルードされています。".format (path))
+                        self.error_flag = True
+                        return
+                entry = self.parse_cache.get (abspath, self.macros) if self.parse_cache != None else None
+                if entry == None:
+                        try:
+                                with open (abspath, "rb") as include_file:
+                                        st = os.stat (include_file.fileno ())
+                                        data = include_file.read ()
+                        except OSError:
+                                self.print_error ("インクルードファイル {0} をオープンできません。".format (path))
+                                self.error_flag = True
+                                return
+                        # 字句解析する。エラーがあればキャッシュに登録しない。
+                        errors = len (self.diagnostics)
+                        import hashlib
+                        frame = ([(abspath, st.st_mtime_ns, st.st_size, hashlib.sha256 (data).digest ())], {}, {})
+                        self.include_stack.append (abspath)
+                        self.include_frames.append (frame)
+                        try:
+                                lines = enumerate (io.TextIOWrapper (io.BytesIO (data)), 1)
+                                records = list (self.expand (lines, display, None, 0))
+                        finally:
+                                self.include_stack.pop ()
+                                self.include_frames.pop ()
+                        entry = (frame[0], frame[1], frame[2], records)
+                        if len (self.diagnostics) == errors and self.parse_cache != None:
+                                self.parse_cache.put (abspath, entry)
+                (deps, uses, defines, records) = entry
+                # インクルードしたファイルで定義したマクロを登録し，依存するファイルと外部のマクロをインクルード中のファイルに伝える。
+                self.macros.update (defines)
+                for frame in self.include_frames:
+                        frame[0].extend (deps)
+                        for (name, macro) in uses.items ():
+                                if name not in frame[2]:
+                                        frame[1][name] = macro
+                        frame[2].update (defines)
+                yield from records
+
+        # 1行を字句解析し，（ラベル，ニーモニック，オペランドのマッチ結果，サイズを求めるメソッド，コード生成メソッド）の組を返す。
+        # 空行または文法エラーならば None を返す。
+        def tokenize (self, asm_line):
+                self.profile.lines += 1
+                # asm_line から最初の「#」以降のコメントを削除する。
+                comment_pos = asm_line.find ('#')
+                if comment_pos != -1:
+                        asm_line = asm_line[:comment_pos]
+                else:
+                        asm_line = asm_line.rstrip (os.linesep)
+                # 空行ならば次の文に進む。
+                if len (asm_line) == 0:
+                        return None
+                # asm_line を字句解析し，ラベルとニーモニック（またはディレクティブ）を取り出す。
+                token = self.profile.match ("statement", statement_pat, asm_line)
+                label = token.group ('label')
+                keyword = token.group ('keyword')
+                if label != None:
+                        label = label[:-1]
+                if keyword == None:
+                        # ラベルのみの文または空文でなければ文法エラーとする。
+                        if token.end () != len (asm_line):
+                                self.print_error ("文法エラー: {0}".format (asm_line))
+                                self.error_flag = True
+                                return None
+                        return (label, None, None, None, None)
+                # ニーモニック（またはディレクティブ）から解析方法を1回の表引きで決め，オペランドを解析する。
+                keyword = keyword.lower ()
+                entry = statement_table.get (keyword)
+                match = None
+                if entry != None:
+                        (pattern, preparse, parse) = entry
+                        match = self.profile.match (parse, pattern, asm_line, token.end ())
+                elif keyword in pseudo_dict:
+                        # 1命令に置き換える疑似命令は，置き換えた命令のオペランドとして解析する。
+                        (count, keyword, template) = pseudo_dict[keyword]
+                        (pattern, preparse, parse) = statement_table[keyword]
+                        operands = asm_line[token.end ():]
+                        operands = [operand.strip () for operand in operands.split (',')] if operands.strip () != "" else []
+                        if len (operands) == count:
+                                match = self.profile.match (parse, pattern, template.format (*operands))
+                elif keyword in preprocess_keywords or keyword in self.macros:
+                        # インクルードとマクロの文は，オペランドを文字列のまま返す。（展開は expand で行う。）
+                        return (label, keyword, asm_line[token.end ():], None, None)
+                if not match:
+                        self.print_error ("文法エラー: {0}".format (asm_line))
+                        self.error_flag = True
+                        return None
+                return (label, keyword, match, preparse, parse)
+
+        # 字句解析した文 statement にアドレスを割り当て，ラベルを登録し，コードを生成する文ならば文リストに登録する。
+        # （パディング量，サイズ）の組を返す。
+        def locate (self, statement):
+                (label, keyword, match, preparse, parse) = statement
+                self.profile.count (preparse, parse)
+                if preparse != None:
+                        (size, padding) = preparse (self, keyword, match)
+                else:
+                        (size, padding) = (0, 0)
+                self.binary_loc += padding
+                if label != None:
+                        # ラベルに予約語が指定されているならエラーを出す。
+                        if label.lower () in reserved_words:
+                                self.print_error ("ラベルに予約語 {0} が指定されています。".format (label))
+                                self.error_flag = True
+                        # ラベルが定義済みならエラーを出す。
+                        elif self.label_dict.get (label) != None:
+                                self.print_error ("ラベル {0} が重複定義されています。".format (label))
+                                self.error_flag = True
+                        # 当該ラベルに相当するアドレスを登録する。
+                        else:
+                                self.label_dict[label] = self.binary_loc
+                                self.label_index[label] = (len (self.statement_list), parse == Assembly.parse_align)
+                # コードを生成する文ならば文リストに登録する。
+                if parse != None:
+                        self.statement_list.append ((parse, keyword, match, self.binary_loc, padding, self.asm_line_number))
+                        # 範囲外なら置き換える分岐命令と，パディング量が変わりうる境界合わせ疑似命令を記録する。
+                        item = relax_item (parse, match)
+                        if item != None:
+                                self.relax_list.append ((len (self.statement_list) - 1,) + item)
+                # カウンタを進める。
+                self.binary_loc += size
+                return (padding, size)
+
+        # パス1で作成した文リストに沿ってコード生成する。（パス2）
+        def pass2 (self):
+                self.binary_loc = 0
+                for (parse, keyword, match, address, padding, self.asm_line_number) in self.statement_list:
+                        parse (self, keyword, match, address, padding)
+
+        # レジスタ対レジスタ算術論理演算命令を解析する。
+
+        def parse_reg_reg_arith (self, mnemonic, match, address, padding):
+                # オペコードを取得する。（検証はパス1で済んでいる。）
+                opcode = reg_reg_arith_dict[mnemonic.lower ()]
+                # ディスティネーションレジスタを検証する。
+                rdreg = match.group ('rd')
+                rdindex = reg_dict.get (rdreg.lower ())
+                if rdindex == None:
+                        self.print_error ("不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
+                        self.error_flag = True
+                # ソースレジスタ1を検証する。
+                rs1reg = match.group ('rs1')
+                rs1index = reg_dict.get (rs1reg.lower ())
+                if rs1index == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rs1reg))
+                        self.error_flag = True
+                # ソースレジスタ2を検証する。
+                rs2reg = match.group ('rs2')
+                rs2index = reg_dict.get (rs2reg.lower ())
+                if rs2index == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rs2reg))
+                        self.error_flag = True
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        opcode |= ((rdindex << 7) | (rs1index << 15) | (rs2index << 20)) & 0xffffffff
+                        struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, opcode)
+                        self.binary_loc += 4
+
+        # レジスタ対即値算術論理演算命令を解析する。
+
+        def parse_reg_imm_arith (self, mnemonic, match, address, padding):
+                # オペコードを取得する。（検証はパス1で済んでいる。）
+                opcode = reg_imm_arith_dict[mnemonic.lower ()]
+                # ディスティネーションレジスタを検証する。
+                rdreg = match.group ('rd')
+                rdindex = reg_dict.get (rdreg.lower ())
+                if rdindex == None:
+                        self.print_error ("不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
+                        self.error_flag = True
+                # ソースレジスタを検証する。
+                rs1reg = match.group ('rs1')
+                rs1index = reg_dict.get (rs1reg.lower ())
+                if rs1index == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rs1reg))
+                        self.error_flag = True
+                # 即値を検証する。
+                if match.group ('dec') != None:
+                        imm = int (match.group ('dec'))
+                        if mnemonic.lower () in { "addi", "slti", "jalr" }:
+                                min = -2048
+                                max = 2047
+                        if mnemonic.lower () in { "andi", "ori", "xori", "sltiu" }:
+                                min = 0
+                                max = 4095
+                        if (imm < min) or (imm > max):
+                                self.print_error ("妥当な範囲（{0}～{1}）外の即値が指定されています。".format (min, max))
+                                self.error_flag = True
+                elif match.group ('hex') != None:
+                        imm = int (match.group ('hex'), 16)
+                        if (imm < 0) or (imm > 0xfff):
+                                self.print_error ("妥当な範囲（0x000～0xfff）外の即値が指定されています。")
+                                self.error_flag = True
+                elif match.group ('ref') != None:
+                        ref = match.group ("ref")
+                        imm = self.label_dict.get (ref)
+                        if imm == None:
+                                self.print_error ("ラベル {0} は未定義です。".format (ref))
+                                self.error_flag = True
+                        else:
+                                imm &= 0x00000fff
+                elif match.group ('lohex') != None:
+                        imm = int (match.group ('lohex'), 16)
+                        if (imm < 0) or (imm > 0xffffffff):
+                                self.print_error ("妥当な範囲（0x00000000～0xffffffff）外の即値が指定されています。")
+                                self.error_flag = True
                         imm &= 0x00000fff
-        else:
-                pass
-        # インデックスレジスタを検証する。
-        rs1reg = match.group ('rs1')
-        rs1index = reg_dict.get (rs1reg.lower ())
-        if rs1index == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs1reg))
-                error_flag = True
-        # コードを生成する。
-        if not error_flag:
-                insert_padding (padding_size (4))
-                if mnemonic in load_instructions:
-                        opcode |= ((regindex << 7) | (rs1index << 15)) & 0xffffffff
-                        opcode |= (imm << 20) & 0xffffffff
-                elif mnemonic in store_instructions:
-                        opcode |= ((regindex << 20) | (rs1index << 15)) & 0xffffffff
-                        opcode |= ((imm & 0b00000000_00000000_00000000_00011111) << 7) & 0xffffffff
-                        opcode |= ((imm & 0b00000000_00000000_00001111_11100000) << 20) & 0xffffffff
                 else:
                         pass
-                bin_file.write (struct.pack ("<I", opcode))
-                binary_loc += 4
-        return True
-
-# ロード／ストア命令のサイズを返す。
-
-def preparse_load_store (asm_line):
-        # マッチしなければ何もしない。
-        match = load_store_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 4, padding_size (4))
-
-# データ転送命令を解析する。
-
-def parse_data_xfer (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = data_xfer_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        # ニーモニックを検証する。
-        mnemonic = match.group ('mnemonic')
-        opcode = data_xfer_dict.get (mnemonic.lower ())
-        if opcode == None:
-                return None
-        # ディスティネーションレジスタを検証する。
-        rdreg = match.group ('rd')
-        rdindex = reg_dict.get (rdreg.lower ())
-        if rdindex == None:
-                print_error (asm_filename, asm_line_number, "不正なディスティネーションレジスタ {0} が指定されています。".format (rs1reg))
-                error_flag = True
-        # 即値を検証する。
-        if match.group ('dec') != None:
-                imm = int (match.group ('dec'))
-                if (imm < 0) or (imm >= 1048576):
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（0～1048575）外の即値が指定されています。".format (imm))
-                        error_flag = True
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        opcode |= ((rdindex << 7) | (rs1index << 15) | (imm << 20)) & 0xffffffff
+                        struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, opcode)
+                        self.binary_loc += 4
+
+        # 即値シフト命令を解析する。
+
+        def parse_reg_imm_shift (self, mnemonic, match, address, padding):
+                # オペコードを取得する。（検証はパス1で済んでいる。）
+                opcode = reg_imm_shift_dict[mnemonic.lower ()]
+                # ディスティネーションレジスタを検証する。
+                rdreg = match.group ('rd')
+                rdindex = reg_dict.get (rdreg.lower ())
+                if rdindex == None:
+                        self.print_error ("不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
+                        self.error_flag = True
+                # ソースレジスタを検証する。
+                rs1reg = match.group ('rs1')
+                rs1index = reg_dict.get (rs1reg.lower ())
+                if rs1index == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rs1reg))
+                        self.error_flag = True
+                # シフト量を検証する。
+                if match.group ('dec') != None:
+                        shamt = int (match.group ('dec'))
+                elif match.group ('hex') != None:
+                        shamt = int (match.group ('hex'), 16)
                 else:
-                        imm = (imm << 12) & 0xfffff000
-        elif match.group ('hex') != None:
-                imm = int (match.group ('hex'), 16)
-                if imm >= 0x100000:
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（0x00000～0xfffff）外の即値が指定されています。".format (imm))
-                        error_flag = True
+                        pass
+                if (shamt < 0) or (shamt > 31):
+                        self.print_error ("妥当な範囲（0～31）外のシフト量が指定されています。。")
+                        self.error_flag = True
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        opcode |= ((rdindex << 7) | (rs1index << 15) | (shamt << 20)) & 0xffffffff
+                        struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, opcode)
+                        self.binary_loc += 4
+
+        # ロード／ストア命令を解析する。
+
+        def parse_load_store (self, mnemonic, match, address, padding):
+                load_instructions = { "lw", "lh", "lhu", "lb", "lbu" }
+                store_instructions = { "sw", "sh", "sb" }
+
+                # オペコードを取得する。（検証はパス1で済んでいる。）
+                opcode = load_store_dict[mnemonic.lower ()]
+                # ロード／ストアの対象となるレジスタを検証する。
+                reg = match.group ('reg')
+                regindex = reg_dict.get (reg.lower ())
+                if regindex == None:
+                        if mnemonic in load_instructions:
+                                regtype = "ディスティネーションレジスタ"
+                        elif mnemonic in store_instructions:
+                                regtype = "ソースレジスタ"
+                        else:
+                                pass
+                        self.print_error ("不正な{0} {1} が指定されています。".format (regtype, reg))
+                        self.error_flag = True
+                # オフセットを検証する。
+                if match.group ('dec') != None:
+                        imm = int (match.group ('dec'))
+                        if (imm < -2048) or (imm > 2047):
+                                self.print_error ("妥当な範囲（-2048～2047）外の即値が指定されています。")
+                                self.error_flag = True
+                elif match.group ('hex') != None:
+                        imm = int (match.group ('hex'), 16)
+                        if imm > 0xfff:
+                                self.print_error ("妥当な範囲（0x000～0xfff）外の即値が指定されています。")
+                                self.error_flag = True
+                elif match.group ('ref') != None:
+                        ref = match.group ("ref")
+                        imm = self.label_dict.get (ref)
+                        if imm == None:
+                                self.print_error ("ラベル {0} は未定義です。".format (ref))
+                                self.error_flag = True
+                        else:
+                                imm &= 0x00000fff
+                elif match.group ('lohex') != None:
+                        imm = int (match.group ("lohex"), 16)
+                        if (imm < 0x00000000) or (imm > 0xffffffff):
+                                self.print_error ("妥当な範囲（0x00000000～0xffffffff）外の即値が指定されています。")
+                                self.error_flag = True
+                        else:
+                                imm &= 0x00000fff
                 else:
-                        imm = (imm << 12) & 0xfffff000
-        elif match.group ('ref') != None:
-                ref = match.group ("ref")
-                imm = label_dict.get (ref)
-                if imm == None:
-                        print_error (asm_filename, asm_line_number, "ラベル {0} は未定義です。".format (ref))
-                        error_flag = True
+                        pass
+                # インデックスレジスタを検証する。
+                rs1reg = match.group ('rs1')
+                rs1index = reg_dict.get (rs1reg.lower ())
+                if rs1index == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rs1reg))
+                        self.error_flag = True
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        if mnemonic in load_instructions:
+                                opcode |= ((regindex << 7) | (rs1index << 15)) & 0xffffffff
+                                opcode |= (imm << 20) & 0xffffffff
+                        elif mnemonic in store_instructions:
+                                opcode |= ((regindex << 20) | (rs1index << 15)) & 0xffffffff
+                                opcode |= ((imm & 0b00000000_00000000_00000000_00011111) << 7) & 0xffffffff
+                                opcode |= ((imm & 0b00000000_00000000_00001111_11100000) << 20) & 0xffffffff
+                        else:
+                                pass
+                        struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, opcode)
+                        self.binary_loc += 4
+
+        # データ転送命令を解析する。
+
+        def parse_data_xfer (self, mnemonic, match, address, padding):
+                # オペコードを取得する。（検証はパス1で済んでいる。）
+                opcode = data_xfer_dict[mnemonic.lower ()]
+                # ディスティネーションレジスタを検証する。
+                rdreg = match.group ('rd')
+                rdindex = reg_dict.get (rdreg.lower ())
+                if rdindex == None:
+                        self.print_error ("不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
+                        self.error_flag = True
+                # 即値を検証する。
+                if match.group ('dec') != None:
+                        imm = int (match.group ('dec'))
+                        if (imm < 0) or (imm >= 1048576):
+                                self.print_error ("妥当な範囲（0～1048575）外の即値が指定されています。".format (imm))
+                                self.error_flag = True
+                        else:
+                                imm = (imm << 12) & 0xfffff000
+                elif match.group ('hex') != None:
+                        imm = int (match.group ('hex'), 16)
+                        if imm >= 0x100000:
+                                self.print_error ("妥当な範囲（0x00000～0xfffff）外の即値が指定されています。".format (imm))
+                                self.error_flag = True
+                        else:
+                                imm = (imm << 12) & 0xfffff000
+                elif match.group ('ref') != None:
+                        ref = match.group ("ref")
+                        imm = self.label_dict.get (ref)
+                        if imm == None:
+                                self.print_error ("ラベル {0} は未定義です。".format (ref))
+                                self.error_flag = True
+                        else:
+                                imm = imm & 0xfffff000
+                elif match.group ('hihex') != None:
+                        imm = int (match.group ('hihex'), 16)
+                        if (imm < 0) or (imm > 0xffffffff):
+                                self.print_error ("妥当な範囲（0x00000000～0xffffffff）外の即値が指定されています。".format (imm))
+                                self.error_flag = True
+                        else:
+                                imm = imm & 0xfffff000
                 else:
-                        imm = imm & 0xfffff000
-        elif match.group ('hihex') != None:
-                imm = int (match.group ('hihex'), 16)
-                if (imm < 0) or (imm > 0xffffffff):
-                        print_error (asm_filename, asm_line_number, "妥当な範囲（0x00000000～0xffffffff）外の即値が指定されています。".format (imm))
-                        error_flag = True
+                        pass
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        opcode |= (rdindex << 7) & 0xffffffff
+                        opcode |= (imm & 0xfffff000)
+                        struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, opcode)
+                        self.binary_loc += 4
+
+        # 条件分岐命令を解析する。
+
+        def parse_cond_branch (self, mnemonic, match, address, padding):
+                # オペコードを取得する。（検証はパス1で済んでいる。）
+                opcode = cond_branch_dict[mnemonic.lower ()]
+                # ソースレジスタ1を検証する。
+                rs1reg = match.group ('rs1')
+                rs1index = reg_dict.get (rs1reg.lower ())
+                if rs1index == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rs1reg))
+                        self.error_flag = True
+                # ソースレジスタ2を検証する。
+                rs2reg = match.group ('rs2')
+                rs2index = reg_dict.get (rs2reg.lower ())
+                if rs2index == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rs2reg))
+                        self.error_flag = True
+                # 分岐先ラベルを検証する。
+                dest = match.group ('dest')
+                if dest.lower () in reserved_words:
+                        self.print_error ("分岐先ラベルに予約語 {0} が指定されています。".format (dest))
+                        self.error_flag = True
+                        return
+                if self.label_dict.get (dest) == None:
+                        self.print_error ("分岐先ラベル {0} を解決できません。".format (dest))
+                        self.error_flag = True
+                        return
+                jumpto = self.label_dict.get (dest)
+                # パス1で長い形に置き換えた場合は，逆条件で次の命令を飛び越す分岐命令と jal 命令を生成する。
+                # （逆条件は funct3 の最下位ビットを反転して得られる。）
+                if address in self.long_forms:
+                        if (jumpto & 0xfff00000) != ((address + 4) & 0xfff00000):
+                                self.print_error ("分岐先ラベル {0} はジャンプ可能範囲外です。".format (dest))
+                                self.error_flag = True
+                                return
+                        if not self.error_flag:
+                                self.insert_padding (padding)
+                                struct.pack_into ("<II", self.bin_image, binary_pos + self.binary_loc,
+                                        encode_branch (opcode ^ (1 << 12), rs1index, rs2index, 8), encode_jal (0, jumpto))
+                                self.binary_loc += 8
+                        return
+                jumpto -= address
+                if (jumpto < -4096) or (jumpto > 4094):
+                        self.print_error ("分岐先ラベル {0} はジャンプ可能範囲外です。".format (dest))
+                        self.error_flag = True
+                        return
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        opcode = encode_branch (opcode, rs1index, rs2index, jumpto)
+                        struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, opcode)
+                        self.binary_loc += 4
+
+        # jal 命令を解析する。
+
+        def parse_jal (self, mnemonic, match, address, padding):
+                # ディスティネーションレジスタを検証する。
+                rdreg = match.group ('rd')
+                rdindex = reg_dict.get (rdreg.lower ())
+                if rdindex == None:
+                        self.print_error ("不正なソースレジスタ {0} が指定されています。".format (rdreg))
+                        self.error_flag = True
+                # 分岐先ラベルを検証する。
+                dest = match.group ('dest')
+                if dest.lower () in reserved_words:
+                        self.print_error ("分岐先ラベルに予約語 {0} が指定されています。".format (dest))
+                        self.error_flag = True
+                        return
+                jumpto = self.label_dict.get (dest)
+                if  jumpto == None:
+                        self.print_error ("分岐先ラベル {0} を解決できません。".format (dest))
+                        self.error_flag = True
+                        return
+                # パス1で長い形に置き換えた場合は，リンクレジスタに分岐先アドレスの上位を置く lui 命令と jalr 命令を生成する。
+                if address in self.long_forms:
+                        if not self.error_flag:
+                                self.insert_padding (padding)
+                                (hi, lo) = split_hi_lo (jumpto)
+                                struct.pack_into ("<II", self.bin_image, binary_pos + self.binary_loc,
+                                        encode_utype (data_xfer_dict["lui"], rdindex, hi), encode_itype (reg_imm_arith_dict["jalr"], rdindex, rdindex, lo))
+                                self.binary_loc += 8
+                        return
+                if (jumpto & 0xfff00000) != (address & 0xfff00000):
+                        self.print_error ("分岐先ラベル {0} はジャンプ可能範囲外です。".format (dest))
+                        self.error_flag = True
+                        return
+                # コード生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, encode_jal (rdindex, jumpto))
+                        self.binary_loc += 4
+
+        # li 疑似命令を解析する。
+        # 　値が符号付き12ビットに収まれば addi 命令，下位12ビットが0なら lui 命令，それ以外は lui 命令と addi 命令を生成する。
+
+        def parse_li (self, mnemonic, match, address, padding):
+                # ディスティネーションレジスタを検証する。
+                rdreg = match.group ('rd')
+                rdindex = reg_dict.get (rdreg.lower ())
+                if rdindex == None:
+                        self.print_error ("不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
+                        self.error_flag = True
+                # 即値を検証する。（値域の検証はパス1で済んでいる。）
+                value = signed32 (li_value (match))
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        (hi, lo) = split_hi_lo (value)
+                        if -2048 <= value <= 2047:
+                                words = [encode_itype (reg_imm_arith_dict["addi"], rdindex, 0, value)]
+                        elif lo == 0:
+                                words = [encode_utype (data_xfer_dict["lui"], rdindex, hi)]
+                        else:
+                                words = [encode_utype (data_xfer_dict["lui"], rdindex, hi), encode_itype (reg_imm_arith_dict["addi"], rdindex, rdindex, lo)]
+                        for word in words:
+                                struct.pack_into ("<I", self.bin_image, binary_pos + self.binary_loc, word)
+                                self.binary_loc += 4
+
+        # la 疑似命令を解析する。
+        # 　ラベルのアドレスを lui 命令と addi 命令で作る。（アドレスによらず2命令とする。）
+
+        def parse_la (self, mnemonic, match, address, padding):
+                # ディスティネーションレジスタを検証する。
+                rdreg = match.group ('rd')
+                rdindex = reg_dict.get (rdreg.lower ())
+                if rdindex == None:
+                        self.print_error ("不正なディスティネーションレジスタ {0} が指定されています。".format (rdreg))
+                        self.error_flag = True
+                # ラベルを検証する。
+                ref = match.group ('ref')
+                value = self.label_dict.get (ref)
+                if value == None:
+                        self.print_error ("ラベル {0} は未定義です。".format (ref))
+                        self.error_flag = True
+                # コードを生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        (hi, lo) = split_hi_lo (value)
+                        struct.pack_into ("<II", self.bin_image, binary_pos + self.binary_loc,
+                                encode_utype (data_xfer_dict["lui"], rdindex, hi), encode_itype (reg_imm_arith_dict["addi"], rdindex, rdindex, lo))
+                        self.binary_loc += 8
+
+        # データ定義疑似命令を解析する。
+        # 　データ並びはまとめて変換し，値域を一括で検証して，1回の struct.pack_into で書き込む。
+        # 　16進数は符号付きの値に読み替える。範囲外の16進数は読み替えても10進数の値域に入らないので，最小値と最大値だけで検証できる。
+        # 　ラベルを含むか範囲外のデータがあれば，データごとに変換して診断メッセージを出す。
+        def parse_defdata (self, directive, match, address, padding):
+                # ディレクティブに応じた値域と形式を決める。（検証はパス1で済んでいる。）
+                (decmin, decmax, hexmax, fmt, size) = defdata_formats[directive.lower ()]
+                sign = decmax + 1
+                # コード生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        datalist = match.group ('datalist').split (',')
+                        try:
+                                values = [(int (data, 16) ^ sign) - sign if "x" in data else int (data) for data in datalist]
+                                if min (values) < decmin or max (values) > decmax:
+                                        values = None
+                        except ValueError:
+                                values = None
+                        if values == None:
+                                values = self.defdata_values (directive, datalist, decmin, decmax, hexmax, size)
+                        if values != None:
+                                struct.pack_into ("<{0}{1}".format (len (values), fmt), self.bin_image, binary_pos + self.binary_loc, *values)
+                                self.binary_loc += len (values) * size
+
+        # データ定義疑似命令のデータ並び datalist をデータごとに変換し，符号付きの値に読み替えた値のリストを返す。
+        # 範囲外のデータや使えないラベルがあれば，すべて診断メッセージを出して None を返す。
+        def defdata_values (self, directive, datalist, decmin, decmax, hexmax, size):
+                values = []
+                for data in datalist:
+                        data = data.strip ()
+                        if data[0].isalpha () or data[0] == '_':
+                                if directive.lower () != ".dd":
+                                        self.print_error ("ラベル {0} は {1} 疑似命令では指定できません。".format (data, directive.lower ()))
+                                        self.error_flag = True
+                                        continue
+                                value = self.label_dict.get (data)
+                                if value == None:
+                                        self.print_error ("ラベル {0} は未定義です。".format (data))
+                                        self.error_flag = True
+                                        continue
+                        elif "x" in data:
+                                value = int (data, 16)
+                                if value > hexmax:
+                                        self.print_error ("データ {0} が {1} バイトで表現できる範囲を越えています。".format (data, size))
+                                        self.error_flag = True
+                                        continue
+                        else:
+                                value = int (data)
+                                if (value < decmin) or (value > decmax):
+                                        self.print_error ("データ {0} が {1} バイトで表現できる範囲を越えています。".format (data, size))
+                                        self.error_flag = True
+                                        continue
+                        values.append (((value & hexmax) ^ (decmax + 1)) - (decmax + 1))
+                return values if not self.error_flag else None
+
+        # 文字列定義疑似命令を解析する。
+
+        def parse_cstr (self, directive, match, address, padding):
+                # コード生成する。
+                if not self.error_flag:
+                        data = match.group ("str").encode ('ascii')
+                        self.bin_image[binary_pos + self.binary_loc:binary_pos + self.binary_loc + len (data)] = data
+                        self.binary_loc += len (data) + 1
+
+        # 領域確保疑似命令を解析する。
+        # 　オブジェクトイメージは0で初期化されているので，0以外の値で埋める場合だけ書き込む。
+
+        def parse_space (self, directive, match, address, padding):
+                # コード生成する。
+                if not self.error_flag:
+                        size = operand_value (match, 'size')
+                        value = operand_value (match, 'value', 0) if directive == ".space" else 0
+                        if value != 0:
+                                self.bin_image[binary_pos + self.binary_loc:binary_pos + self.binary_loc + size] = bytes ((value & 0xff,)) * size
+                        self.binary_loc += size
+
+        # 繰り返しデータ定義疑似命令を解析する。
+        # 　1個分のバイト列を繰り返したバイト列を1回で書き込む。
+
+        def parse_fill (self, directive, match, address, padding):
+                # コード生成する。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+                        repeat = operand_value (match, 'repeat')
+                        size = operand_value (match, 'size', 1)
+                        value = operand_value (match, 'value', 0)
+                        if value != 0:
+                                data = (value & ((1 << (size * 8)) - 1)).to_bytes (size, 'little') * repeat
+                                self.bin_image[binary_pos + self.binary_loc:binary_pos + self.binary_loc + len (data)] = data
+                        self.binary_loc += repeat * size
+
+        # 境界合わせ疑似命令を解析する。
+
+        def parse_align (self, directive, match, address, padding):
+                # パディングする。
+                if not self.error_flag:
+                        self.insert_padding (padding)
+
+        # バイナリファイル取り込み疑似命令を解析する。（取り込む内容はパス1で読み込んでいる。）
+
+        def parse_incbin (self, directive, match, address, padding):
+                # コード生成する。
+                if not self.error_flag:
+                        data = self.incbin_data[match]
+                        self.bin_image[binary_pos + self.binary_loc:binary_pos + self.binary_loc + len (data)] = data
+                        self.binary_loc += len (data)
+
+        # 命令のサイズとパディング量を返す。
+
+        def preparse_instruction (self, mnemonic, match):
+                return (4, self.padding_size (4))
+
+        # li 疑似命令のサイズとパディング量を返す。
+        # 　値が範囲外なら文法エラーとし，サイズは0とする。
+
+        def preparse_li (self, mnemonic, match):
+                value = li_value (match)
+                if value < -2**31 or value > 0xffffffff:
+                        self.print_error ("妥当な範囲（-2147483648～0xffffffff）外の即値が指定されています。")
+                        self.error_flag = True
+                        return (0, 0)
+                value = signed32 (value)
+                if -2048 <= value <= 2047 or value & 0xfff == 0:
+                        return (4, self.padding_size (4))
+                return (8, self.padding_size (4))
+
+        # la 疑似命令のサイズとパディング量を返す。
+
+        def preparse_la (self, mnemonic, match):
+                return (8, self.padding_size (4))
+
+        # データ定義疑似命令のサイズとパディング量を返す。
+
+        def preparse_defdata (self, directive, match):
+                if directive == ".dd":
+                        unitsize = 4
+                elif directive == ".dw":
+                        unitsize = 2
                 else:
-                        imm = imm & 0xfffff000
-        else:
-                pass
-        # コードを生成する。
-        if not error_flag:
-                insert_padding (padding_size (4))
-                opcode |= (rdindex << 7) & 0xffffffff
-                opcode |= (imm & 0xfffff000)
-                bin_file.write (struct.pack ("<I", opcode))
-                binary_loc += 4
-        return True
+                        unitsize = 1
+                datalist = match.group ('datalist')
+                datalist = datalist.split (',')
+                size = len (datalist) * unitsize
+                return (size, self.padding_size (unitsize))
 
-# データ転送命令のサイズを返す。
-
-def preparse_data_xfer (asm_line):
-        # マッチしなければ何もしない。
-        match = data_xfer_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 4, padding_size (4))
-
-# 条件分岐命令を解析する。
-
-def parse_cond_branch (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = cond_branch_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        # ニーモニックを検証する。
-        mnemonic = match.group ('mnemonic')
-        opcode = cond_branch_dict.get (mnemonic.lower ())
-        if opcode == None:
-                return None
-        # ソースレジスタ1を検証する。
-        rs1reg = match.group ('rs1')
-        rs1index = reg_dict.get (rs1reg.lower ())
-        if rs1index == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs1reg))
-                error_flag = True
-        # ソースレジスタ2を検証する。
-        rs2reg = match.group ('rs2')
-        rs2index = reg_dict.get (rs2reg.lower ())
-        if rs2index == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs2reg))
-                error_flag = True
-        # 分岐先ラベルを検証する。
-        dest = match.group ('dest')
-        if dest.lower () in reserved_words:
-                print_error (asm_filename, asm_line_number, "分岐先ラベルに予約語 {0} が指定されています。".format (dest))
-                error_flag = True
-                return None
-        if label_dict.get (dest) == None:
-                print_error (asm_filename, asm_line_number, "分岐先ラベル {0} を解決できません。".format (dest))
-                error_flag = True
-                return None
-        jumpto = label_dict.get (dest)
-        jumpto -= binary_loc
-        if (jumpto < -4096) or (jumpto > 4094):
-                print_error (asm_filename, asm_line_number, "分岐先ラベル {0} はジャンプ可能範囲外です。".format (dest))
-                error_flag = True
-                return None
-        # コードを生成する。
-        if not error_flag:
-                insert_padding (padding_size (4))
-                if jumpto < 0:
-                        jumpto += 8192
-                opcode |= ((rs1index << 15) | (rs2index << 20)) & 0xffffffff
-                opcode |= ((jumpto & 0b00000000_00000000_00000000_00011110) << 7) & 0xffffffff
-                opcode |= ((jumpto & 0b00000000_00000000_00000111_11100000) << 20) & 0xffffffff
-                opcode |= ((jumpto & 0b00000000_00000000_00001000_00000000) >> 4) & 0xffffffff
-                opcode |= ((jumpto & 0b00000000_00000000_00010000_00000000) << 19) & 0xffffffff
-                bin_file.write (struct.pack ("<I", opcode))
-                binary_loc += 4
-        return True
+        # 文字列定義疑似命令のサイズとパディング量を返す。
 
-# 条件分岐命令のサイズを返す。
-
-def preparse_cond_branch (asm_line):
-        # マッチしなければ何もしない。
-        match = cond_branch_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 4, padding_size (4))
-
-# jal 命令を解析する。
-
-def parse_jal (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = jal_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        if label != None:
-                label = label[:-1]
-        # ニーモニックを検証する。
-        mnemonic = match.group ('mnemonic')
-        if mnemonic.lower () != "jal":
-                return None
-        # ディスティネーションレジスタを検証する。
-        rdreg = match.group ('rd')
-        rdindex = reg_dict.get (rdreg.lower ())
-        if rdindex == None:
-                print_error (asm_filename, asm_line_number, "不正なソースレジスタ {0} が指定されています。".format (rs1reg))
-                error_flag = True
-        # 分岐先ラベルを検証する。
-        dest = match.group ('dest')
-        if dest.lower () in reserved_words:
-                print_error (asm_filename, asm_line_number, "分岐先ラベルに予約語 {0} が指定されています。".format (dest))
-                error_flag = True
-                return None
-        jumpto = label_dict.get (dest)
-        if  jumpto == None:
-                print_error (asm_filename, asm_line_number, "分岐先ラベル {0} を解決できません。".format (dest))
-                error_flag = True
-                return None
-        if (jumpto & 0xfff00000) != (binary_loc & 0xfff00000):
-                print_error (asm_filename, asm_line_number, "分岐先ラベル {0} はジャンプ可能範囲外です。".format (dest))
-                error_flag = True
+        def preparse_cstr (self, directive, match):
+                str = match.group ("str")
+                return (len (str) + 1, 0)
+
+        # 領域確保疑似命令のサイズとパディング量を返す。
+        # 　サイズや値が範囲外なら文法エラーとし，サイズは0とする。
+
+        def preparse_space (self, directive, match):
+                size = operand_value (match, 'size')
+                if size < 0 or size > space_size_limit:
+                        self.print_error ("妥当な範囲（0～{0:#x}）外のサイズが指定されています。".format (space_size_limit))
+                        self.error_flag = True
+                        return (0, 0)
+                if directive == ".space" and not -128 <= operand_value (match, 'value', 0) <= 0xff:
+                        self.print_error ("妥当な範囲（-128～0xff）外の値が指定されています。")
+                        self.error_flag = True
+                        return (0, 0)
+                return (size, 0)
+
+        # 繰り返しデータ定義疑似命令のサイズとパディング量を返す。
+        # 　繰り返し回数，1個のサイズ（1，2，4のいずれか），値が範囲外なら文法エラーとし，サイズは0とする。
+
+        def preparse_fill (self, directive, match):
+                repeat = operand_value (match, 'repeat')
+                size = operand_value (match, 'size', 1)
+                value = operand_value (match, 'value', 0)
+                if size not in (1, 2, 4):
+                        self.print_error ("データのサイズには 1，2，4 のいずれかを指定してください。")
+                        self.error_flag = True
+                        return (0, 0)
+                if repeat < 0 or repeat * size > space_size_limit:
+                        self.print_error ("妥当な範囲（0～{0:#x}バイト）外の繰り返し回数が指定されています。".format (space_size_limit))
+                        self.error_flag = True
+                        return (0, 0)
+                if not - (1 << (size * 8 - 1)) <= value < (1 << (size * 8)):
+                        self.print_error ("データ {0} が {1} バイトで表現できる範囲を越えています。".format (value, size))
+                        self.error_flag = True
+                        return (0, 0)
+                return (repeat * size, self.padding_size (size))
+
+        # 境界合わせ疑似命令のサイズとパディング量を返す。
+        # 　2の「オペランド」乗のバイト境界に合わせる。
+
+        def preparse_align (self, directive, match):
+                align = operand_value (match, 'align')
+                if align < 0 or align > align_limit:
+                        self.print_error ("妥当な範囲（0～{0}）外の値が指定されています。".format (align_limit))
+                        self.error_flag = True
+                        return (0, 0)
+                return (0, self.padding_size (1 << align))
+
+        # バイナリファイル取り込み疑似命令のサイズとパディング量を返す。
+        # 　ファイルはこの文を書いたファイルからの相対パスで探し，取り込む範囲を読み込んでおく。
+
+        def preparse_incbin (self, directive, match):
+                filename = self.asm_line_number[0] if isinstance (self.asm_line_number, tuple) else None
+                (display, abspath) = self.resolve (match.group ('path'), filename)
+                try:
+                        with open (abspath, "rb") as incbin_file:
+                                data = incbin_file.read ()
+                except OSError:
+                        self.print_error ("ファイル {0} をオープンできません。".format (match.group ('path')))
+                        self.error_flag = True
+                        return (0, 0)
+                skip = operand_value (match, 'skip', 0)
+                count = operand_value (match, 'count', len (data) - skip)
+                if skip < 0 or count < 0 or skip + count > len (data):
+                        self.print_error ("取り込む範囲がファイル {0} の大きさ（{1} バイト）を越えています。".format (match.group ('path'), len (data)))
+                        self.error_flag = True
+                        return (0, 0)
+                self.incbin_data[match] = data[skip:skip + count] if skip > 0 or count < len (data) else data
+                return (count, 0)
+
+# 文テーブル：
+# 　ニーモニック名またはディレクティブ名（小文字）をキー，
+# 　（オペランドのパターン，パス1でサイズを求めるメソッド，パス2でコード生成するメソッド）の組を値とする辞書。
+statement_table = {
+        }
+for (keywords, pattern, preparse, parse) in [
+        (reg_reg_arith_dict, reg_reg_arith_pat, Assembly.preparse_instruction, Assembly.parse_reg_reg_arith),
+        (reg_imm_arith_dict, reg_imm_arith_pat, Assembly.preparse_instruction, Assembly.parse_reg_imm_arith),
+        (reg_imm_shift_dict, reg_imm_shift_pat, Assembly.preparse_instruction, Assembly.parse_reg_imm_shift),
+        (load_store_dict, load_store_pat, Assembly.preparse_instruction, Assembly.parse_load_store),
+        (data_xfer_dict, data_xfer_pat, Assembly.preparse_instruction, Assembly.parse_data_xfer),
+        (cond_branch_dict, cond_branch_pat, Assembly.preparse_instruction, Assembly.parse_cond_branch),
+        ({ "jal" }, jal_pat, Assembly.preparse_instruction, Assembly.parse_jal),
+        ({ ".dd", ".dw", ".db" }, defdata_pat, Assembly.preparse_defdata, Assembly.parse_defdata),
+        ({ ".cstr" }, cstr_pat, Assembly.preparse_cstr, Assembly.parse_cstr),
+        ({ "li" }, li_pat, Assembly.preparse_li, Assembly.parse_li),
+        ({ "la" }, la_pat, Assembly.preparse_la, Assembly.parse_la),
+        ({ ".space" }, space_pat, Assembly.preparse_space, Assembly.parse_space),
+        ({ ".zero" }, zero_pat, Assembly.preparse_space, Assembly.parse_space),
+        ({ ".fill" }, fill_pat, Assembly.preparse_fill, Assembly.parse_fill),
+        ({ ".align" }, align_pat, Assembly.preparse_align, Assembly.parse_align),
+        ({ ".incbin" }, incbin_pat, Assembly.preparse_incbin, Assembly.parse_incbin),
+        ]:
+        for kw in keywords:
+                statement_table[kw] = (pattern, preparse, parse)
+
+# 文（コード生成メソッド parse，マッチ結果 match）を Assembly.relax の対象とする場合は，relax_list に登録する（分岐先ラベルまたは境界，種類）の組を返す。
+# 　範囲外なら置き換える分岐命令（jal 命令はリンクレジスタを lui 命令に使うので，zero 以外の場合に限る。）と，
+# 　分岐命令を置き換えるとパディング量が変わりうる境界合わせ疑似命令を対象とする。対象でなければ None を返す。
+
+def relax_item (parse, match):
+        if parse == Assembly.parse_cond_branch:
+                return (match.group ('dest'), parse)
+        if parse == Assembly.parse_jal and reg_dict.get (match.group ('rd').lower (), 0) != 0:
+                return (match.group ('dest'), parse)
+        if parse == Assembly.parse_align and operand_value (match, 'align') > 2:
+                return (1 << operand_value (match, 'align'), parse)
+        return None
+
+# インクルードとマクロの疑似命令
+preprocess_keywords = { ".include", ".macro", ".endm" }
+
+# インクリメンタルアセンブラ：
+# 　前回のアセンブルの行ごとの字句解析の結果，配置，ラベル辞書，バイナリを保持し，次のアセンブルでは変更された行だけを解析し直す。
+# 　変更箇所より後ろの文はアドレスをずらすだけとし，参照するラベルのアドレス（条件分岐命令では相対アドレス）が
+# 　変わった文だけをコード生成し直す。結果は Assembler でアセンブルした場合とバイト単位で一致する。
+# 　配置は分岐命令を短い形としたものを保持し，範囲外の分岐命令があれば Assembly.relax で置き換えて全体をコード生成する。（字句解析の結果は再利用する。）
+# 　エラーがあれば Assembler と同じ診断メッセージを得るために全体をアセンブルし直し，保持している状態を破棄する。
+# 　cache を指定した場合，状態を保持していなければキャッシュを参照し，全体をアセンブルした結果をキャッシュに登録する。
+
+class IncrementalAssembler (Assembler):
+
+        def __init__ (self, log = None, cache = None):
+                super ().__init__ (log, cache)
+                self.forget ()
+
+        # 保持している状態を破棄する。
+        def forget (self):
+                # 前回のソースコードの行のリスト
+                self.lines = []
+                # 行ごとの字句解析の結果（Assembly.tokenize の戻り値）
+                self.records = []
+                # 行ごとの開始ロケーション，パディング量，サイズ
+                self.starts = []
+                self.paddings = []
+                self.sizes = []
+                # ラベルを参照する行の番号（0から数える。）のリストと，それぞれの参照するラベル名のタプル，コードを左右する参照先の値のリスト
+                self.ref_lines = []
+                self.refs = []
+                self.depends = []
+                # ラベル辞書と，各ラベルを定義した行の番号（0から数える。ラベル辞書の登録順）のリスト
+                self.label_dict = {}
+                self.label_lines = []
+                # バイナリ（None なら状態を保持していない。）
+                self.code = None
+                # パディングの単位（最大4バイト。それを越える境界合わせ疑似命令を含んだことがあれば，その最大の境界）
+                self.align_unit = 4
+                # バイナリが長い形に置き換えた分岐命令を含むか（保持している配置はどちらの場合も短い形のものとする。）
+                self.relaxed = False
+
+        def assemble (self, source, filename = "source.s", stat = None, user = None):
+                assembly = self.new_assembly (source, filename, stat, user, None)
+                full = self.code == None
+                if full and self.cache != None and cacheable (assembly.asm_source):
+                        key = self.cache.key (assembly.asm_source, self.options)
+                        entry = self.cache.get (key)
+                        if entry != None:
+                                assembly.log = self.log
+                                return assembly.reuse (entry)
+                result = self.update (assembly, list (assembly.asm_text))
+                if result == None:
+                        # エラーがあれば全体をアセンブルし直して診断メッセージを得る。
+                        # インクルードとマクロの文があれば全体をアセンブルする。
+                        self.forget ()
+                        assembly = self.new_assembly (source, filename, stat, user, self.log)
+                        return assembly.run ()
+                if full:
+                        assembly.log = self.log
+                        assembly.print_log ("*** PASS 1 ***")
+                        assembly.print_log ("*** PASS 2 ***")
+                        if self.cache != None and cacheable (assembly.asm_source):
+                                self.cache.put (key, self.code, self.label_dict)
+                return result
+
+        # 文が参照するラベル名のタプルを返す。参照しなければ None を返す。
+        def references (self, parse, match):
+                if parse == Assembly.parse_cond_branch or parse == Assembly.parse_jal:
+                        return (match.group ('dest'),)
+                if parse == Assembly.parse_defdata:
+                        datalist = [data.strip () for data in match.group ('datalist').split (',')]
+                        refs = tuple (data for data in datalist if data[0].isalpha () or data[0] == '_')
+                        return refs if len (refs) > 0 else None
+                if 'ref' in match.re.groupindex and match.group ('ref') != None:
+                        return (match.group ('ref'),)
                 return None
-        # コード生成する。
-        if not error_flag:
-                insert_padding (padding_size (4))
-                opcode = 0b0_0000000000_0_00000000_00000_1101111
-                opcode |= rdindex << 7;
-                opcode |= ((jumpto & 0b00000000_00010000_00000000_00000000) << 11) & 0xffffffff
-                opcode |= ((jumpto & 0b00000000_00001111_11110000_00000000)      ) & 0xffffffff
-                opcode |= ((jumpto & 0b00000000_00000000_00001000_00000000) << 9) & 0xffffffff
-                opcode |= ((jumpto & 0b00000000_00000000_00000111_11111110) << 20) & 0xffffffff
-                bin_file.write (struct.pack ("<I", opcode))
-                binary_loc += 4
-        return True
 
-# jal 命令のサイズを返す。
-
-def preparse_jal (asm_line):
-        # マッチしなければ何もしない。
-        match = jal_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 4, padding_size (4))
-
-# データ定義疑似命令を解析する。
-def parse_defdata (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = defdata_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        if label != None:
-                label = label[:-1]
-        # ディレクティブを検証する。
-        directive = match.group ('directive')
-        if directive.lower () == ".dd":
-                decmin = - 2**31
-                decmax = + 2**31 - 1
-                hexmax = 0xffffffff
-                fmt = '<i'
-                size = 4
-        elif directive.lower () == ".dw":
-                decmin = -32768
-                decmax = +32767
-                hexmax = 0xffff
-                fmt = '<h'
-                size = 2
-        elif directive.lower () == ".db":
-                decmin = -128
-                decmax = +127
-                hexmax = 0xff
-                fmt = 'b'
-                size = 1
-        else:
-                return None
-        # コード生成する。
-        if not error_flag:
-                insert_padding (padding_size (size))
-                datalist = match.group ('datalist')
-                datalist = datalist.split (',')
-                for data in datalist:
-                        match = re.match ("^\s*((?P<dec>[+-]?[0-9]+)|(?P<hex>0x[0-9A-Fa-f]+)|(?P<ref>[A-Za-z_][0-9A-Za-z_]*))\s*$", data)
-                        if match.group ('dec') != None:
-                                dec = match.group ('dec')
-                                data = int (dec)
-                                if (data < decmin) or (data > decmax):
-                                        print_error (asm_filename, asm_line_number, "データ {0} が {1} バイトで表現できる範囲を越えています。".format (dec, size))
-                                        error_flag = True
-                                        continue
-                                bin_file.write (struct.pack (fmt, data))
-                                binary_loc += size
-                        elif match.group ('hex') != None:
-                                hex = match.group ('hex')
-                                data = int (hex, 16)
-                                if data > hexmax:
-                                        print_error (asm_filename, asm_line_number, "データ {0} が {1} バイトで表現できる範囲を越えています。".format (hex, size))
-                                        error_flag = True
-                                        continue
-                                bin_file.write (struct.pack (fmt.upper (), data))
-                                binary_loc += size
-                        elif match.group ('ref') != None:
-                                ref = match.group ('ref')
-                                if directive.lower () != ".dd":
-                                        print_error (asm_filename, asm_line_number, "ラベル {0} は {1} 疑似命令では指定できません。".format (ref, directive.lower ()))
-                                        error_flag = True
-                                        continue
-                                data = label_dict.get (ref)
-                                if data == None:
-                                        print_error (asm_filename, asm_line_number, "ラベル {0} は未定義です。".format (ref))
-                                        error_flag = True
+        # アドレス address の文のコードを左右する参照先の値を返す。
+        # 条件分岐命令は相対アドレス，jal 命令は分岐先アドレスと分岐元の領域，それ以外はラベルのアドレスで決まる。
+        def depend (self, parse, refs, address, label_dict):
+                values = tuple (label_dict.get (ref) for ref in refs)
+                if values[0] == None:
+                        return values
+                if parse == Assembly.parse_cond_branch:
+                        return values[0] - address
+                if parse == Assembly.parse_jal:
+                        return (values[0], address & 0xfff00000)
+                return values
+
+        # 前回との差分だけ解析し直してソースコードの行のリスト lines をアセンブルし，AssemblyResult を返す。
+        # 状態を保持していなければ全行を解析する。エラーがあれば None を返す。
+        def update (self, assembly, lines):
+                old_count = len (self.lines)
+                count = len (lines)
+
+                # 変更されていない先頭と末尾の行数を求める。
+                head = 0
+                tail = 0
+                if self.code != None:
+                        limit = min (old_count, count)
+                        while head < limit and lines[head] == self.lines[head]:
+                                head += 1
+                        while tail < limit - head and lines[count - 1 - tail] == self.lines[old_count - 1 - tail]:
+                                tail += 1
+                        old_code = self.code
+                else:
+                        old_code = b""
+                # 短い形での大きさは，バイナリが長い形の分岐命令を含む場合もあるので配置から求める。
+                old_total = self.starts[-1] + self.paddings[-1] + self.sizes[-1] if len (self.starts) > 0 else 0
+                old_tail = old_count - tail
+                new_tail = count - tail
+                if self.code != None and self.log != None:
+                        print ("*** INCREMENTAL (line {0}-{1}) ***".format (head + 1, new_tail), file = self.log)
+
+                # 変更された行を字句解析する。
+                start = time.perf_counter ()
+                records = []
+                for i in range (head, new_tail):
+                        assembly.asm_line_number = i + 1
+                        records.append (assembly.tokenize (lines[i]))
+                if assembly.error_flag:
+                        return None
+                # インクルードとマクロの文があれば，行ごとには扱えないので全体をアセンブルし直す。
+                # バイナリファイル取り込み疑似命令も，ファイルの変更を検出できないので同様とする。
+                for record in records:
+                        if record != None and record[1] != None and (record[4] == None or record[4] == Assembly.parse_incbin):
+                                return None
+
+                # 変更箇所より前の配置とラベルはそのまま用いる。
+                head_loc = self.starts[head] if head < old_count else old_total
+                n = bisect.bisect_left (self.label_lines, head)
+                label_dict = { label: address for (label, address) in itertools.islice (self.label_dict.items (), n) }
+                label_lines = self.label_lines[:n]
+                starts = self.starts[:head]
+                paddings = self.paddings[:head]
+                sizes = self.sizes[:head]
+
+                # 変更された行を配置する。
+                assembly.label_dict = label_dict
+                assembly.binary_loc = head_loc
+                for (i, record) in enumerate (records, head):
+                        starts.append (assembly.binary_loc)
+                        if record == None:
+                                paddings.append (0)
+                                sizes.append (0)
+                                continue
+                        assembly.asm_line_number = i + 1
+                        (padding, size) = assembly.locate (record)
+                        paddings.append (padding)
+                        sizes.append (size)
+                        if record[0] != None:
+                                label_lines.append (i)
+                if assembly.error_flag:
+                        return None
+
+                # パディングの単位を，変更された行の境界合わせ疑似命令の境界まで広げる。
+                for record in records:
+                        if record != None and record[4] == Assembly.parse_align:
+                                self.align_unit = max (self.align_unit, 1 << operand_value (record[2], 'align'))
+
+                # 変更箇所より後ろの行は，アドレスの差がパディングの単位の倍数ならアドレスをずらすだけとし，
+                # そうでなければ字句解析の結果から配置し直す。
+                old_tail_loc = self.starts[old_tail] if old_tail < old_count else old_total
+                new_tail_loc = assembly.binary_loc
+                delta = new_tail_loc - old_tail_loc
+                shifted = delta % self.align_unit == 0
+                if shifted:
+                        starts.extend ([start + delta for start in self.starts[old_tail:]])
+                        paddings.extend (self.paddings[old_tail:])
+                        sizes.extend (self.sizes[old_tail:])
+                        m = bisect.bisect_left (self.label_lines, old_tail)
+                        for ((label, address), i) in zip (itertools.islice (self.label_dict.items (), m, None), self.label_lines[m:]):
+                                if label in label_dict:
+                                        return None
+                                label_dict[label] = address + delta
+                                label_lines.append (i - old_tail + new_tail)
+                        assembly.binary_loc = old_total + delta
+                else:
+                        for (i, record) in enumerate (self.records[old_tail:], new_tail):
+                                starts.append (assembly.binary_loc)
+                                if record == None:
+                                        paddings.append (0)
+                                        sizes.append (0)
                                         continue
-                                bin_file.write (struct.pack (fmt, data))
-                                binary_loc += size
-        return True
+                                assembly.asm_line_number = i + 1
+                                (padding, size) = assembly.locate (record)
+                                paddings.append (padding)
+                                sizes.append (size)
+                                if record[0] != None:
+                                        label_lines.append (i)
+                        if assembly.error_flag:
+                                return None
+                records = self.records[:head] + records + self.records[old_tail:]
+                assembly.profile.lap ("pass1", start)
+
+                # コード生成し直す行を求める。
+                # 変更されていない行は，参照先の値が変わった場合だけコード生成し直す。変更された行はすべてコード生成する。
+                targets = []
+                ref_lines = []
+                refs = []
+                depends = []
+                k = bisect.bisect_left (self.ref_lines, head)
+                m = bisect.bisect_left (self.ref_lines, old_tail)
+                for j in range (0, k):
+                        i = self.ref_lines[j]
+                        depend = self.depend (records[i][4], self.refs[j], starts[i] + paddings[i], label_dict)
+                        if depend != self.depends[j]:
+                                targets.append (i)
+                        depends.append (depend)
+                ref_lines.extend (self.ref_lines[:k])
+                refs.extend (self.refs[:k])
+                for i in range (head, new_tail):
+                        record = records[i]
+                        if record == None or record[4] == None:
+                                continue
+                        targets.append (i)
+                        ref = self.references (record[4], record[2])
+                        if ref != None:
+                                ref_lines.append (i)
+                                refs.append (ref)
+                                depends.append (self.depend (record[4], ref, starts[i] + paddings[i], label_dict))
+                for j in range (m, len (self.ref_lines)):
+                        i = self.ref_lines[j] - old_tail + new_tail
+                        depend = self.depend (records[i][4], self.refs[j], starts[i] + paddings[i], label_dict)
+                        if depend != self.depends[j]:
+                                targets.append (i)
+                        ref_lines.append (i)
+                        depends.append (depend)
+                refs.extend (self.refs[m:])
+
+                # 前回のバイナリが長い形に置き換えた分岐命令を含むか，今回置き換えが必要な分岐命令があれば，
+                # 保持している配置は短い形のものなので，Assembly.pass1 と同じ文リストを作って置き換え，全体をコード生成する。
+                start = time.perf_counter ()
+                if self.relaxed or any (self.out_of_range (records[i], starts[i] + paddings[i], label_dict) for i in targets):
+                        if not self.generate_relaxed (assembly, records, starts, paddings, label_dict):
+                                return None
+                else:
+                        # オブジェクトイメージを確保し，変更されていない行のバイナリを複写する。
+                        assembly.allocate_image ()
+                        image = assembly.bin_image
+                        image[binary_pos:binary_pos + head_loc] = old_code[0:head_loc]
+                        if shifted:
+                                image[binary_pos + new_tail_loc:assembly.asmfile_pos] = old_code[old_tail_loc:]
+                        else:
+                                for i in range (new_tail, count):
+                                        size = sizes[i]
+                                        if size > 0:
+                                                j = i - new_tail + old_tail
+                                                old_address = self.starts[j] + self.paddings[j]
+                                                address = binary_pos + starts[i] + paddings[i]
+                                                image[address:address + size] = old_code[old_address:old_address + size]
+                        for i in targets:
+                                (label, keyword, match, preparse, parse) = records[i]
+                                assembly.asm_line_number = i + 1
+                                assembly.binary_loc = starts[i]
+                                parse (assembly, keyword, match, starts[i] + paddings[i], paddings[i])
+                                if assembly.error_flag:
+                                        return None
+                        assembly.label_dict = label_dict.copy ()
+                assembly.profile.lap ("pass2", start)
+
+                # 状態を保持する。
+                self.lines = lines
+                self.records = records
+                self.starts = starts
+                self.paddings = paddings
+                self.sizes = sizes
+                self.ref_lines = ref_lines
+                self.refs = refs
+                self.depends = depends
+                self.label_dict = label_dict
+                self.label_lines = label_lines
+                self.code = bytes (memoryview (assembly.bin_image)[binary_pos:assembly.asmfile_pos])
+                self.relaxed = len (assembly.long_forms) > 0
+
+                # ソースコードを添付する。
+                return assembly.attach_source ()
+
+        # 文 record（アドレス address）が，Assembly.relax で置き換える分岐命令で，短い形では分岐先に届かないかを返す。
+        def out_of_range (self, record, address, label_dict):
+                (label, keyword, match, preparse, parse) = record
+                item = relax_item (parse, match)
+                if item == None or parse == Assembly.parse_align or label_dict.get (item[0]) == None:
+                        return False
+                target = label_dict[item[0]]
+                if parse == Assembly.parse_cond_branch:
+                        return not -4096 <= target - address <= 4094
+                return (target & 0xfff00000) != (address & 0xfff00000)
+
+        # 短い形での配置（行ごとの字句解析の結果 records，開始ロケーション starts，パディング量 paddings，ラベル辞書 label_dict）から
+        # Assembly.pass1 と同じ文リストを作り，範囲外の分岐命令を置き換えて全体をコード生成する。エラーがあれば偽を返す。
+        # 　配置し直すのは Assembly.relax なので，置き換える分岐命令とアドレスは Assembler でアセンブルした場合と一致する。
+        def generate_relaxed (self, assembly, records, starts, paddings, label_dict):
+                assembly.statement_list = []
+                assembly.relax_list = []
+                assembly.label_index = {}
+                for (i, record) in enumerate (records):
+                        if record == None:
+                                continue
+                        (label, keyword, match, preparse, parse) = record
+                        if label != None:
+                                assembly.label_index[label] = (len (assembly.statement_list), parse == Assembly.parse_align)
+                        if parse != None:
+                                assembly.statement_list.append ((parse, keyword, match, starts[i] + paddings[i], paddings[i], i + 1))
+                                item = relax_item (parse, match)
+                                if item != None:
+                                        assembly.relax_list.append ((len (assembly.statement_list) - 1,) + item)
+                assembly.label_dict = label_dict.copy ()
+                assembly.relax ()
+                assembly.allocate_image ()
+                assembly.pass2 ()
+                return not assembly.error_flag
+
+# 分割してアセンブルする場合の1チャンクの最小行数
+chunk_min_lines = 20000
+
+# ソースコード source（bytes）を分割してアセンブルできるかを返す。
+# マクロの定義は後ろのチャンクに及び，インクルードファイルは展開しないと大きさが分からないので，それらを含むソースコードは分割しない。
+
+def chunkable (source):
+        return re.search (rb"\.(include|macro|endm)", source, re.IGNORECASE) == None
+
+# チャンクのワーカ：
+# 　ソースコードの一部 text（先頭の行番号 first_line）を字句解析して配置し，パイプ conn で親プロセスの指示に応える。
+# 　配置は開始ロケーション start からとし，（エラーがないか，ラベルと start からのアドレスの組のリスト，大きさ，境界）を返す。
+# 　境界は，開始ロケーションがその倍数ならパディング量が変わらない値（4 と，4バイトを越える境界合わせ疑似命令の境界の最大値）である。
+# 　指示は次のとおりとする。
+# 　　("layout", start)：開始ロケーション start から配置し直して，同じ形式で返す。
+# 　　("generate", start, label_dict)：開始ロケーション start，ラベル辞書 label_dict でコード生成し，バイナリを返す。
+# 　　　エラーがあるか，分岐先が範囲外の分岐命令がある（置き換えが必要な）場合は None を返す。返したら終了する。
+# 　　None：終了する。
+
+def chunk_worker (conn, text, filename, directory, first_line):
+        assembly = Assembly (text, filename, None, "", None)
+        assembly.directory = directory
+        records = []
+        for (assembly.asm_line_number, asm_line) in enumerate (assembly.asm_text, first_line):
+                statement = assembly.tokenize (asm_line)
+                if statement != None:
+                        records.append ((assembly.asm_line_number, statement))
+
+        # 開始ロケーション start から配置する。
+        def layout (start):
+                assembly.statement_list = []
+                assembly.label_dict = {}
+                assembly.relax_list = []
+                assembly.label_index = {}
+                assembly.binary_loc = start
+                for (assembly.asm_line_number, statement) in records:
+                        assembly.locate (statement)
+                unit = 4
+                for (parse, keyword, match, address, padding, line_number) in assembly.statement_list:
+                        if parse == Assembly.parse_align:
+                                unit = max (unit, 1 << operand_value (match, 'align'))
+                ok = not assembly.error_flag and len (assembly.diagnostics) == 0
+                return (ok, [(label, address - start) for (label, address) in assembly.label_dict.items ()], assembly.binary_loc - start, unit)
+
+        located = 0
+        conn.send (layout (located))
+        while True:
+                try:
+                        request = conn.recv ()
+                except EOFError:
+                        break
+                if request == None:
+                        break
+                if request[0] == "layout":
+                        located = request[1]
+                        conn.send (layout (located))
+                        continue
+                (command, start, label_dict) = request
+                size = assembly.binary_loc - located
+                # 配置をずらす。（ずれは境界の倍数なので，パディング量は変わらない。）
+                if start != located:
+                        assembly.statement_list = [(parse, keyword, match, address + start - located, padding, line_number)
+                                for (parse, keyword, match, address, padding, line_number) in assembly.statement_list]
+                # 分岐先が範囲外の分岐命令があれば，全体を配置し直す必要がある。
+                for (index, dest, parse) in assembly.relax_list:
+                        address = assembly.statement_list[index][3]
+                        target = label_dict.get (dest)
+                        if parse == Assembly.parse_cond_branch and target != None and not -4096 <= target - address <= 4094:
+                                break
+                        if parse == Assembly.parse_jal and target != None and (target & 0xfff00000) != (address & 0xfff00000):
+                                break
+                else:
+                        # チャンクの先頭をバイナリの先頭としてコード生成する。（各文のアドレスは全体の中のアドレスである。）
+                        assembly.label_dict = label_dict
+                        assembly.bin_image = bytearray (binary_pos + size)
+                        assembly.pass2 ()
+                        if not assembly.error_flag and len (assembly.diagnostics) == 0:
+                                conn.send (bytes (memoryview (assembly.bin_image)[binary_pos:]))
+                                break
+                conn.send (None)
+                break
+        conn.close ()
+
+# 並列アセンブラ：
+# 　1つの大きなソースファイルを行数で jobs 個までのチャンクに分け，チャンクごとのワーカプロセスで字句解析，配置，コード生成する。
+# 　各チャンクの大きさとラベルを先頭から順に足し合わせて開始ロケーションとラベル辞書を求め，各チャンクのバイナリを連結する。
+# 　開始ロケーションがチャンクの境界の倍数でなければ，そのチャンクを配置し直させる。
+# 　結果のバイナリとラベル辞書は Assembler と同じになる。
+# 　診断メッセージがある，チャンクをまたいでラベルが重複している，分岐命令の置き換えが必要などの場合は，
+# 　Assembler と同じ結果と診断メッセージを得るため，このプロセスで全体をアセンブルし直す。
+# 　行数が少ないか，インクルードやマクロを含むソースコードは分割しない。
+
+class ParallelAssembler (Assembler):
+
+        def __init__ (self, log = None, cache = None, jobs = None):
+                super ().__init__ (log, cache)
+                self.jobs = jobs if jobs != None else os.cpu_count ()
+
+        def assemble (self, source, filename = "source.s", stat = None, user = None):
+                assembly = self.new_assembly (source, filename, stat, user, self.log)
+                lines = assembly.asm_text.readlines ()
+                count = min (self.jobs, len (lines) // chunk_min_lines)
+                if count < 2 or not chunkable (assembly.asm_source):
+                        assembly.asm_text.seek (0)
+                        return assembly.run (self.cache, self.options)
+                key = None
+                if self.cache != None and cacheable (assembly.asm_source):
+                        key = self.cache.key (assembly.asm_source, self.options)
+                        entry = self.cache.get (key)
+                        if entry != None:
+                                return assembly.reuse (entry)
+                result = self.assemble_chunks (assembly, lines, count)
+                if result == None:
+                        assembly = self.new_assembly (source, filename, stat, user, self.log)
+                        result = assembly.run ()
+                if key != None and result.success:
+                        self.cache.put (key, result.code, result.labels)
+                return result
+
+        # assembly のソースコードの行のリスト lines を count 個のチャンクに分けてアセンブルし，AssemblyResult を返す。
+        # 全体をアセンブルし直す必要があれば None を返す。
+        def assemble_chunks (self, assembly, lines, count):
+                import multiprocessing
+                bounds = [len (lines) * i // count for i in range (count + 1)]
+                processes = []
+                conns = []
+                try:
+                        for i in range (count):
+                                (conn, child_conn) = multiprocessing.Pipe ()
+                                process = multiprocessing.Process (target = chunk_worker, daemon = True,
+                                        args = (child_conn, "".join (lines[bounds[i]:bounds[i + 1]]), assembly.asm_filename, assembly.directory, bounds[i] + 1))
+                                process.start ()
+                                child_conn.close ()
+                                processes.append (process)
+                                conns.append (conn)
+
+                        # 各チャンクの開始ロケーションとラベル辞書を求める。（パス1）
+                        start = time.perf_counter ()
+                        replies = [conn.recv () for conn in conns]
+                        starts = []
+                        label_dict = {}
+                        for (i, (ok, labels, size, unit)) in enumerate (replies):
+                                if ok and assembly.binary_loc % unit != 0:
+                                        conns[i].send (("layout", assembly.binary_loc))
+                                        (ok, labels, size, unit) = conns[i].recv ()
+                                if not ok:
+                                        return None
+                                for (label, address) in labels:
+                                        if label in label_dict:
+                                                return None
+                                        label_dict[label] = assembly.binary_loc + address
+                                starts.append (assembly.binary_loc)
+                                assembly.binary_loc += size
+                        assembly.label_dict = label_dict
+                        assembly.profile.lines = len (lines)
+                        assembly.profile.lap ("pass1", start)
+
+                        # 各チャンクをコード生成し，その間にオブジェクトイメージを確保する。（パス2）
+                        for (conn, chunk_start) in zip (conns, starts):
+                                conn.send (("generate", chunk_start, label_dict))
+                        assembly.allocate_image ()
+                        start = time.perf_counter ()
+                        for (conn, chunk_start) in zip (conns, starts):
+                                code = conn.recv ()
+                                if code == None:
+                                        return None
+                                assembly.bin_image[binary_pos + chunk_start:binary_pos + chunk_start + len (code)] = code
+                        assembly.profile.lap ("pass2", start)
+                except (EOFError, OSError):
+                        return None
+                finally:
+                        # ワーカの終了を指示する。（パイプの端は他のワーカにも継承されているので，閉じるだけでは終了が伝わらない。）
+                        for conn in conns:
+                                try:
+                                        conn.send (None)
+                                except OSError:
+                                        pass
+                                conn.close ()
+                        for process in processes:
+                                process.join (1)
+                                if process.is_alive ():
+                                        process.terminate ()
+                assembly.print_log ("*** PASS 1 ***")
+                assembly.print_log ("*** PASS 2 ***")
+                return assembly.attach_source ()
 
-# データ定義疑似命令のサイズを返す。
-
-def preparse_defdata (asm_line):
-        # マッチしなければ何もしない。
-        match = defdata_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        # ディレクティブを検証する。
-        directive = match.group ('directive')
-        if directive.lower () == ".dd":
-                unitsize = 4
-        elif directive.lower () == ".dw":
-                unitsize = 2
-        elif directive.lower () == ".db":
-                unitsize = 1
+#**********************************************************************************************************************
+# 出力関数群
+#**********************************************************************************************************************
+
+# ソースコードの ZIP エントリ情報を作成する。
+# ソースファイル名を filename，ソースファイルの os.stat の結果を st，更新時刻を mtime に指定する。
+# zipfile.ZipFile.write と同じエントリ名，時刻，属性を記録する。
+
+def source_zipinfo (filename, st, mtime):
+        import zipfile
+        arcname = os.path.normpath (os.path.splitdrive (filename)[1])
+        while arcname[0] in (os.sep, os.altsep):
+                arcname = arcname[1:]
+        date_time = time.localtime (mtime)[0:6]
+        if date_time[0] < 1980:
+                date_time = (1980, 1, 1, 0, 0, 0)
+        zinfo = zipfile.ZipInfo (arcname, date_time)
+        if st != None:
+                zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
         else:
-                return (False, None, 0, 0)
-        datalist = match.group ('datalist')
-        datalist = datalist.split (',')
-        size = len (datalist) * unitsize
-        return (True, label, size, padding_size (unitsize))
-
-# 文字列定義疑似命令を解析する。
-
-def parse_cstr (asm_line):
-        global bin_file
-        global binary_loc
-        global error_flag
-        # マッチしなければ何もしない。
-        match = cstr_pat.search (asm_line)
-        if not match:
-                return None
-        # ラベルを取得する。（検証はパス1で済んでいる。）
-        label = match.group ('label')
-        if label != None:
-                label = label[:-1]
-        # ディレクティブを検証する。
-        directive = match.group ('directive')
-        if directive.lower () != ".cstr":
-                return None
-        # コード生成する。
-        if not error_flag:
-                str = match.group ("str")
-                for char in str:
-                        bin_file.write (struct.pack ("B", ord (char)))
-                        binary_loc += 1
-                bin_file.write (struct.pack ("B", 0))
-                binary_loc += 1
-        return True
+                zinfo.external_attr = (stat.S_IFREG | 0o644) << 16
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        return zinfo
+
+# オブジェクトイメージ image をファイル filename に1回で書き込む。
+# 同じディレクトリの一時ファイルに書き込んでから名前を付け替えるので，
+# 書き込み途中のファイルが filename として読まれることはない。
+# 　シンボリックリンクはリンク先を置き換え，既存のファイルのパーミッションは引き継ぐ。
+# 　デバイスなど通常のファイルでないものは置き換えられないので，直接書き込む。
+
+def write_image (filename, image):
+        import uuid
+        # シンボリックリンクならリンク先に書き込む。
+        filename = os.path.realpath (filename)
+        # デバイスや名前付きパイプなど，通常のファイルでないものには直接書き込む。
+        try:
+                st = os.stat (filename)
+        except FileNotFoundError:
+                st = None
+        if st != None and not stat.S_ISREG (st.st_mode):
+                with open (filename, "wb") as out_file:
+                        out_file.write (image)
+                return
+        dirname = os.path.dirname (filename)
+        tmp_filename = os.path.join (dirname, ".{0}.{1}.tmp".format (os.path.basename (filename), uuid.uuid4 ().hex))
+        fd = os.open (tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr (os, "O_BINARY", 0), 0o666)
+        try:
+                with os.fdopen (fd, "wb") as tmp_file:
+                        tmp_file.write (image)
+                        tmp_file.flush ()
+                        os.fsync (tmp_file.fileno ())
+                # 既存のファイルのパーミッションを引き継ぐ。
+                if st != None:
+                        os.chmod (tmp_filename, stat.S_IMODE (st.st_mode))
+                os.replace (tmp_filename, filename)
+        except BaseException:
+                os.remove (tmp_filename)
+                raise
 
-# 文字列定義疑似命令のサイズを返す。
-
-def preparse_cstr (asm_line):
-        # マッチしなければ何もしない。
-        match = cstr_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        # コード生成する。
-        str = match.group ("str")
-        return (True, label, len (str) + 1, 0)
-
-# ラベル文を解析する。
-
-def parse_label (asm_line):
-        # マッチしなければ何もしない。
-        match = label_pat.search (asm_line)
-        return match
-
-# ラベルのみの文のサイズを返す。
-
-def preparse_label (asm_line):
-        # マッチしなければ何もしない。
-        match = label_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        label = match.group ('label')
-        return (True, label, 0, 0)
-
-# 空文を解析する。
-
-def parse_null (asm_line):
-        # マッチしなければ何もしない。
-        match = null_pat.search (asm_line)
-        return match
-
-# 空文のサイズを返す。
-
-def preparse_null (asm_line):
-        # マッチしなければ何もしない。
-        match = null_pat.search (asm_line)
-        if not match:
-                return (False, None, 0, 0)
-        # ラベルを取得する。
-        return (True, None, 0, 0)
+#**********************************************************************************************************************
+# 出力形式
+#**********************************************************************************************************************
+
+# 出力形式：
+# 　furv は FURV 形式のオブジェクトファイル，raw はバイナリだけのメモリイメージ，
+# 　ihex は Intel HEX 形式，memh は Verilog の $readmemh で読み込める32ビットワードごとの16進数のテキスト，
+# 　elf はラベルをシンボルとする RISC-V の ELF32 実行ファイルとする。
+# 　いずれもアセンブル結果のオブジェクトイメージのバイナリから作り，コード生成し直さない。
+# 出力形式名をキー，出力ファイルの拡張子を値とする辞書。
+output_formats = {
+        "furv": ".bin",
+        "raw" : ".img",
+        "ihex": ".hex",
+        "memh": ".mem",
+        "elf" : ".elf",
+        }
+
+# ELF32 実行ファイルでバイナリを置くファイル内の位置（mmap でページ単位に写像できるようにページ境界に置く。）
+elf_code_pos = 0x1000
+
+# バイナリ code を Intel HEX 形式のテキスト（bytes）にする。
+# 1レコードは16バイトとし，64KB ごとに拡張リニアアドレスレコードで上位アドレスを指定する。
+# 　64KB ごとに，各レコードの（バイト数，アドレス，種別，データ16バイト，チェックサム）の21バイトを並べた表を，
+# 　1バイトずつの列ごとにスライス代入で組み立て，表全体を1回で16進数にする。
+# 　チェックサムは，各列を16ビットごとの欄に広げた整数の和から一括で求める。（各欄の和は 20 * 255 を越えないので桁あふれしない。）
+# 　末尾の16バイトに満たないレコードは個別に組み立てる。
+
+def ihex_text (code):
+        code = bytes (code)
+        text = bytearray ()
+        # 64KB 内の各レコードのアドレスの上位バイトと下位バイト
+        his = bytes (hi for hi in range (256) for k in range (16))
+        los = bytes (range (0, 256, 16)) * 256
+        for base in range (0, len (code), 0x10000):
+                block = code[base:base + 0x10000]
+                count = len (block) // 16
+                if base > 0:
+                        upper = base >> 16
+                        text += b":02000004%04X%02X\n" % (upper, (- (6 + (upper >> 8) + (upper & 0xff))) & 0xff)
+                table = bytearray (count * 21)
+                table[0::21] = bytes ((16,)) * count
+                table[1::21] = his[0:count]
+                table[2::21] = los[0:count]
+                for k in range (16):
+                        table[4 + k::21] = block[k:count * 16:16]
+                # チェックサム（各レコードの20バイトの和の2の補数）
+                total = 0
+                for k in range (20):
+                        column = bytearray (count * 2)
+                        column[0::2] = table[k::21]
+                        total += int.from_bytes (column, 'little')
+                checksums = (int.from_bytes (b"\x00\x20" * count, 'little') - total).to_bytes (count * 2, 'little')
+                table[20::21] = checksums[0::2]
+                if count > 0:
+                        text += b":" + table.hex ("\n", 21).upper ().replace ("\n", "\n:").encode ('ascii') + b"\n"
+                # 末尾の16バイトに満たないレコード
+                if count * 16 < len (block):
+                        record = bytearray ((len (block) - count * 16, his[count], los[count], 0)) + block[count * 16:]
+                        record.append (- sum (record) & 0xff)
+                        text += b":" + record.hex ().upper ().encode ('ascii') + b"\n"
+        text += b":00000001FF\n"
+        return bytes (text)
+
+# バイナリ code を $readmemh 形式のテキスト（bytes）にする。
+# 0番地からの32ビットワード（リトルエンディアン）を1行に1つずつ書く。末尾の半端なバイトは0で補う。
+# 　ワードを上位バイトから並べ直したバイト列を，4バイトごとに改行を挟んで1回で16進数にする。
+
+def memh_text (code):
+        words = array.array ("I", bytes (code) + bytes (- len (code) % 4))
+        if sys.byteorder == "little":
+                words.byteswap ()
+        if len (words) == 0:
+                return b""
+        return words.tobytes ().hex ("\n", 4).encode ('ascii') + b"\n"
+
+# バイナリ code とラベル辞書 labels から ELF32 実行ファイルのイメージ（bytearray）を作る。
+# 　バイナリは 0 番地に読み込む1つの PT_LOAD セグメント（読み書き実行可）とし，実行開始アドレスは 0 番地とする。
+# 　セクションは .text，.symtab，.strtab，.shstrtab とし，ラベルは .text の大域シンボルとする。
+
+def elf_image (code, labels):
+        shstrtab = b"\0.text\0.symtab\0.strtab\0.shstrtab\0"
+        strtab = bytearray (b"\0")
+        symtab = bytearray (16)
+        for (label, address) in labels.items ():
+                symtab += struct.pack ("<IIIBBH", len (strtab), address, 0, 0x10, 0, 1)
+                strtab += label.encode ('utf-8') + b"\0"
+        symtab_pos = elf_code_pos + (len (code) + 3) // 4 * 4
+        strtab_pos = symtab_pos + len (symtab)
+        shstrtab_pos = strtab_pos + len (strtab)
+        section_pos = (shstrtab_pos + len (shstrtab) + 3) // 4 * 4
+        image = bytearray (section_pos + 40 * 5)
+        # ELF ヘッダ（ELFCLASS32，ELFDATA2LSB，ET_EXEC，EM_RISCV）とプログラムヘッダ
+        struct.pack_into ("<4sBBBB8xHHIIIIIHHHHHH", image, 0, b"\x7fELF", 1, 1, 1, 0,
+                2, 243, 1, 0, 52, section_pos, 0, 52, 32, 1, 40, 5, 4)
+        struct.pack_into ("<IIIIIIII", image, 52, 1, elf_code_pos, 0, 0, len (code), len (code), 7, 0x1000)
+        # 各セクションの内容
+        image[elf_code_pos:elf_code_pos + len (code)] = code
+        image[symtab_pos:strtab_pos] = symtab
+        image[strtab_pos:shstrtab_pos] = strtab
+        image[shstrtab_pos:shstrtab_pos + len (shstrtab)] = shstrtab
+        # セクションヘッダ（先頭は空のセクション）
+        for (index, header) in enumerate ([
+                (1, 1, 0x7, 0, elf_code_pos, len (code), 0, 0, 4, 0),
+                (7, 2, 0, 0, symtab_pos, len (symtab), 3, 1, 4, 16),
+                (15, 3, 0, 0, strtab_pos, len (strtab), 0, 0, 1, 0),
+                (23, 3, 0, 0, shstrtab_pos, len (shstrtab), 0, 0, 1, 0),
+                ], 1):
+                struct.pack_into ("<IIIIIIIIII", image, section_pos + 40 * index, *header)
+        return image
+
+# アセンブル結果 result を出力形式 fmt で書き出す内容を返す。（furv と raw はオブジェクトイメージをコピーしない。）
+
+def output_image (result, fmt):
+        if fmt == "furv":
+                return result.image
+        if fmt == "raw":
+                return result.code
+        if fmt == "ihex":
+                return ihex_text (result.code)
+        if fmt == "memh":
+                return memh_text (result.code)
+        return elf_image (result.code, result.labels)
+
+# オブジェクトファイル filename（FURV 形式，ELF32 実行ファイル，またはメモリイメージ）を mmap で写像し，
+# バイナリをコピーせずに memoryview で返す。形式が不正なら ValueError を送出する。
+# 　バイナリの memoryview を解放すると写像も解放される。
+# 　filename が "-" なら，標準入力から読み込む。（パイプは写像できないので読み込んだ内容を用いる。）
+
+def map_code (filename):
+        import mmap
+        if filename == "-":
+                image = sys.stdin.buffer.read ()
+        else:
+                with open (filename, "rb") as bin_file:
+                        if os.fstat (bin_file.fileno ()).st_size == 0:
+                                return memoryview (b"")
+                        image = mmap.mmap (bin_file.fileno (), 0, access = mmap.ACCESS_READ)
+        if image[0:4] == b"FURV":
+                if len (image) < binary_pos:
+                        raise ValueError ("FURV 形式ではありません。")
+                (binfile_pos, asmfile_pos) = struct.unpack_from ("<II", image, 12)
+                (start, end) = (binfile_pos, asmfile_pos)
+        elif image[0:4] == b"\x7fELF":
+                if len (image) < 84 or image[4] != 1 or image[5] != 1:
+                        raise ValueError ("ELF32 リトルエンディアン形式ではありません。")
+                (phoff,) = struct.unpack_from ("<I", image, 28)
+                (p_type, p_offset, p_vaddr, p_paddr, p_filesz) = struct.unpack_from ("<IIIII", image, phoff)
+                if p_type != 1 or p_vaddr != 0:
+                        raise ValueError ("0 番地に読み込むセグメントがありません。")
+                (start, end) = (p_offset, p_offset + p_filesz)
+        else:
+                (start, end) = (0, len (image))
+        if start > end or end > len (image):
+                raise ValueError ("オブジェクトファイルの形式が不正です。")
+        return memoryview (image)[start:end]
 
 #**********************************************************************************************************************
-# メインルーチン
+# ファイル単位のアセンブル
 #**********************************************************************************************************************
 
-# 著作権を表示する。
-print ("RISC-V Minimum Assembler Version 1.03", file = sys.stderr)
-print ("Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)", file = sys.stderr)
-print (file = sys.stderr)
-
-# ソースファイルをオープンする。
-args = sys.argv
-if len (args) < 2:
-        print ("ソースファイルが指定されていません。", file = sys.stderr)
-        sys.exit (1)
-if len (args) > 2:
-        print ("ソースファイルが複数指定されています。", file = sys.stderr)
-        sys.exit (1)
-asm_filename = args[1]
-if not re.search (r'\.(s|asm)$', asm_filename.lower ()):
-        print ("ソースファイル {0} の拡張子が不正です。".format (asm_filename), file = sys.stderr)
-        sys.exit (1)
-try:
-	asm_file = open (asm_filename, "r")
-except IOError:
-        print ("ソースファイル {0} をオープンできません。".format (asm_filename), file = sys.stderr)
-        sys.exit (1)
-
-# オブジェクトファイルをオープンする。
-bin_filename = re.sub (r'\.(s|asm)$', ".bin", asm_filename)
-try:
-	bin_file = open (bin_filename, "wb")
-except IOError:
-        print ("オブジェクトファイル {0} をオープンできません。".format (bin_filename), file = sys.stderr)
-        sys.exit (1)
-
-# ファイルヘッダを記録する。
-bin_file.write (struct.pack ("8s", "FURV0000".encode ('utf-8'))) # マジックストリング
-bin_file.write (struct.pack ("<I", 0x00000014)) # アセンブル環境情報
-bin_file.write (struct.pack ("<I", 0x00000064)) # バイナリ
-bin_file.write (struct.pack ("<I", 0x00000000)) # ソースコード
-
-# アセンブル環境情報を記録する。
-bin_file.write (struct.pack ("16s", uuid.uuid1 ().bytes)) # UUID1
-bin_file.write (struct.pack ("16s", uuid.uuid4 ().bytes)) # UUID4
-bin_file.write (struct.pack ("16s", getpass.getuser ().encode ('utf-8')[0:15])) # ユーザ名
-bin_file.write (struct.pack ("<d", time.time ())) # アセンブル時刻
-bin_file.write (struct.pack ("<d", os.stat (asm_filename).st_ctime)) # ファイル生成時刻
-bin_file.write (struct.pack ("<d", os.stat (asm_filename).st_atime)) # ファイル参照時刻
-bin_file.write (struct.pack ("<d", os.stat (asm_filename).st_mtime)) # ファイル更新時刻
-
-# ラベルのアドレスを解決する。（パス1）
-print ("*** PASS 1 ***", file = sys.stderr)
-for asm_line in asm_file:
-        # asm_line から最初の「#」以降のコメントを削除する。
-        comment_pos = asm_line.find ('#')
-        if comment_pos != -1:
-                asm_line = asm_line[:comment_pos]
+# ソースファイル asm_filename をアセンブルし，オブジェクトファイルを書き出す。
+# log にファイルを指定すると，進捗と診断メッセージとアセンブルの成否を出力する。
+# assembler に Assembler を指定すると，それを用いてアセンブルする。（キャッシュを共有する場合など）
+# （報告用の記録の辞書，AssemblyResult）の組を返す。ソースファイルを読めなかった場合の AssemblyResult は None である。
+
+# profile が真なら，報告用の記録にプロファイル（AssemblyProfile.as_dict の辞書）を加える。
+# fmt には出力形式（output_formats のキー）を指定する。出力ファイル名の拡張子は出力形式で決まる。
+# bin_filename に出力ファイル名を指定すると，ソースファイル名から決めずにそのファイルに書き出す。
+# asm_filename が "-" ならソースコードを標準入力から，bin_filename が "-" ならオブジェクトイメージを標準出力に書き出す。
+# 　標準入力から読む場合，bin_filename を省略すると標準出力に書き出す。
+# source_name を指定すると，診断メッセージと添付するソースコードのソースファイル名にする。
+# 　標準入力から読んだソースコードの既定のソースファイル名は stdin.s とし，各時刻にはアセンブル時刻を記録する。
+# user にはアセンブル環境情報に記録するユーザ名を指定する。（省略時はこのプロセスのユーザ名）
+
+def assemble_file (asm_filename, log = None, assembler = None, profile = False, fmt = "furv", bin_filename = None,
+                source_name = None, user = None):
+        start = time.perf_counter ()
+        record = {
+                "source"     : asm_filename,
+                "object"     : None,
+                "status"     : "error",
+                "diagnostics": [],
+                "code_size"  : 0,
+                "labels"     : 0,
+                "elapsed"    : 0.0,
+                "cache"      : None,
+                }
+        result = None
+        if source_name == None:
+                source_name = "stdin.s" if asm_filename == "-" else asm_filename
+        if bin_filename == None:
+                bin_filename = "-" if asm_filename == "-" else re.sub (r'\.(s|asm)$', output_formats[fmt], asm_filename, flags = re.IGNORECASE)
+
+        # ソースファイルを読み込む。
+        # 　アセンブル環境情報として記録する時刻は読み込む前に取得する。
+        try:
+                if asm_filename == "-":
+                        asm_stat = None
+                        asm_source = sys.stdin.buffer.read ()
+                else:
+                        with open (asm_filename, "rb") as asm_file:
+                                asm_stat = os.stat (asm_file.fileno ())
+                                asm_source = asm_file.read ()
+                opened = time.perf_counter ()
+        except IOError:
+                message = "ソースファイル {0} をオープンできません。".format (asm_filename)
         else:
-                asm_line = asm_line.rstrip (os.linesep)
-        # 空行ならば次の文に進む。
-        if len (asm_line) == 0:
-                asm_line_number += 1
-                continue
-        # asm_line を構文解析する。
-        for preparse in [preparse_reg_reg_arith, preparse_reg_imm_arith, preparse_reg_imm_shift, preparse_load_store, preparse_data_xfer, preparse_cond_branch, preparse_jal, preparse_defdata, preparse_cstr, preparse_label, preparse_null]:
-                (ok, label, size, padding) = preparse (asm_line)
-                if not ok:
-                        continue
-                binary_loc += padding
-                if label != None:
-                        label = label[:-1]
-                        # ラベルに予約語が指定されているならエラーを出す。
-                        if label.lower () in reserved_words:
-                                print_error (asm_filename, asm_line_number, "ラベルに予約語 {0} が指定されています。".format (label))
-                                error_flag = True
-                                break
-                        # ラベルが定義済みならエラーを出す。
-                        if label_dict.get (label) != None:
-                                print_error (asm_filename, asm_line_number, "ラベル {0} が重複定義されています。".format (label))
-                                error_flag = True
-                                break
-                        # 当該ラベルに相当するアドレスを登録する。
-                        label_dict[label] = binary_loc
-                # カウンタを進める。
-                binary_loc += size
-                break
+                # アセンブルする。
+                if assembler == None:
+                        assembler = Assembler ()
+                assembler.log = log
+                result = assembler.assemble (asm_source, filename = source_name, stat = asm_stat, user = user)
+                result.profile.times["open"] = opened - start
+                if assembler.cache != None:
+                        record["cache"] = "hit" if result.cached else "miss"
+                record["diagnostics"] = [str (diagnostic) for diagnostic in result.diagnostics]
+                record["labels"] = len (result.labels)
+                if not result.success:
+                        # エラー終了した場合は，古いオブジェクトファイルを削除する。
+                        if bin_filename != "-" and os.path.exists (bin_filename):
+                                os.remove (bin_filename)
+                        message = "{0}, アセンブルに失敗しました。".format (source_name)
+                else:
+                        # オブジェクトイメージをオブジェクトファイルに書き込む。
+                        try:
+                                flush_start = time.perf_counter ()
+                                if bin_filename == "-":
+                                        sys.stdout.buffer.write (output_image (result, fmt))
+                                        sys.stdout.buffer.flush ()
+                                else:
+                                        write_image (bin_filename, output_image (result, fmt))
+                                result.profile.lap ("flush", flush_start)
+                        except OSError:
+                                message = "オブジェクトファイル {0} をオープンできません。".format (bin_filename)
+                        else:
+                                if bin_filename == "-":
+                                        message = "{0}, オブジェクトイメージを標準出力に書き出しました。".format (source_name)
+                                else:
+                                        message = "{0}, オブジェクトファイル {1} を生成しました。".format (source_name, bin_filename)
+                                record["object"] = bin_filename
+                                record["status"] = "ok"
+                                record["code_size"] = len (result.code)
+        if record["status"] != "ok" and message not in record["diagnostics"]:
+                record["diagnostics"].append (message)
+        if log != None:
+                print (message, file = log)
+        record["elapsed"] = time.perf_counter () - start
+        if profile and result != None:
+                record["profile"] = result.profile.as_dict ()
+        return (record, result)
+
+# キャッシュディレクトリ cache_dir（None ならキャッシュしない）と上限 cache_size バイトからアセンブラを作る。
+# jobs に2以上を指定すると，1つのソースファイルを jobs 個までのプロセスで分割してアセンブルする ParallelAssembler を作る。
+# attach と timestamp は Assembler の同名の属性（ソースコードを添付するか，記録する時刻）とする。
+
+def make_assembler (cache_dir, cache_size, jobs = 1, attach = True, timestamp = None):
+        cache = AssemblyCache (cache_dir, cache_size) if cache_dir != None else None
+        if jobs > 1:
+                assembler = ParallelAssembler (cache = cache, jobs = jobs)
         else:
-                print_error (asm_filename, asm_line_number, "文法エラー: {0}".format (asm_line))
-                error_flag = True
-        # 次の文に進む。
-        asm_line_number += 1
-
-# パス1でエラーが出ている場合は終了する。
-if error_flag:
-        print ("{0}, アセンブルに失敗しました。".format (asm_filename), file = sys.stderr)
-        sys.exit (1)
-
-# ソースコードを1行ずつ asm_line に読んで構文解析，コード生成する。（パス2）
-print ("*** PASS 2 ***", file = sys.stderr)
-asm_file.seek (0, 0)
-asm_line_number = 1
-binary_loc = 0
-for asm_line in asm_file:
-        # asm_line から最初の「#」以降のコメントを削除する。
-        comment_pos = asm_line.find ('#')
-        if comment_pos != -1:
-                asm_line = asm_line[:comment_pos]
+                assembler = Assembler (cache = cache)
+        assembler.attach = attach
+        assembler.timestamp = timestamp
+        return assembler
+
+# バッチアセンブルのワーカプロセスで用いるアセンブラと，記録にプロファイルを加えるか，出力形式
+batch_assembler = None
+batch_profile = False
+batch_format = "furv"
+
+# バッチアセンブルのワーカプロセスを初期化する。
+
+def batch_init (cache_dir, cache_size, profile = False, fmt = "furv", attach = True, timestamp = None):
+        global batch_assembler, batch_profile, batch_format
+        batch_assembler = make_assembler (cache_dir, cache_size, attach = attach, timestamp = timestamp)
+        batch_profile = profile
+        batch_format = fmt
+
+# バッチアセンブルのワーカプロセスで1ファイルをアセンブルし，報告用の記録を返す。
+
+def batch_worker (asm_filename):
+        return assemble_file (asm_filename, assembler = batch_assembler, profile = batch_profile, fmt = batch_format)[0]
+
+# DIR_OR_GLOB に指定したディレクトリ以下，またはパターンに一致するソースファイルのリストを返す。
+
+def batch_sources (dir_or_glob):
+        import glob
+        if os.path.isdir (dir_or_glob):
+                filenames = []
+                for (dirpath, dirnames, files) in os.walk (dir_or_glob):
+                        dirnames.sort ()
+                        for filename in sorted (files):
+                                filenames.append (os.path.join (dirpath, filename))
         else:
-                asm_line = asm_line.rstrip (os.linesep)
-        # 空行ならば次の文に進む。
-        if len (asm_line) == 0:
-                asm_line_number += 1
-                continue
-        # asm_line を構文解析する。
-        for parse in [parse_reg_reg_arith, parse_reg_imm_arith, parse_reg_imm_shift, parse_load_store, parse_data_xfer, parse_cond_branch, parse_jal, parse_cstr, parse_defdata, parse_label, parse_null]:
-                if parse (asm_line) != None:
-                        break
+                filenames = sorted (glob.glob (dir_or_glob, recursive = True))
+        return [filename for filename in filenames if re.search (r'\.(s|asm)$', filename.lower ()) and os.path.isfile (filename)]
+
+# ソースファイルのリスト filenames を jobs 個のプロセスで並列にアセンブルし，報告用の記録のリストを返す。
+# キャッシュはディレクトリ cache_dir（None ならキャッシュしない）を全プロセスで共有する。
+# profile が真なら，各記録にプロファイルを加える。fmt は出力形式，attach と timestamp は make_assembler と同じである。
+
+def batch_assemble (filenames, jobs, cache_dir = None, cache_size = 0, profile = False, fmt = "furv", attach = True, timestamp = None):
+        if jobs <= 1 or len (filenames) <= 1:
+                batch_init (cache_dir, cache_size, profile, fmt, attach, timestamp)
+                return [batch_worker (filename) for filename in filenames]
+        import concurrent.futures
+        chunksize = max (1, len (filenames) // (jobs * 8))
+        with concurrent.futures.ProcessPoolExecutor (max_workers = jobs, initializer = batch_init,
+                        initargs = (cache_dir, cache_size, profile, fmt, attach, timestamp)) as executor:
+                return list (executor.map (batch_worker, filenames, chunksize = chunksize))
+
+# バッチアセンブルの報告を report_filename に書き出す。（None なら標準出力に書き出す。）
+# 拡張子が .csv なら CSV 形式，それ以外は JSON 形式とする。
+
+def write_report (report_filename, records, elapsed):
+        import csv
+        import json
+        if report_filename != None and report_filename.lower ().endswith (".csv"):
+                with open (report_filename, "w", newline = "", encoding = "utf-8") as report_file:
+                        writer = csv.writer (report_file)
+                        writer.writerow (["source", "object", "status", "code_size", "labels", "elapsed", "cache", "diagnostics"])
+                        for record in records:
+                                writer.writerow ([record["source"], record["object"] or "", record["status"], record["code_size"],
+                                        record["labels"], "%.6f" % record["elapsed"], record["cache"] or "", "\n".join (record["diagnostics"])])
+                return
+        report = {
+                "version": version,
+                "summary": {
+                        "files"  : len (records),
+                        "ok"     : sum (1 for record in records if record["status"] == "ok"),
+                        "error"  : sum (1 for record in records if record["status"] != "ok"),
+                        "cache_hits"  : sum (1 for record in records if record["cache"] == "hit"),
+                        "cache_misses": sum (1 for record in records if record["cache"] == "miss"),
+                        "elapsed": elapsed,
+                        },
+                "files"  : records,
+                }
+        if report_filename == None:
+                json.dump (report, sys.stdout, ensure_ascii = False, indent = 1)
+                print ()
         else:
-                print_error (asm_filename, asm_line_number, "文法エラー: {0}".format (asm_line))
-                error_flag = True
-        # 次の文に進む。
-        asm_line_number += 1
-
-# ソースファイルをクローズする。
-asm_file.close ()
-
-# ソースコードを添付する。
-pos = bin_file.tell ()
-bin_file.seek (16, 0)
-bin_file.write (struct.pack ("<I", pos))
-bin_file.seek (pos, 0)
-
-zip_filename = '$$$ZIPTMP$$$.zip'
-with zipfile.ZipFile (zip_filename, 'w', compression = zipfile.ZIP_DEFLATED) as zipf:
-        zipf.write (asm_filename, arcname = asm_filename)
-with open (zip_filename, "rb") as zipf:
-        while True:
-                by = zipf.read (1)
-                if not by:
-                        break
-                bin_file.write (by)
-os.remove (zip_filename)
+                with open (report_filename, "w", encoding = "utf-8") as report_file:
+                        json.dump (report, report_file, ensure_ascii = False, indent = 1)
 
-# オブジェクトファイルをクローズする。
-bin_file.close ()
+# プロファイルの辞書 profile を total に加算し，total を返す。
 
-# エラー終了した場合は，途中まで生成していたオブジェクトファイルを削除する。
-if error_flag:
-        os.remove (bin_filename)
-        print ("{0}, アセンブルに失敗しました。".format (asm_filename), file = sys.stderr)
-        sys.exit (1)
+def add_profile (total, profile):
+        for (key, value) in profile.items ():
+                if isinstance (value, (int, float)):
+                        total[key] = total.get (key, 0) + value
+                else:
+                        add_profile (total.setdefault (key, {}), value)
+        return total
+
+# プロファイル report を JSON 形式で profile_filename に書き出す。（"-" なら標準出力に書き出す。）
 
-# オブジェクトファイルの生成を報告する。
-print ("{0}, オブジェクトファイル {1} を生成しました。".format (asm_filename, bin_filename), file = sys.stderr)
+def write_profile (profile_filename, report):
+        import json
+        report = { "version": version, **report }
+        if profile_filename == "-":
+                json.dump (report, sys.stdout, ensure_ascii = False, indent = 1)
+                print ()
+        else:
+                with open (profile_filename, "w", encoding = "utf-8") as profile_file:
+                        json.dump (report, profile_file, ensure_ascii = False, indent = 1)
 
-# ラベルのアドレスを出力する。
-print ("*** Labels ***", file = sys.stderr)
-for label in label_dict:
-        print ("%-12s = 0x%08x" % (label, label_dict[label]), file = sys.stderr)
+#**********************************************************************************************************************
+# 常駐モード
+#**********************************************************************************************************************
+
+# 常駐モードでは，Unix ドメインソケットで受け付けた要求ごとにアセンブルし，結果を返す。
+# 要求と応答はどちらも，ヘッダの JSON の長さと本体の長さ（"<II"），ヘッダの JSON（UTF-8），本体を順に並べたメッセージとする。
+# 　要求：ヘッダは {"filename": ソースファイル名, "stat": [st_mode, st_ctime, st_atime, st_mtime] または null, "user": ユーザ名,
+# 　　　　"directory": インクルードファイルを探す基準のディレクトリ（省略可）, "format": 出力形式（省略時は "furv"）,
+# 　　　　"attach": ソースコードを添付するか（省略時は true）, "timestamp": 記録する時刻（省略可）}，本体はソースコード。
+# 　応答：ヘッダは {"success": 成否, "labels": ラベル辞書, "diagnostics": 診断メッセージのリスト, "log": 進捗の出力,
+# 　　　　"cache": キャッシュの使用（"hit"，"miss" またはキャッシュしない場合 null）, "cache_hits": ヒット数の累計, "cache_misses": ミス数の累計,
+# 　　　　"profile": プロファイル（AssemblyProfile.as_dict の辞書）, "version": アセンブラのバージョン}，
+# 　　　　本体は出力形式で書き出す内容。
+# 　　　　アセンブラ自体のエラーで応答を作れなかった場合は，ヘッダを {"success": false, ..., "error": エラーメッセージ} とし，本体を空とする。
+# 　キャッシュとインクルードファイルの解析キャッシュは常駐している間，全接続で共有する。
+# 　（基準のディレクトリ，ソースファイル名）の組ごとに IncrementalAssembler を保持し，同じ組の要求では前回との差分だけアセンブルし直す。
+
+# メッセージを組み立てる。
+
+def pack_message (header, body):
+        import json
+        header = json.dumps (header, ensure_ascii = False).encode ('utf-8')
+        return struct.pack ("<II", len (header), len (body)) + header + body
+
+# 常駐モードで用いるキャッシュ
+serve_cache = None
+
+# 常駐モードで（基準のディレクトリ，ソースファイル名）の組ごとに保持するインクリメンタルアセンブラの辞書と，その上限数
+serve_sessions = {}
+serve_session_limit = 64
+
+# 要求 header，body に応じてアセンブルし，応答のメッセージを返す。
+
+def serve_request (header, body):
+        log = io.StringIO ()
+        filename = header.get ("filename", "source.s")
+        # 最近使ったものを辞書の末尾に置き，上限を越えたら先頭（最も古いもの）から破棄する。
+        session = (header.get ("directory"), filename)
+        assembler = serve_sessions.pop (session, None)
+        if assembler == None:
+                assembler = IncrementalAssembler (cache = serve_cache)
+        serve_sessions[session] = assembler
+        while len (serve_sessions) > serve_session_limit:
+                del serve_sessions[next (iter (serve_sessions))]
+        assembler.log = log
+        assembler.directory = header.get ("directory")
+        assembler.attach = header.get ("attach", True)
+        assembler.timestamp = header.get ("timestamp")
+        st = None
+        if header.get ("stat") != None:
+                (st_mode, st_ctime, st_atime, st_mtime) = header["stat"]
+                st = types.SimpleNamespace (st_mode = st_mode, st_ctime = st_ctime, st_atime = st_atime, st_mtime = st_mtime)
+        result = assembler.assemble (body, filename = filename, stat = st, user = header.get ("user"))
+        cache = assembler.cache
+        response = {
+                "success"     : result.success,
+                "labels"      : result.labels,
+                "diagnostics" : [str (diagnostic) for diagnostic in result.diagnostics],
+                "log"         : log.getvalue (),
+                "cache"       : None if cache == None else ("hit" if result.cached else "miss"),
+                "cache_hits"  : None if cache == None else cache.hits,
+                "cache_misses": None if cache == None else cache.misses,
+                "profile"     : result.profile.as_dict (),
+                "version"     : version,
+                }
+        return pack_message (response, bytes (output_image (result, header.get ("format", "furv"))) if result.success else b"")
+
+# 1つの接続で送られてくる要求に順に応答する。
+
+async def serve_client (reader, writer):
+        import asyncio
+        import json
+        try:
+                while True:
+                        try:
+                                (header_size, body_size) = struct.unpack ("<II", await reader.readexactly (8))
+                        except asyncio.IncompleteReadError:
+                                break
+                        header = json.loads ((await reader.readexactly (header_size)).decode ('utf-8'))
+                        body = await reader.readexactly (body_size)
+                        # アセンブル中のエラーで接続を切らず，エラーを応答する。
+                        try:
+                                reply = serve_request (header, body)
+                        except Exception as error:
+                                reply = pack_message ({ "success": False, "labels": {}, "diagnostics": [], "log": "",
+                                        "error": "常駐しているアセンブラでエラーが発生しました。（{0}: {1}）".format (type (error).__name__, error) }, b"")
+                        writer.write (reply)
+                        await writer.drain ()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                pass
+        finally:
+                writer.close ()
+
+# Unix ドメインソケット socket_path で要求を待ち受ける。SIGINT または SIGTERM を受けると終了する。
+# cache に AssemblyCache を指定すると，全要求でそれを用いる。
+# 　socket_path で別の常駐しているアセンブラが待ち受けていれば，起動せずに偽を返す。
+# 　接続を拒否される（待ち受けているプロセスがない）ソケットファイルだけを削除し，終了時は自身が作ったソケットファイルだけを削除する。
+
+def serve (socket_path, cache = None):
+        import asyncio
+        import errno
+        import signal
+        import socket
+        global serve_cache
+        serve_cache = cache
+        try:
+                with socket.socket (socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                        probe.connect (socket_path)
+        except OSError as error:
+                if error.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                        print ("ソケット {0} を使用できません。（{1}）".format (socket_path, error.strerror), file = sys.stderr)
+                        return False
+        else:
+                print ("ソケット {0} では既に常駐しているアセンブラが待ち受けています。".format (socket_path), file = sys.stderr)
+                return False
+        if os.path.exists (socket_path):
+                if not stat.S_ISSOCK (os.stat (socket_path).st_mode):
+                        print ("{0} はソケットではありません。".format (socket_path), file = sys.stderr)
+                        return False
+                os.remove (socket_path)
+        # 作ったソケットファイルの（デバイス，i ノード番号）の組
+        bound = None
+
+        async def run ():
+                nonlocal bound
+                stop = asyncio.Event ()
+                loop = asyncio.get_running_loop ()
+                for signum in (signal.SIGINT, signal.SIGTERM):
+                        loop.add_signal_handler (signum, stop.set)
+                server = await asyncio.start_unix_server (serve_client, path = socket_path)
+                st = os.stat (socket_path)
+                bound = (st.st_dev, st.st_ino)
+                print ("{0} で要求を待ち受けています。".format (socket_path), file = sys.stderr)
+                async with server:
+                        await stop.wait ()
+
+        try:
+                asyncio.run (run ())
+        finally:
+                try:
+                        st = os.stat (socket_path)
+                        if bound == (st.st_dev, st.st_ino):
+                                os.remove (socket_path)
+                except OSError:
+                        pass
+        return True
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
 
-# 成功終了する。
-sys.exit (0)
+def main ():
+        # 著作権を表示する。
+        print ("RISC-V Minimum Assembler Version {0}".format (version), file = sys.stderr)
+        print ("Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)", file = sys.stderr)
+        print (file = sys.stderr)
+
+        # 引数を解析する。
+        import argparse
+        parser = argparse.ArgumentParser (prog = "minas", description = "RISC-V Minimum Assembler")
+        parser.add_argument ("source", nargs = "*", help = "ソースファイル（.s または .asm。- なら標準入力）")
+        parser.add_argument ("-o", "--output", metavar = "FILE", help = "出力ファイル（- なら標準出力。省略時はソースファイル名の拡張子を出力形式のものに替えた名前，標準入力から読む場合は標準出力）")
+        parser.add_argument ("--batch", metavar = "DIR_OR_GLOB", help = "ディレクトリ以下またはパターンに一致するソースファイルをすべてアセンブルする。")
+        parser.add_argument ("--jobs", type = int, default = os.cpu_count (), help = "バッチアセンブルと --parallel のプロセス数（既定は CPU 数）")
+        parser.add_argument ("--parallel", action = "store_true", help = "1つの大きなソースファイルを分割し，--jobs 個までのプロセスで並列にアセンブルする。")
+        parser.add_argument ("--serve", metavar = "SOCKET", help = "Unix ドメインソケットで要求を待ち受ける常駐モードで起動する。")
+        parser.add_argument ("--report", metavar = "FILE", help = "バッチアセンブルの報告の出力先（拡張子 .csv なら CSV，それ以外は JSON。省略時は標準出力に JSON）")
+        parser.add_argument ("--cache", metavar = "DIR", default = os.environ.get ("MINAS_CACHE"), help = "アセンブル結果のキャッシュディレクトリ（既定は環境変数 MINAS_CACHE。省略時はキャッシュしない）")
+        parser.add_argument ("--cache-size", metavar = "MB", type = int, default = 256, help = "キャッシュの上限（MB，既定は 256）")
+        parser.add_argument ("--profile", metavar = "FILE", nargs = "?", const = "-", help = "各段階の所要時間と文の種類ごとの数などを JSON で出力する。（FILE を省略すると標準出力）")
+        parser.add_argument ("--format", choices = list (output_formats), default = "furv",
+                help = "出力形式（furv：FURV 形式 .bin，raw：メモリイメージ .img，ihex：Intel HEX .hex，memh：$readmemh 形式 .mem，elf：ELF32 .elf。既定は furv）")
+        parser.add_argument ("--no-source", action = "store_true", help = "オブジェクトファイルにソースコードを添付しない。")
+        parser.add_argument ("--source-name", metavar = "NAME", help = "診断メッセージと添付するソースコードに用いるソースファイル名（標準入力の場合の既定は stdin.s）")
+        parser.add_argument ("--timestamp", metavar = "SECONDS", type = float,
+                help = "アセンブル時刻とファイルの各時刻としてすべてこの時刻（エポックからの秒数）を記録する。（省略時は実際の時刻）")
+        parser.add_argument ("--source-date-epoch", action = "store_true", help = "--timestamp の代わりに環境変数 SOURCE_DATE_EPOCH の時刻を記録する。")
+        parser.add_argument ("--user", metavar = "NAME", help = "アセンブル環境情報に記録するユーザ名（省略時はこのプロセスのユーザ名）")
+        args = parser.parse_args ()
+        cache_size = args.cache_size * 1024 * 1024
+
+        # 記録する時刻を環境変数 SOURCE_DATE_EPOCH から得る。（明示的に指定した場合だけとする。）
+        if args.source_date_epoch:
+                if args.timestamp != None:
+                        print ("--timestamp と --source-date-epoch は同時に指定できません。", file = sys.stderr)
+                        return 1
+                try:
+                        args.timestamp = float (os.environ["SOURCE_DATE_EPOCH"])
+                except (KeyError, ValueError):
+                        print ("環境変数 SOURCE_DATE_EPOCH が設定されていないか，不正です。", file = sys.stderr)
+                        return 1
+
+        # 常駐モードで起動する。
+        if args.serve != None:
+                return 0 if serve (args.serve, AssemblyCache (args.cache, cache_size) if args.cache != None else None) else 1
+
+        # バッチアセンブルする。
+        if args.batch != None:
+                if len (args.source) > 0:
+                        print ("--batch とソースファイルは同時に指定できません。", file = sys.stderr)
+                        return 1
+                if args.output != None or args.source_name != None:
+                        print ("--batch と --output，--source-name は同時に指定できません。", file = sys.stderr)
+                        return 1
+                start = time.perf_counter ()
+                records = batch_assemble (batch_sources (args.batch), args.jobs, args.cache, cache_size, args.profile != None, args.format,
+                        not args.no_source, args.timestamp)
+                elapsed = time.perf_counter () - start
+                write_report (args.report, records, elapsed)
+                if args.profile != None:
+                        total = {}
+                        for record in records:
+                                if "profile" in record:
+                                        add_profile (total, record["profile"])
+                        write_profile (args.profile, { "files": len (records), "elapsed": elapsed, "profile": total })
+                ok = sum (1 for record in records if record["status"] == "ok")
+                print ("{0} 個中 {1} 個のソースファイルをアセンブルしました。".format (len (records), ok), file = sys.stderr)
+                if args.cache != None:
+                        hits = sum (1 for record in records if record["cache"] == "hit")
+                        misses = sum (1 for record in records if record["cache"] == "miss")
+                        print ("キャッシュ：ヒット {0} 回，ミス {1} 回".format (hits, misses), file = sys.stderr)
+                return 0 if ok == len (records) else 1
+
+        # ソースファイル名を取得する。
+        if len (args.source) < 1:
+                print ("ソースファイルが指定されていません。", file = sys.stderr)
+                return 1
+        if len (args.source) > 1:
+                print ("ソースファイルが複数指定されています。", file = sys.stderr)
+                return 1
+        asm_filename = args.source[0]
+        if asm_filename != "-" and not re.search (r'\.(s|asm)$', asm_filename.lower ()):
+                print ("ソースファイル {0} の拡張子が不正です。".format (asm_filename), file = sys.stderr)
+                return 1
+        if (args.output == "-" or args.output == None and asm_filename == "-") and args.profile == "-":
+                print ("--output と --profile の出力先をともに標準出力にはできません。", file = sys.stderr)
+                return 1
+
+        # アセンブルし，オブジェクトファイルを書き出す。
+        # 　進捗と診断メッセージ，ラベルは標準エラー出力に出力するので，標準出力はオブジェクトイメージだけになる。
+        assembler = make_assembler (args.cache, cache_size, args.jobs if args.parallel else 1, not args.no_source, args.timestamp)
+        (record, result) = assemble_file (asm_filename, log = sys.stderr, assembler = assembler, profile = args.profile != None,
+                fmt = args.format, bin_filename = args.output, source_name = args.source_name, user = args.user)
+        if "profile" in record:
+                write_profile (args.profile, { "source": asm_filename, "status": record["status"], "elapsed": record["elapsed"],
+                        "cached": result.cached, "profile": record["profile"] })
+        if record["status"] != "ok":
+                return 1
+
+        # ラベルのアドレスを出力する。
+        print ("*** Labels ***", file = sys.stderr)
+        for label in result.labels:
+                print ("%-12s = 0x%08x" % (label, result.labels[label]), file = sys.stderr)
+
+        # 成功終了する。
+        return 0
+
+if __name__ == "__main__":
+        sys.exit (main ())
@@ -0,0 +1,718 @@
+#-*- python -*-
+#**********************************************************************************************************************
+#
+# RISC-V Minimum Assembler Benchmark
+#
+# Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)
+#
+#**********************************************************************************************************************
+
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+import minas
+import minsim
+
+# ベンチマーク対象のアセンブラ（既定はこのファイルと同じディレクトリの minas.py）
+default_minas = os.path.join (os.path.dirname (os.path.abspath (__file__)), "minas.py")
+
+# 生成するソースで使用するレジスタ名
+bench_regs = ["zero", "ra", "sp", "gp", "t0", "t1", "t2", "s0", "s1", "a0", "a1", "a2", "a3", "a4", "a5", "x20", "x31"]
+
+#**********************************************************************************************************************
+# ソース生成関数群
+#**********************************************************************************************************************
+
+# 命令クラスごとに1行分のソースを生成する関数を定義する。
+# 乱数生成器を rnd，行番号を i に指定する。
+
+def gen_reg_reg_arith (rnd, i):
+        return "        {0} {1}, {2}, {3}".format (rnd.choice (["add", "sub", "and", "or", "xor", "slt", "sltu", "sll", "srl", "sra", "mul", "div", "remu"]),
+                rnd.choice (bench_regs), rnd.choice (bench_regs), rnd.choice (bench_regs))
+
+def gen_reg_imm_arith (rnd, i):
+        return "        {0} {1}, {2}, {3}".format (rnd.choice (["addi", "slti", "jalr"]), rnd.choice (bench_regs), rnd.choice (bench_regs), rnd.randint (-2048, 2047))
+
+def gen_reg_imm_shift (rnd, i):
+        return "        {0} {1}, {2}, {3}".format (rnd.choice (["slli", "srli", "srai"]), rnd.choice (bench_regs), rnd.choice (bench_regs), rnd.randint (0, 31))
+
+def gen_load_store (rnd, i):
+        return "        {0} {1}, {2}({3})".format (rnd.choice (["lw", "lh", "lhu", "lb", "lbu", "sw", "sh", "sb"]), rnd.choice (bench_regs), rnd.randint (-2048, 2047), rnd.choice (bench_regs))
+
+def gen_data_xfer (rnd, i):
+        return "        {0} {1}, 0x{2:05x}".format (rnd.choice (["lui", "auipc"]), rnd.choice (bench_regs), rnd.randint (0, 0xfffff))
+
+def gen_cond_branch (rnd, i):
+        return "L{0}:    {1} {2}, {3}, L{4}".format (i, rnd.choice (["beq", "bne", "blt", "bge", "bltu", "bgeu"]), rnd.choice (bench_regs), rnd.choice (bench_regs), max (0, i - rnd.randint (0, 100)))
+
+def gen_jal (rnd, i):
+        return "L{0}:    jal {1}, L{2}".format (i, rnd.choice (bench_regs), rnd.randint (0, i))
+
+def gen_defdata (rnd, i):
+        return "        .dd {0}".format (", ".join (str (rnd.randint (-2**31, 2**31 - 1)) for n in range (8)))
+
+def gen_cstr (rnd, i):
+        return "        .cstr \"{0}\"".format ("".join (rnd.choice ("abcdefghijklmnopqrstuvwxyz ") for n in range (32)))
+
+# 命令クラス辞書：
+# 　命令クラス名をキー，1行分のソースを生成する関数を値とする辞書。
+class_dict = {
+        "reg_reg_arith": gen_reg_reg_arith,
+        "reg_imm_arith": gen_reg_imm_arith,
+        "reg_imm_shift": gen_reg_imm_shift,
+        "load_store"   : gen_load_store,
+        "data_xfer"    : gen_data_xfer,
+        "cond_branch"  : gen_cond_branch,
+        "jal"          : gen_jal,
+        "defdata"      : gen_defdata,
+        "cstr"         : gen_cstr,
+        }
+
+# 指定した命令クラスだけからなる lines 行のソースを生成する。
+
+def generate_source (gen, lines, seed = 1):
+        rnd = random.Random (seed)
+        return "".join (gen (rnd, i) + "\n" for i in range (lines))
+
+#**********************************************************************************************************************
+# 計測関数群
+#**********************************************************************************************************************
+
+# アセンブラ minas でソース source をアセンブルし，repeat 回中の最短の経過時間（秒）を返す。
+
+def time_assembly (minas, source, workdir, repeat):
+        asm_filename = os.path.join (workdir, "bench.s")
+        with open (asm_filename, "w") as asm_file:
+                asm_file.write (source)
+        best = None
+        for n in range (repeat):
+                start = time.perf_counter ()
+                result = subprocess.run ([sys.executable, minas, "bench.s"], cwd = workdir, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+                elapsed = time.perf_counter () - start
+                if result.returncode != 0:
+                        raise RuntimeError ("{0} がアセンブルに失敗しました。\n{1}".format (minas, result.stderr.decode ('utf-8', 'replace')))
+                if best == None or elapsed < best:
+                        best = elapsed
+        return best
+
+# 命令クラスごとに1行あたりのアセンブル時間（マイクロ秒）を求める辞書を返す。
+# 起動時間は1行だけのソースのアセンブル時間として差し引く。
+
+def per_line_times (minas, lines, repeat):
+        times = {}
+        with tempfile.TemporaryDirectory () as workdir:
+                startup = time_assembly (minas, "        add a0, a0, a1\n", workdir, repeat)
+                for name in class_dict:
+                        elapsed = time_assembly (minas, generate_source (class_dict[name], lines), workdir, repeat)
+                        times[name] = max (elapsed - startup, 0.0) / lines * 1e6
+        return times
+
+# minas（minas.py，または minaspack.py で作った zipapp）の起動時間を計測し，
+# repeat 回中の最短の（python -X importtime による import の累計時間（ミリ秒），1行だけのソースのアセンブル時間（ミリ秒））の組を返す。
+# 　実際の起動と同じくバイトコードのキャッシュを用いるよう，最初の1回は計測しない。
+# 　カレントディレクトリのモジュールを import しないよう，一時ディレクトリで実行する。
+
+def time_startup (minas, repeat):
+        env = os.environ.copy ()
+        env.pop ("PYTHONDONTWRITEBYTECODE", None)
+        minas = os.path.abspath (minas)
+        if minas.endswith (".pyz"):
+                (env["PYTHONPATH"], module) = (minas, "minas")
+        else:
+                (env["PYTHONPATH"], module) = (os.path.dirname (minas), os.path.splitext (os.path.basename (minas))[0])
+        imported = None
+        best = None
+        with tempfile.TemporaryDirectory () as workdir:
+                for n in range (repeat + 1):
+                        completed = subprocess.run ([sys.executable, "-X", "importtime", "-c", "import " + module], cwd = workdir, env = env,
+                                stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+                        if completed.returncode != 0:
+                                raise RuntimeError ("{0} をインポートできません。\n{1}".format (minas, completed.stderr.decode ('utf-8', 'replace')))
+                        # 「import time: 自身 | 累計 | モジュール名」の行から累計時間（マイクロ秒）を取り出す。
+                        elapsed = None
+                        for line in completed.stderr.decode ('utf-8', 'replace').splitlines ():
+                                fields = line.split ("|")
+                                if len (fields) == 3 and fields[2].strip () == module:
+                                        elapsed = int (fields[1]) / 1000
+                        if elapsed == None:
+                                raise RuntimeError ("{0} の import 時間を取得できません。\n{1}".format (minas, completed.stderr.decode ('utf-8', 'replace')))
+                        if n > 0 and (imported == None or elapsed < imported):
+                                imported = elapsed
+                with open (os.path.join (workdir, "bench.s"), "w") as asm_file:
+                        asm_file.write ("        add a0, a0, a1\n")
+                for n in range (repeat + 1):
+                        start = time.perf_counter ()
+                        completed = subprocess.run ([sys.executable, minas, "bench.s"], cwd = workdir, env = env, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+                        elapsed = (time.perf_counter () - start) * 1000
+                        if completed.returncode != 0:
+                                raise RuntimeError ("{0} がアセンブルに失敗しました。\n{1}".format (minas, completed.stderr.decode ('utf-8', 'replace')))
+                        if n > 0 and (best == None or elapsed < best):
+                                best = elapsed
+        return (imported, best)
+
+# シミュレータの計測用プログラム：
+# 　1回あたり12命令のループを iterations 回まわす。
+sim_source = """
+        addi sp, sp, -64
+        lui t1, 0x{0:05x}
+        addi t1, t1, {1}
+        addi t0, zero, 0
+loop:   add a0, a0, t0
+        xor a1, a1, a0
+        slli a2, a1, 3
+        srai a3, a2, 2
+        sw a3, 0(sp)
+        lw a4, 0(sp)
+        sltu a5, a4, a0
+        andi a6, a5, 255
+        mul a7, a0, t0
+        sub s1, a7, a6
+        addi t0, t0, 1
+        blt t0, t1, loop
+        jalr zero, ra, 0
+"""
+
+# 計測用プログラムをシミュレータで実行し，repeat 回中の最短の（経過時間（秒），実行した命令数，レジスタの値）の組を返す。
+# hot が None なら1命令ずつ実行し，そうでなければ基本ブロックを翻訳して実行する。
+
+def time_simulation (iterations, repeat, hot = None):
+        upper = (iterations + 0x800) >> 12
+        result = minas.Assembler ().assemble (sim_source.format (upper, iterations - (upper << 12)), filename = "simbench.s")
+        best = None
+        for n in range (repeat):
+                sim = minsim.Simulator (result.code, hot = hot)
+                start = time.perf_counter ()
+                sim.run ()
+                elapsed = time.perf_counter () - start
+                if best == None or elapsed < best[0]:
+                        best = (elapsed, sim.steps, sim.regs)
+        return best
+
+# 一斉実行の計測用プログラム：
+# 　レーンごとの入力 a0 によって分岐の向きが変わる，1回あたり10または11命令のループを iterations 回まわす。
+lane_source = """
+        lui t1, 0x{0:05x}
+        addi t1, t1, {1}
+        addi t0, zero, 0
+loop:   add a1, a1, a0
+        andi t2, a1, 4
+        beq t2, zero, skip
+        addi a2, a2, 1
+skip:   xor a3, a3, a1
+        slli a4, a3, 1
+        srli a5, a3, 3
+        mul a6, a5, t0
+        addi t0, t0, 1
+        blt t0, t1, loop
+        jalr zero, ra, 0
+"""
+
+# 計測用プログラムを lanes 本のレーンで，minsim.py で1本ずつ実行した場合と minsimvec.py で一斉に実行した場合の，
+# （経過時間（秒），実行した命令数）の組をそれぞれ返す。
+
+def time_lockstep (iterations, lanes, repeat):
+        import minsimvec
+        upper = (iterations + 0x800) >> 12
+        result = minas.Assembler ().assemble (lane_source.format (upper, iterations - (upper << 12)), filename = "lanebench.s")
+        code = bytes (result.code)
+        interpreter = None
+        lockstep = None
+        for n in range (repeat):
+                start = time.perf_counter ()
+                steps = 0
+                for lane in range (lanes):
+                        sim = minsim.Simulator (code, minsimvec.default_memory_size)
+                        sim.regs[10] = lane
+                        sim.run ()
+                        steps += sim.steps
+                elapsed = time.perf_counter () - start
+                if interpreter == None or elapsed < interpreter[0]:
+                        interpreter = (elapsed, steps)
+                executor = minsimvec.LockstepExecutor ([code] * lanes)
+                executor.regs[:, 10] = range (lanes)
+                start = time.perf_counter ()
+                executor.run ()
+                elapsed = time.perf_counter () - start
+                if lockstep == None or elapsed < lockstep[0]:
+                        lockstep = (elapsed, int (executor.steps.sum ()))
+        return (interpreter, lockstep)
+
+# size_mb MB のバイナリ（生成したソースの命令を繰り返したもの）を minadis.py で逆アセンブルし，
+# repeat 回中の最短の（解読の経過時間（秒），逆アセンブルリストの生成を含めた経過時間（秒），ワード数）の組を返す。
+
+def time_disassembly (size_mb, repeat):
+        import numpy
+        import minadis
+        source = "".join (generate_source (gen, 200) for gen in class_dict.values () if gen not in (gen_jal, gen_defdata, gen_cstr))
+        (words, tail) = minadis.code_words (bytes (minas.Assembler ().assemble (source, filename = "disbench.s").image))
+        words = numpy.resize (words, size_mb * 0x100000 // 4)
+        best = None
+        for n in range (repeat):
+                start = time.perf_counter ()
+                insns = minadis.disassemble (words)
+                decoded = time.perf_counter () - start
+                for line in minadis.listing (insns):
+                        pass
+                elapsed = time.perf_counter () - start
+                if best == None or decoded < best[0]:
+                        best = (decoded, elapsed, len (words))
+        return best
+
+#**********************************************************************************************************************
+# ベンチマークスイート
+#**********************************************************************************************************************
+
+# 大きな合成ソースを生成する関数を定義する。
+# 乱数生成器を rnd，行数を lines に指定し，ソース全体を返す。
+
+# 全ニーモニック辞書の命令を順に繰り返すコード
+# 　条件分岐命令と jal 命令の分岐先は，256 行ごとに置くラベルのうち直前のものとする。
+
+def suite_instructions (rnd, lines):
+        gens = []
+        for mnemonic in minas.reg_reg_arith_dict:
+                gens.append (lambda mnemonic = mnemonic: "{0} {1}, {2}, {3}".format (mnemonic, rnd.choice (bench_regs), rnd.choice (bench_regs), rnd.choice (bench_regs)))
+        for mnemonic in minas.reg_imm_arith_dict:
+                if mnemonic in ("andi", "ori", "xori", "sltiu"):
+                        gens.append (lambda mnemonic = mnemonic: "{0} {1}, {2}, {3}".format (mnemonic, rnd.choice (bench_regs), rnd.choice (bench_regs), rnd.randint (0, 4095)))
+                else:
+                        gens.append (lambda mnemonic = mnemonic: "{0} {1}, {2}, {3}".format (mnemonic, rnd.choice (bench_regs), rnd.choice (bench_regs), rnd.randint (-2048, 2047)))
+        for mnemonic in minas.reg_imm_shift_dict:
+                gens.append (lambda mnemonic = mnemonic: "{0} {1}, {2}, {3}".format (mnemonic, rnd.choice (bench_regs), rnd.choice (bench_regs), rnd.randint (0, 31)))
+        for mnemonic in minas.load_store_dict:
+                gens.append (lambda mnemonic = mnemonic: "{0} {1}, {2}({3})".format (mnemonic, rnd.choice (bench_regs), rnd.randint (-2048, 2047), rnd.choice (bench_regs)))
+        for mnemonic in minas.data_xfer_dict:
+                gens.append (lambda mnemonic = mnemonic: "{0} {1}, 0x{2:05x}".format (mnemonic, rnd.choice (bench_regs), rnd.randint (0, 0xfffff)))
+        for mnemonic in minas.cond_branch_dict:
+                gens.append (lambda mnemonic = mnemonic: "{0} {1}, {2}, {{0}}".format (mnemonic, rnd.choice (bench_regs), rnd.choice (bench_regs)))
+        gens.append (lambda: "jal {0}, {{0}}".format (rnd.choice (bench_regs)))
+        out = []
+        for i in range (lines):
+                head = i - i % 256
+                label = "B{0}:".format (i) if i == head else ""
+                out.append ("{0:8}{1}\n".format (label, gens[i % len (gens)] ().replace ("{0}", "B{0}".format (head))))
+        return "".join (out)
+
+# 全行にラベルを付け，前後のラベルへの beq と jal を多数含むコード
+
+def suite_labels (rnd, lines):
+        out = []
+        for i in range (lines):
+                if i % 2 == 0:
+                        dest = min (max (0, i + rnd.randint (-500, 500)), lines - 1)
+                        out.append ("L{0}:    {1} {2}, {3}, L{4}\n".format (i, rnd.choice (["beq", "bne", "blt", "bgeu"]), rnd.choice (bench_regs), rnd.choice (bench_regs), dest))
+                else:
+                        out.append ("L{0}:    jal {1}, L{2}\n".format (i, rnd.choice (bench_regs), rnd.randint (0, lines - 1)))
+        return "".join (out)
+
+# 1行に多数の要素を並べた .db/.dd の大きな表（.dd はラベルも参照する。）
+
+def suite_tables (rnd, lines):
+        out = []
+        for i in range (lines):
+                if i % 2 == 0:
+                        items = [str (rnd.randint (-128, 127)) if n % 2 == 0 else "0x{0:02x}".format (rnd.randint (0, 0xff)) for n in range (32)]
+                        out.append ("Tab{0}:  .db {1}\n".format (i, ", ".join (items)))
+                else:
+                        items = [str (rnd.randint (-2**31, 2**31 - 1)) if n % 4 != 3 else "Tab{0}".format (rnd.randint (0, i - 1) & ~1) for n in range (16)]
+                        out.append ("        .dd {0}\n".format (", ".join (items)))
+        return "".join (out)
+
+# 長い .cstr 文字列
+
+def suite_strings (rnd, lines):
+        chars = " !$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~"
+        return "".join ("Str{0}:  .cstr \"{1}\"\n".format (i, "".join (rnd.choice (chars) for n in range (200))) for i in range (lines))
+
+# %hi，%lo でラベルと16進定数を参照するコード
+
+def suite_hilo (rnd, lines):
+        out = []
+        for i in range (lines // 4):
+                out.append ("D{0}:    .dd {1}\n".format (i, rnd.randint (0, 2**31 - 1)))
+        for i in range (lines - lines // 4):
+                reg = rnd.choice (bench_regs)
+                ref = "D{0}".format (rnd.randint (0, lines // 4 - 1)) if i % 4 != 3 else "0x{0:08x}".format (rnd.randint (0, 0xffffffff))
+                form = i % 3
+                if form == 0:
+                        out.append ("        lui {0}, %hi({1})\n".format (reg, ref))
+                elif form == 1:
+                        out.append ("        addi {0}, {0}, %lo({1})\n".format (reg, ref))
+                else:
+                        out.append ("        {0} {1}, %lo({2})({1})\n".format (rnd.choice (["lw", "sw", "lbu", "sh"]), reg, ref))
+        return "".join (out)
+
+# スイートの負荷辞書：
+# 　負荷名をキー，ソース全体を生成する関数を値とする辞書。
+suite_dict = {
+        "instructions": suite_instructions,
+        "labels"      : suite_labels,
+        "tables"      : suite_tables,
+        "strings"     : suite_strings,
+        "hilo"        : suite_hilo,
+        }
+
+# 負荷 name の lines 行のソースを生成する。
+
+def suite_source (name, lines, seed = 1):
+        return suite_dict[name] (random.Random (seed), lines)
+
+# アセンブラ minas でソース source を --profile 付きでアセンブルし，repeat 回中の最短の（経過時間（秒），プロファイル）の組を返す。
+
+def time_profiled_assembly (minas, source, workdir, repeat):
+        asm_filename = os.path.join (workdir, "bench.s")
+        with open (asm_filename, "w") as asm_file:
+                asm_file.write (source)
+        best = None
+        for n in range (repeat):
+                start = time.perf_counter ()
+                result = subprocess.run ([sys.executable, minas, "bench.s", "--profile", "profile.json"], cwd = workdir, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+                elapsed = time.perf_counter () - start
+                if result.returncode != 0:
+                        raise RuntimeError ("{0} がアセンブルに失敗しました。\n{1}".format (minas, result.stderr.decode ('utf-8', 'replace')))
+                if best == None or elapsed < best[0]:
+                        with open (os.path.join (workdir, "profile.json"), encoding = "utf-8") as profile_file:
+                                best = (elapsed, json.load (profile_file)["profile"])
+        return best
+
+# fuextract.py で size_mb MB 程度のソースコードを添付したオブジェクトファイルからソースコードを展開し，
+# repeat 回中の最短の（経過時間（秒），ソースコードの大きさ（バイト））の組を返す。
+
+def time_extraction (size_mb, workdir, repeat):
+        fuextract = os.path.join (os.path.dirname (os.path.abspath (__file__)), "fuextract.py")
+        source = suite_source ("strings", size_mb * 0x100000 // 207)
+        result = minas.Assembler ().assemble (source, filename = "extract.s")
+        bin_filename = os.path.join (workdir, "extract.bin")
+        minas.write_image (bin_filename, result.image)
+        best = None
+        for n in range (repeat):
+                destdir = os.path.join (workdir, "extract{0}".format (n))
+                start = time.perf_counter ()
+                completed = subprocess.run ([sys.executable, fuextract, bin_filename, destdir], stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+                elapsed = time.perf_counter () - start
+                if completed.returncode != 0:
+                        raise RuntimeError ("fuextract.py が展開に失敗しました。\n{0}".format (completed.stderr.decode ('utf-8', 'replace')))
+                if best == None or elapsed < best:
+                        best = elapsed
+        return (best, len (source.encode ('utf-8')))
+
+# スイートを実行し，結果の辞書を返す。
+# 各負荷は lines 行とし，fuextract.py は extract_mb MB のソースコードで計測する。（0 なら計測しない。）
+
+def run_suite (minas_path, lines, extract_mb, repeat):
+        results = {}
+        with tempfile.TemporaryDirectory () as workdir:
+                for name in suite_dict:
+                        source = suite_source (name, lines)
+                        (elapsed, profile) = time_profiled_assembly (minas_path, source, workdir, repeat)
+                        size = len (source.encode ('utf-8'))
+                        results[name] = {
+                                "lines"       : lines,
+                                "bytes"       : size,
+                                "elapsed"     : elapsed,
+                                "lines_per_s" : lines / elapsed,
+                                "mb_per_s"    : size / 0x100000 / elapsed,
+                                "phases"      : profile["times"],
+                                }
+                if extract_mb > 0:
+                        (elapsed, size) = time_extraction (extract_mb, workdir, repeat)
+                        results["fuextract"] = {
+                                "bytes"       : size,
+                                "elapsed"     : elapsed,
+                                "mb_per_s"    : size / 0x100000 / elapsed,
+                                }
+        return { "version": minas.version, "python": sys.version.split ()[0], "lines": lines, "extract_mb": extract_mb, "repeat": repeat, "results": results }
+
+# スイートの結果 suite を表示する。
+
+def print_suite (suite):
+        print ("%-14s %10s %10s %12s %8s %8s %8s %8s %8s" % ("workload", "seconds", "MB/s", "lines/s", "open", "pass1", "pass2", "attach", "flush"))
+        for (name, result) in suite["results"].items ():
+                if "phases" in result:
+                        phases = result["phases"]
+                        print ("%-14s %10.3f %10.2f %12.0f %8.3f %8.3f %8.3f %8.3f %8.3f" % (name, result["elapsed"], result["mb_per_s"], result["lines_per_s"],
+                                phases["open"], phases["pass1"], phases["pass2"], phases["attach"], phases["flush"]))
+                else:
+                        print ("%-14s %10.3f %10.2f" % (name, result["elapsed"], result["mb_per_s"]))
+
+# スイートの結果 suite をベースライン baseline と比較し，処理速度（MB/s）が tolerance の割合を越えて落ちた負荷の
+# （負荷名，ベースラインの MB/s，今回の MB/s）の組のリストを返す。
+# 起動時間の割合が変わらないよう，ソースの大きさが異なる負荷は比較しない。
+
+def compare_suite (suite, baseline, tolerance):
+        regressions = []
+        for (name, base) in baseline["results"].items ():
+                result = suite["results"].get (name)
+                if result == None or result["bytes"] != base["bytes"]:
+                        continue
+                if result["mb_per_s"] < base["mb_per_s"] * (1.0 - tolerance):
+                        regressions.append ((name, base["mb_per_s"], result["mb_per_s"]))
+        return regressions
+
+#**********************************************************************************************************************
+# 検査関数群
+#**********************************************************************************************************************
+
+# 編集で挿入する行
+# 　.space と後ろへの beq は，範囲外の分岐命令の置き換えを起こす。
+check_inserts = ["        .db 1", "        .cstr \"ab\"", "        .dw 3", "        add a0, a0, a1", "        .space 3000", "        .align 3", "        beq a0, a1, CheckEnd"]
+
+# ソース lines（行のリスト）に乱数生成器 rnd で1〜3箇所の編集（置き換え，複製，削除，データやラベルの挿入，レジスタの書き換え）を施す。
+# 　ラベルの重複定義ばかりにならないよう，置き換えと複製ではラベルを取り除く。置き換え元は pool（行のリスト）からも選ぶ。
+
+def edit_source (rnd, lines, pool):
+        for n in range (rnd.randint (1, 3)):
+                kind = rnd.randrange (5)
+                i = rnd.randrange (len (lines))
+                if kind == 0:
+                        lines[i] = re.sub (r"^\w+:", "", rnd.choice (lines)) if rnd.random () < 0.8 else rnd.choice (pool)
+                elif kind == 1:
+                        lines.insert (i, re.sub (r"^\w+:", "", rnd.choice (lines)))
+                elif kind == 2:
+                        if len (lines) > 5 and ":" not in lines[i]:
+                                del lines[i]
+                elif kind == 3:
+                        lines.insert (i, rnd.choice (check_inserts + ["X{0}:".format (rnd.randrange (10**6))]))
+                else:
+                        lines[i] = lines[i].replace ("a0", "a1")
+
+# IncrementalAssembler の結果が Assembler で最初からアセンブルした結果と一致するかを，
+# スイートの負荷を混ぜたソースに steps 回の編集を施しながら seeds 通りの乱数系列で検査する。
+# （不一致の数，差分だけアセンブルした回数，最初からアセンブルし直した回数）の組を返す。
+# 　バイナリ（コード部分），ラベル辞書（登録順を含む。），エラーメッセージを比較する。
+
+def check_incremental (seeds, steps, verbose = False):
+        mismatches = 0
+        incremental = 0
+        full = 0
+        for seed in range (seeds):
+                rnd = random.Random (seed)
+                lines = []
+                for name in rnd.sample (sorted (suite_dict), rnd.randint (1, 3)):
+                        lines += suite_source (name, rnd.choice ([20, 100, 500]), seed).splitlines ()
+                lines.append ("CheckEnd:")
+                pool = [gen (rnd, rnd.randrange (len (lines))) for gen in class_dict.values () for n in range (20)]
+                inc = minas.IncrementalAssembler ()
+                for step in range (steps):
+                        if step > 0:
+                                edit_source (rnd, lines, pool)
+                        source = "".join (line + "\n" for line in lines)
+                        result = inc.assemble (source)
+                        if inc.code == None:
+                                full += 1
+                        else:
+                                incremental += 1
+                        expected = minas.Assembler ().assemble (source)
+                        if (result.success != expected.success or
+                            result.success and bytes (result.code) != bytes (expected.code) or
+                            list (result.labels.items ()) != list (expected.labels.items ()) or
+                            [str (diagnostic) for diagnostic in result.diagnostics] != [str (diagnostic) for diagnostic in expected.diagnostics]):
+                                mismatches += 1
+                                if verbose:
+                                        print ("seed {0}，{1} 回目の編集で結果が一致しません。".format (seed, step), file = sys.stderr)
+        return (mismatches, incremental, full)
+
+# 一斉実行の検査で用いるメモリの大きさと，レジスタ名
+check_memory_size = 0x800
+check_regs = ["zero", "ra", "t0", "t1", "a0", "a1", "a2", "a3"]
+
+# 一斉実行の検査用に，メモリの末尾（最初の ra のアドレス）に END を置く lines 行のランダムなプログラムのソースを生成する。
+# 　演算，条件分岐（END や 4 の倍数でない M2 への分岐を含む。），jal（自分自身への分岐を含む。），jalr による戻り，
+# 　データ領域 DATA と範囲外へのロード／ストアを含む。
+
+def check_program (rnd, lines):
+        regs = lambda: rnd.choice (check_regs)
+        dests = lambda: rnd.choice (["L{0}".format (rnd.randrange (lines))] * 12 + ["END", "M2"])
+        body = []
+        for i in range (lines):
+                kind = rnd.randrange (12)
+                if kind < 3:
+                        line = "{0} {1}, {2}, {3}".format (rnd.choice (list (minas.reg_reg_arith_dict)), regs (), regs (), regs ())
+                elif kind == 3:
+                        line = "{0} {1}, {2}, {3}".format (rnd.choice (["addi", "slti"]), regs (), regs (), rnd.randint (-2048, 2047))
+                elif kind == 4:
+                        line = "{0} {1}, {2}, {3}".format (rnd.choice (["sltiu", "andi", "ori", "xori"]), regs (), regs (), rnd.randint (0, 4095))
+                elif kind == 5:
+                        line = "{0} {1}, {2}, {3}".format (rnd.choice (list (minas.reg_imm_shift_dict)), regs (), regs (), rnd.randint (0, 31))
+                elif kind == 6:
+                        line = "{0} {1}, 0x{2:05x}".format (rnd.choice (["lui", "auipc"]), regs (), rnd.randint (0, 0xfffff))
+                elif kind == 7:
+                        line = "{0} {1}, {2}, {3}".format (rnd.choice (list (minas.cond_branch_dict)), regs (), regs (), dests ())
+                elif kind == 8:
+                        line = rnd.choice (["jal zero, {0}", "jal ra, {0}", "jal zero, L{1}", "jalr zero, ra, 0"]).format (dests (), i)
+                else:
+                        # DATA からの（まれに範囲外への）ロード／ストア
+                        offset = rnd.randrange (64) if rnd.random () < 0.9 else rnd.randrange (64, 2048)
+                        line = "lui t0, %hi(DATA)\n        addi t0, t0, %lo(DATA)\n        {0} {1}, {2}(t0)".format (
+                                rnd.choice (list (minas.load_store_dict)), regs (), offset)
+                body.append ("L{0}:    {1}\n".format (i, line))
+        body.append ("        jalr zero, ra, 0\n        .db 1, 2\nM2:     .db 3, 4\nDATA:   .dd {0}\n".format (", ".join (["0"] * 16)))
+        size = len (minas.Assembler ().assemble ("".join (body) + "END:\n").code)
+        return "".join (body) + "        .dd {0}\nEND:\n".format (", ".join (["0"] * ((check_memory_size - size) // 4)))
+
+# minsimvec.py の一斉実行の結果が，minsim.py で1レーンずつ実行した結果と一致するかを，
+# programs 個のランダムなプログラムをそれぞれ lanes 通りの入力（a0〜a3）で，各レーン max_steps 命令まで一斉に実行して検査する。
+# （不一致のレーン数，停止したレーン数，エラーになったレーン数，全レーン数）の組を返す。
+# 　状態（停止，エラー，実行中），実行した命令数，PC，レジスタ，エラーメッセージを比較する。
+
+def check_lockstep (programs, lanes, max_steps, seed = 1, verbose = False):
+        import minsimvec
+        rnd = random.Random (seed)
+        codes = []
+        inputs = []
+        for n in range (programs):
+                code = bytes (minas.Assembler ().assemble (check_program (rnd, rnd.randint (5, 40))).code)
+                for lane in range (lanes):
+                        codes.append (code)
+                        inputs.append ([rnd.choice ([0, 1, 2, 0xffffffff, rnd.getrandbits (32)]) for index in range (4)])
+        executor = minsimvec.LockstepExecutor (codes, check_memory_size)
+        for (lane, values) in enumerate (inputs):
+                executor.regs[lane, 10:14] = values
+        executor.run (max_steps)
+        mismatches = 0
+        for (lane, values) in enumerate (inputs):
+                sim = minsim.Simulator (codes[lane], check_memory_size, None)
+                sim.regs[10:14] = values
+                try:
+                        sim.run (max_steps)
+                        (state, error) = (minsimvec.HALTED if sim.halted else minsimvec.RUNNING, "")
+                except minsim.SimulatorError as exception:
+                        (state, error) = (minsimvec.FAULT, str (exception))
+                expected = (state, sim.steps, sim.pc, sim.regs, error)
+                actual = (int (executor.state[lane]), int (executor.steps[lane]), int (executor.pc[lane]),
+                        [int (value) for value in executor.regs[lane]], executor.errors.get (lane, ""))
+                if actual != expected:
+                        mismatches += 1
+                        if verbose:
+                                print ("レーン {0} の結果が一致しません。（minsim: {1}，minsimvec: {2}）".format (lane, expected[0:3] + expected[4:], actual[0:3] + actual[4:]), file = sys.stderr)
+        return (mismatches, int ((executor.state == minsimvec.HALTED).sum ()), int ((executor.state == minsimvec.FAULT).sum ()), len (codes))
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser (description = "minas.py の命令クラスごとの1行あたりのアセンブル時間，合成した大きなソースによるベンチマークスイート，minas.py の起動時間，minsim.py と minsimvec.py の実行速度，または minadis.py の逆アセンブル時間を計測する。")
+        parser.add_argument ("--minas", default = default_minas, help = "計測対象の minas.py")
+        parser.add_argument ("--against", help = "比較対象の minas.py（指定すると速度比を表示する）")
+        parser.add_argument ("--lines", type = int, default = 20000, help = "命令クラスごとのソース行数")
+        parser.add_argument ("--repeat", type = int, default = 3, help = "計測の繰り返し回数")
+        parser.add_argument ("--sim", type = int, metavar = "ITERATIONS", help = "アセンブラの代わりに minsim.py の実行速度を計測する。（計測用プログラムのループ回数）")
+        parser.add_argument ("--disasm", type = int, metavar = "MB", help = "アセンブラの代わりに，この大きさ（MB）のバイナリの minadis.py による逆アセンブル時間を計測する。")
+        parser.add_argument ("--lanes", type = int, help = "--sim と共に指定すると，このレーン数で minsimvec.py の一斉実行と比較する。")
+        parser.add_argument ("--suite", action = "store_true", help = "合成した大きなソースで minas.py の全体と段階ごとの時間，fuextract.py の展開時間を計測する。（各負荷の行数は --lines）")
+        parser.add_argument ("--extract-mb", type = int, default = 4, help = "--suite で fuextract.py を計測するソースコードの大きさ（MB，0 なら計測しない）")
+        parser.add_argument ("--save-baseline", metavar = "FILE", help = "--suite の結果を JSON のベースラインとして保存する。")
+        parser.add_argument ("--baseline", metavar = "FILE", help = "--suite の結果をベースラインと比較し，遅くなった負荷があれば失敗する。")
+        parser.add_argument ("--tolerance", type = float, default = 0.2, help = "--baseline で許す処理速度の低下の割合（既定は 0.2）")
+        parser.add_argument ("--startup", action = "store_true", help = "--minas（minas.py または zipapp）の import 時間と1行のソースのアセンブル時間を計測する。")
+        parser.add_argument ("--budget", type = float, default = 30.0, metavar = "MS", help = "--startup で許す import 時間（ミリ秒，既定は 30）。越えると失敗する。")
+        parser.add_argument ("--check-incremental", type = int, metavar = "SEEDS", help = "この数の乱数系列で，編集を重ねたソースの差分アセンブルの結果が最初からのアセンブルと一致するかを検査する。（編集回数は --steps）")
+        parser.add_argument ("--steps", type = int, default = 25, help = "--check-incremental で1つの乱数系列あたりに施す編集の回数（既定は 25）")
+        parser.add_argument ("--check-lockstep", type = int, metavar = "PROGRAMS", help = "この数のランダムなプログラムを --lanes（既定は 4）通りの入力で minsimvec.py で一斉に実行し，minsim.py の結果と一致するかを検査する。")
+        parser.add_argument ("--check", action = "store_true", help = "--check-incremental（既定は 20 系列），--check-lockstep（既定は 50 個。NumPy がなければ省く。）と --startup の予算を続けて検査し，いずれかを満たさなければ失敗する。")
+        args = parser.parse_args ()
+
+        if args.check:
+                if args.check_incremental == None:
+                        args.check_incremental = 20
+                if args.check_lockstep == None:
+                        import importlib.util
+                        if importlib.util.find_spec ("numpy") != None:
+                                args.check_lockstep = 50
+                        else:
+                                print ("NumPy がないので --check-lockstep を省きます。", file = sys.stderr)
+                args.startup = True
+
+        # 検査を満たさなかったか
+        failed = False
+        if args.check_incremental != None:
+                (mismatches, incremental, full) = check_incremental (args.check_incremental, args.steps, True)
+                print ("%-14s %12s %12s %12s" % ("incremental", "mismatches", "incremental", "full"))
+                print ("%-14s %12d %12d %12d" % ("minas", mismatches, incremental, full))
+                failed = mismatches > 0
+                if not args.startup and args.check_lockstep == None:
+                        sys.exit (1 if failed else 0)
+        if args.check_lockstep != None:
+                (mismatches, halted, faulted, lanes) = check_lockstep (args.check_lockstep, args.lanes if args.lanes != None else 4, 300, verbose = True)
+                print ("%-14s %12s %12s %12s %12s" % ("lockstep", "mismatches", "halted", "fault", "lanes"))
+                print ("%-14s %12d %12d %12d %12d" % ("minsimvec", mismatches, halted, faulted, lanes))
+                failed = failed or mismatches > 0
+                if not args.startup:
+                        sys.exit (1 if failed else 0)
+
+        if args.startup:
+                print ("%-14s %12s %12s" % ("startup", "import (ms)", "run (ms)"))
+                (imported, elapsed) = time_startup (args.minas, args.repeat)
+                print ("%-14s %12.1f %12.1f" % (os.path.basename (args.minas), imported, elapsed))
+                if args.against:
+                        (against_imported, against_elapsed) = time_startup (args.against, args.repeat)
+                        print ("%-14s %12.1f %12.1f" % (os.path.basename (args.against), against_imported, against_elapsed))
+                if imported > args.budget:
+                        print ("import 時間 {0:.1f} ms が予算 {1:.1f} ms を越えました。".format (imported, args.budget), file = sys.stderr)
+                        failed = True
+                sys.exit (1 if failed else 0)
+
+        if args.suite:
+                suite = run_suite (args.minas, args.lines, args.extract_mb, args.repeat)
+                print_suite (suite)
+                if args.save_baseline != None:
+                        with open (args.save_baseline, "w", encoding = "utf-8") as baseline_file:
+                                json.dump (suite, baseline_file, indent = 1)
+                if args.baseline != None:
+                        with open (args.baseline, encoding = "utf-8") as baseline_file:
+                                baseline = json.load (baseline_file)
+                        if (baseline.get ("lines"), baseline.get ("extract_mb")) != (args.lines, args.extract_mb):
+                                print ("ベースラインと --lines，--extract-mb が異なるため比較できません。", file = sys.stderr)
+                                sys.exit (2)
+                        regressions = compare_suite (suite, baseline, args.tolerance)
+                        for (name, base, current) in regressions:
+                                print ("{0}: {1:.2f} MB/s から {2:.2f} MB/s に低下しました。".format (name, base, current), file = sys.stderr)
+                        if len (regressions) > 0:
+                                sys.exit (1)
+                sys.exit (0)
+
+        if args.disasm != None:
+                (decoded, elapsed, count) = time_disassembly (args.disasm, args.repeat)
+                print ("%-14s %12s %12s %12s" % ("disassembler", "words", "decode (s)", "listing (s)"))
+                print ("%-14s %12d %12.3f %12.3f" % ("minadis", count, decoded, elapsed))
+                sys.exit (0)
+        if args.sim != None and args.lanes != None:
+                (interpreter, lockstep) = time_lockstep (args.sim, args.lanes, args.repeat)
+                print ("%-14s %12s %12s %8s" % ("simulator", "steps", "seconds", "MIPS"))
+                print ("%-14s %12d %12.3f %8.2f" % ("per-lane", interpreter[1], interpreter[0], interpreter[1] / interpreter[0] / 1e6))
+                print ("%-14s %12d %12.3f %8.2f" % ("lockstep", lockstep[1], lockstep[0], lockstep[1] / lockstep[0] / 1e6))
+                print ("speedup: %.2fx" % (interpreter[0] / lockstep[0]))
+                sys.exit (0)
+        if args.sim != None:
+                interpreter = time_simulation (args.sim, args.repeat)
+                blocks = time_simulation (args.sim, args.repeat, minsim.default_hot_count)
+                print ("%-14s %12s %12s %8s" % ("simulator", "steps", "seconds", "MIPS"))
+                print ("%-14s %12d %12.3f %8.2f" % ("interpreter", interpreter[1], interpreter[0], interpreter[1] / interpreter[0] / 1e6))
+                print ("%-14s %12d %12.3f %8.2f" % ("blocks", blocks[1], blocks[0], blocks[1] / blocks[0] / 1e6))
+                print ("speedup: %.2fx" % (interpreter[0] / blocks[0]))
+                # 翻訳しても結果が変わらないことを確かめる。
+                if blocks[1:] != interpreter[1:]:
+                        print ("翻訳して実行した結果が一致しません。", file = sys.stderr)
+                        sys.exit (1)
+                sys.exit (0)
+
+        times = per_line_times (args.minas, args.lines, args.repeat)
+        if args.against:
+                against_times = per_line_times (args.against, args.lines, args.repeat)
+                print ("%-14s %12s %12s %8s" % ("class", "us/line", "against", "speedup"))
+                for name in class_dict:
+                        speedup = against_times[name] / times[name] if times[name] > 0 else float ("inf")
+                        print ("%-14s %12.2f %12.2f %7.2fx" % (name, times[name], against_times[name], speedup))
+        else:
+                print ("%-14s %12s" % ("class", "us/line"))
+                for name in class_dict:
+                        print ("%-14s %12.2f" % (name, times[name]))
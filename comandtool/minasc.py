@@ -0,0 +1,253 @@
+#-*- python -*-
+#**********************************************************************************************************************
+#
+# RISC-V Minimum Assembler Client
+#
+# Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)
+#
+# minas.py --serve で常駐させたアセンブラにソースファイルを送ってアセンブルする。
+# 使い方と出力は minas.py と同じである。ソケットは環境変数 MINAS_SOCKET または --socket で指定する。
+# 出力先，出力形式，ソースコードの添付，記録する時刻とユーザ名などの指定は要求に含めて送る。キャッシュは常駐しているアセンブラのものを用いる。
+# 常駐しているアセンブラに接続できない場合と，バッチアセンブル（--batch），並列アセンブル（--parallel），常駐モード（--serve）の場合は，
+# このプロセスで minas.py を実行する。
+#
+#**********************************************************************************************************************
+
+import getpass
+import io
+import json
+import os
+import re
+import socket
+import stat
+import struct
+import sys
+import time
+import uuid
+
+# メッセージを組み立てる。（minas.py の pack_message と同じ形式）
+
+def pack_message (header, body):
+        header = json.dumps (header, ensure_ascii = False).encode ('utf-8')
+        return struct.pack ("<II", len (header), len (body)) + header + body
+
+# ソケット sock から size バイトを受け取る。
+
+def recv_exactly (sock, size):
+        buf = bytearray (size)
+        view = memoryview (buf)
+        pos = 0
+        while pos < size:
+                n = sock.recv_into (view[pos:])
+                if n == 0:
+                        raise ConnectionError ("接続が切断されました。")
+                pos += n
+        return buf
+
+# オブジェクトイメージ image をファイル filename に1回で書き込む。（minas.py の write_image と同じ）
+
+def write_image (filename, image):
+        # シンボリックリンクならリンク先に書き込む。
+        filename = os.path.realpath (filename)
+        # デバイスや名前付きパイプなど，通常のファイルでないものには直接書き込む。
+        try:
+                st = os.stat (filename)
+        except FileNotFoundError:
+                st = None
+        if st != None and not stat.S_ISREG (st.st_mode):
+                with open (filename, "wb") as out_file:
+                        out_file.write (image)
+                return
+        dirname = os.path.dirname (filename)
+        tmp_filename = os.path.join (dirname, ".{0}.{1}.tmp".format (os.path.basename (filename), uuid.uuid4 ().hex))
+        fd = os.open (tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr (os, "O_BINARY", 0), 0o666)
+        try:
+                with os.fdopen (fd, "wb") as tmp_file:
+                        tmp_file.write (image)
+                        tmp_file.flush ()
+                        os.fsync (tmp_file.fileno ())
+                # 既存のファイルのパーミッションを引き継ぐ。
+                if st != None:
+                        os.chmod (tmp_filename, stat.S_IMODE (st.st_mode))
+                os.replace (tmp_filename, filename)
+        except BaseException:
+                os.remove (tmp_filename)
+                raise
+
+# 常駐しているアセンブラに接続できなければ，minas.py を直接実行する。
+
+def run_locally (args):
+        sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+        import minas
+        sys.argv = [sys.argv[0]] + args
+        return minas.main ()
+
+# 出力形式名をキー，出力ファイルの拡張子を値とする辞書。（minas.py の output_formats と同じ）
+output_formats = {
+        "furv": ".bin",
+        "raw" : ".img",
+        "ihex": ".hex",
+        "memh": ".mem",
+        "elf" : ".elf",
+        }
+
+# プロファイル report を JSON 形式で profile_filename に書き出す。（"-" なら標準出力に書き出す。minas.py の write_profile と同じ）
+
+def write_profile (profile_filename, report):
+        if profile_filename == "-":
+                json.dump (report, sys.stdout, ensure_ascii = False, indent = 1)
+                print ()
+        else:
+                with open (profile_filename, "w", encoding = "utf-8") as profile_file:
+                        json.dump (report, profile_file, ensure_ascii = False, indent = 1)
+
+def main ():
+        # 引数を解析する。（minas.py と同じ引数を受け付け，--socket 以外は minas.py にそのまま渡せるようにしておく。）
+        import argparse
+        argv = sys.argv[1:]
+        socket_path = os.environ.get ("MINAS_SOCKET")
+        if len (argv) >= 2 and argv[0] == "--socket":
+                socket_path = argv[1]
+                argv = argv[2:]
+        parser = argparse.ArgumentParser (prog = "minasc", add_help = False)
+        parser.add_argument ("source", nargs = "*")
+        parser.add_argument ("-o", "--output")
+        parser.add_argument ("--batch")
+        parser.add_argument ("--jobs")
+        parser.add_argument ("--parallel", action = "store_true")
+        parser.add_argument ("--serve")
+        parser.add_argument ("--report")
+        parser.add_argument ("--cache")
+        parser.add_argument ("--cache-size")
+        parser.add_argument ("--profile", nargs = "?", const = "-")
+        parser.add_argument ("--format", choices = list (output_formats), default = "furv")
+        parser.add_argument ("--no-source", action = "store_true")
+        parser.add_argument ("--source-name")
+        parser.add_argument ("--timestamp", type = float)
+        parser.add_argument ("--source-date-epoch", action = "store_true")
+        parser.add_argument ("--user")
+        # 　解析できない引数や，常駐しているアセンブラでは扱わない指定（バッチアセンブル，並列アセンブル，常駐モード）は，
+        # 　minas.py を直接実行して処理させる。（エラーメッセージも minas.py が出力する。）
+        def error (message):
+                raise ValueError (message)
+        parser.error = error
+        try:
+                (args, unknown) = parser.parse_known_args (argv)
+        except ValueError:
+                return run_locally (argv)
+        if socket_path == None or len (unknown) > 0 or args.batch != None or args.parallel or args.serve != None:
+                return run_locally (argv)
+        if len (args.source) != 1:
+                return run_locally (argv)
+        asm_filename = args.source[0]
+        if asm_filename != "-" and not re.search (r'\.(s|asm)$', asm_filename.lower ()):
+                return run_locally (argv)
+        if (args.output == "-" or args.output == None and asm_filename == "-") and args.profile == "-":
+                return run_locally (argv)
+        timestamp = args.timestamp
+        if args.source_date_epoch:
+                try:
+                        if timestamp != None:
+                                raise ValueError (timestamp)
+                        timestamp = float (os.environ["SOURCE_DATE_EPOCH"])
+                except (KeyError, ValueError):
+                        return run_locally (argv)
+        source_name = args.source_name
+        if source_name == None:
+                source_name = "stdin.s" if asm_filename == "-" else asm_filename
+        bin_filename = args.output
+        if bin_filename == None:
+                bin_filename = "-" if asm_filename == "-" else re.sub (r'\.(s|asm)$', output_formats[args.format], asm_filename, flags = re.IGNORECASE)
+
+        # 常駐しているアセンブラに接続する。
+        try:
+                sock = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect (socket_path)
+        except OSError:
+                return run_locally (argv)
+
+        # 著作権を表示する。
+        print ("RISC-V Minimum Assembler Client", file = sys.stderr)
+        print ("Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)", file = sys.stderr)
+        print (file = sys.stderr)
+
+        # ソースファイルを読み込む。
+        # 　標準入力から読む場合は，読み込んだ内容を minas.py に渡せないので，以降で minas.py を直接実行する場合はその内容をアセンブルする。
+        start = time.perf_counter ()
+        try:
+                if asm_filename == "-":
+                        st = None
+                        asm_source = sys.stdin.buffer.read ()
+                else:
+                        with open (asm_filename, "rb") as asm_file:
+                                st = os.stat (asm_file.fileno ())
+                                asm_source = asm_file.read ()
+        except IOError:
+                sock.close ()
+                print ("ソースファイル {0} をオープンできません。".format (asm_filename), file = sys.stderr)
+                return 1
+        if asm_filename == "-":
+                sys.stdin = io.TextIOWrapper (io.BytesIO (asm_source))
+
+        # アセンブルを要求し，応答を受け取る。
+        request = {
+                "filename" : source_name,
+                "stat"     : None if st == None else [st.st_mode, st.st_ctime, st.st_atime, st.st_mtime],
+                "user"     : args.user if args.user != None else getpass.getuser (),
+                "directory": os.getcwd (),
+                "format"   : args.format,
+                "attach"   : not args.no_source,
+                "timestamp": timestamp,
+                }
+        # 　要求の途中で接続が切れた，応答が壊れている，常駐しているアセンブラでエラーが起きた場合は，minas.py を直接実行する。
+        try:
+                with sock:
+                        sock.sendall (pack_message (request, asm_source))
+                        (header_size, body_size) = struct.unpack ("<II", recv_exactly (sock, 8))
+                        response = json.loads (recv_exactly (sock, header_size).decode ('utf-8'))
+                        image = recv_exactly (sock, body_size)
+        except (OSError, struct.error, ValueError):
+                return run_locally (argv)
+        if response.get ("error") != None:
+                print (response["error"], file = sys.stderr)
+                return run_locally (argv)
+        sys.stderr.write (response["log"])
+
+        if not response["success"]:
+                # エラー終了した場合は，古いオブジェクトファイルを削除する。
+                if bin_filename != "-" and os.path.exists (bin_filename):
+                        os.remove (bin_filename)
+                print ("{0}, アセンブルに失敗しました。".format (source_name), file = sys.stderr)
+                status = "error"
+        else:
+                # オブジェクトイメージをオブジェクトファイルに書き込む。
+                try:
+                        if bin_filename == "-":
+                                sys.stdout.buffer.write (image)
+                                sys.stdout.buffer.flush ()
+                        else:
+                                write_image (bin_filename, image)
+                except OSError:
+                        print ("オブジェクトファイル {0} をオープンできません。".format (bin_filename), file = sys.stderr)
+                        status = "error"
+                else:
+                        if bin_filename == "-":
+                                print ("{0}, オブジェクトイメージを標準出力に書き出しました。".format (source_name), file = sys.stderr)
+                        else:
+                                print ("{0}, オブジェクトファイル {1} を生成しました。".format (source_name, bin_filename), file = sys.stderr)
+                        status = "ok"
+        if args.profile != None:
+                write_profile (args.profile, { "version": response.get ("version"), "source": asm_filename, "status": status,
+                        "elapsed": time.perf_counter () - start, "cached": response.get ("cache") == "hit", "profile": response.get ("profile", {}) })
+        if status != "ok":
+                return 1
+
+        # ラベルのアドレスを出力する。
+        labels = response["labels"]
+        print ("*** Labels ***", file = sys.stderr)
+        for label in labels:
+                print ("%-12s = 0x%08x" % (label, labels[label]), file = sys.stderr)
+        return 0
+
+if __name__ == "__main__":
+        sys.exit (main ())
@@ -0,0 +1,58 @@
+#-*- python -*-
+#**********************************************************************************************************************
+#
+# RISC-V Minimum Assembler Packager
+#
+# Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)
+#
+# minas.py を1ファイルで実行できる zipapp（.pyz）にまとめる。
+# 　zipimport はバイトコードをキャッシュに書き込まないので，実行のたびにソースをコンパイルしないよう，
+# 　このスクリプトを実行した Python でコンパイルしたバイトコード（minas.pyc）を同梱する。
+# 　バイトコードはソースの時刻を検査しない形式とし，Python のバージョンが異なる場合は同梱したソース（minas.py）が用いられる。
+#
+#**********************************************************************************************************************
+
+import argparse
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipapp
+
+# まとめる minas.py（既定はこのファイルと同じディレクトリの minas.py）
+default_minas = os.path.join (os.path.dirname (os.path.abspath (__file__)), "minas.py")
+
+# zipapp の入口：
+# 　minas.main の戻り値を終了コードとする。
+main_source = """\
+import sys
+import minas
+sys.exit (minas.main ())
+"""
+
+# minas.py のパス minas_path を zipapp pyz_filename にまとめる。
+# interpreter に起動する Python を指定すると，先頭にその shebang 行を付ける。
+
+def build (minas_path, pyz_filename, interpreter = "/usr/bin/env python3"):
+        with tempfile.TemporaryDirectory () as workdir:
+                shutil.copyfile (minas_path, os.path.join (workdir, "minas.py"))
+                py_compile.compile (minas_path, cfile = os.path.join (workdir, "minas.pyc"), dfile = "minas.py", doraise = True,
+                        invalidation_mode = py_compile.PycInvalidationMode.UNCHECKED_HASH)
+                with open (os.path.join (workdir, "__main__.py"), "w", encoding = "utf-8") as main_file:
+                        main_file.write (main_source)
+                # 読み込みを速くするため圧縮しない。
+                zipapp.create_archive (workdir, pyz_filename, interpreter = interpreter, compressed = False)
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser (description = "minas.py を1ファイルで実行できる zipapp にまとめる。")
+        parser.add_argument ("-o", "--output", default = "minas.pyz", help = "出力する zipapp（既定は minas.pyz）")
+        parser.add_argument ("--minas", default = default_minas, help = "まとめる minas.py")
+        parser.add_argument ("--python", default = "/usr/bin/env python3", help = "shebang 行に書く Python（既定は /usr/bin/env python3）")
+        args = parser.parse_args ()
+        build (args.minas, args.output, args.python)
+        print ("{0} を作成しました。（バイトコードは Python {1}.{2} 用）".format (args.output, *sys.version_info[0:2]), file = sys.stderr)
@@ -0,0 +1,643 @@
+#-*- python -*-
+#**********************************************************************************************************************
+#
+# RISC-V Minimum Simulator
+#
+# Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)
+#
+# minas.py が生成した FURV 形式のオブジェクトファイルのバイナリを実行する RV32IM 命令セットシミュレータ。
+# minas.py がアセンブルできる命令だけを実行する。
+# 　jal 命令の即値は minas.py と同じく，分岐元と同じ 1MB の領域内の絶対アドレスとして扱う。
+# 　mulhsu 命令は minas.py では mul 命令と同じコードになるので，mul 命令として実行される。
+# 繰り返し実行する基本ブロックは，レジスタをローカル変数に持つ Python の関数に翻訳して実行する。
+#
+#**********************************************************************************************************************
+
+import argparse
+import itertools
+import os
+import struct
+import sys
+import time
+
+sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+import minas
+
+# 既定のメモリの大きさ（jal 命令で分岐できる 1MB の領域）
+default_memory_size = 0x00100000
+
+# 基本ブロックを翻訳するまでに，その先頭を実行する回数の既定値
+default_hot_count = 16
+
+# 基本ブロックの最大命令数
+block_limit = 256
+
+#**********************************************************************************************************************
+# 命令の意味
+#**********************************************************************************************************************
+
+# 命令の意味は Python の式または文の雛形で表し，命令ごとの処理関数をこれから生成する。
+# 雛形の {a}，{b} はオペランドの値（32ビット符号なし整数），{rd} はディスティネーションレジスタ，
+# {addr} はメモリのアドレス，{m} はメモリを表す。
+
+# 演算命令辞書：
+# 　ニーモニック名をキー，結果（32ビット符号なし整数）を求める式の雛形を値とする辞書。
+alu_exprs = {
+        "add"   : "({a} + {b}) & 0xffffffff",
+        "sub"   : "({a} - {b}) & 0xffffffff",
+        "and"   : "{a} & {b}",
+        "or"    : "{a} | {b}",
+        "xor"   : "{a} ^ {b}",
+        "slt"   : "(1 if ({a} ^ 0x80000000) < ({b} ^ 0x80000000) else 0)",
+        "sltu"  : "(1 if {a} < {b} else 0)",
+        "sll"   : "({a} << ({b} & 31)) & 0xffffffff",
+        "srl"   : "{a} >> ({b} & 31)",
+        "sra"   : "((({a} ^ 0x80000000) - 0x80000000) >> ({b} & 31)) & 0xffffffff",
+        "mul"   : "({a} * {b}) & 0xffffffff",
+        "mulh"  : "(((({a} ^ 0x80000000) - 0x80000000) * (({b} ^ 0x80000000) - 0x80000000)) >> 32) & 0xffffffff",
+        "mulhu" : "({a} * {b}) >> 32",
+        "mulhsu": "(((({a} ^ 0x80000000) - 0x80000000) * {b}) >> 32) & 0xffffffff",
+        "div"   : "div_signed ({a}, {b})",
+        "rem"   : "rem_signed ({a}, {b})",
+        "divu"  : "div_unsigned ({a}, {b})",
+        "remu"  : "rem_unsigned ({a}, {b})",
+        }
+
+# 即値演算命令辞書：
+# 　ニーモニック名をキー，同じ演算をする演算命令のニーモニック名を値とする辞書。
+alu_imm_alias = {
+        "addi" : "add",
+        "andi" : "and",
+        "ori"  : "or",
+        "xori" : "xor",
+        "slti" : "slt",
+        "sltiu": "sltu",
+        "slli" : "sll",
+        "srli" : "srl",
+        "srai" : "sra",
+        }
+
+# ロード命令辞書：
+# 　ニーモニック名をキー，ロードした値（32ビット符号なし整数）を求める式の雛形を値とする辞書。
+load_exprs = {
+        "lw" : "load_word ({m}, {addr})[0]",
+        "lh" : "load_half ({m}, {addr})[0] & 0xffffffff",
+        "lhu": "load_uhalf ({m}, {addr})[0]",
+        "lb" : "load_byte ({m}, {addr})[0] & 0xffffffff",
+        "lbu": "{m}[{addr}]",
+        }
+
+# ストア命令辞書：
+# 　ニーモニック名をキー，（ストアする文の雛形，ストアするバイト数）の組を値とする辞書。
+store_stmts = {
+        "sw": ("store_word ({m}, {addr}, {b})", 4),
+        "sh": ("store_half ({m}, {addr}, {b} & 0xffff)", 2),
+        "sb": ("{m}[{addr}] = {b} & 0xff", 1),
+        }
+
+# 条件分岐命令辞書：
+# 　ニーモニック名をキー，分岐する条件の式の雛形を値とする辞書。
+branch_exprs = {
+        "beq" : "{a} == {b}",
+        "bne" : "{a} != {b}",
+        "blt" : "({a} ^ 0x80000000) < ({b} ^ 0x80000000)",
+        "bge" : "({a} ^ 0x80000000) >= ({b} ^ 0x80000000)",
+        "bltu": "{a} < {b}",
+        "bgeu": "{a} >= {b}",
+        }
+
+# メモリアクセス関数
+load_word = struct.Struct ("<I").unpack_from
+load_half = struct.Struct ("<h").unpack_from
+load_uhalf = struct.Struct ("<H").unpack_from
+load_byte = struct.Struct ("b").unpack_from
+store_word = struct.Struct ("<I").pack_into
+store_half = struct.Struct ("<H").pack_into
+
+# 除算（M標準拡張仕様に従い，0除算と桁あふれでは例外を起こさず規定の値を返す。）
+
+def div_signed (a, b):
+        a = (a ^ 0x80000000) - 0x80000000
+        b = (b ^ 0x80000000) - 0x80000000
+        if b == 0:
+                return 0xffffffff
+        q = abs (a) // abs (b)
+        if (a < 0) != (b < 0):
+                q = -q
+        return q & 0xffffffff
+
+def rem_signed (a, b):
+        a = (a ^ 0x80000000) - 0x80000000
+        b = (b ^ 0x80000000) - 0x80000000
+        if b == 0:
+                return a & 0xffffffff
+        r = abs (a) % abs (b)
+        if a < 0:
+                r = -r
+        return r & 0xffffffff
+
+def div_unsigned (a, b):
+        if b == 0:
+                return 0xffffffff
+        return a // b
+
+def rem_unsigned (a, b):
+        if b == 0:
+                return a
+        return a % b
+
+#**********************************************************************************************************************
+# 命令の解読
+#**********************************************************************************************************************
+
+# 解読表：
+# 　（マスク，マスクした命令語をキー，ニーモニック名を値とする辞書）の組のリスト。マスクの長いものから順に引く。
+# 　minas.py のオペコード辞書から作る。mulhsu 命令は mul 命令と同じコードなので，先に登録された mul 命令とする。
+decode_table = [(0xfe00707f, {}), (0x0000707f, {}), (0x0000007f, {})]
+decode_masks = { mask: codes for (mask, codes) in decode_table }
+for (opcode_dict, mask) in [
+        (minas.reg_reg_arith_dict, 0xfe00707f),
+        (minas.reg_imm_shift_dict, 0xfe00707f),
+        (minas.reg_imm_arith_dict, 0x0000707f),
+        (minas.load_store_dict, 0x0000707f),
+        (minas.cond_branch_dict, 0x0000707f),
+        (minas.data_xfer_dict, 0x0000007f),
+        ({ "jal": 0b0000000000000000000_00000_1101111 }, 0x0000007f),
+        ]:
+        for mnemonic in opcode_dict:
+                decode_masks[mask].setdefault (opcode_dict[mnemonic], mnemonic)
+
+# 命令語 word のニーモニック名を返す。解読できなければ None を返す。
+
+def decode_mnemonic (word):
+        for (mask, codes) in decode_table:
+                mnemonic = codes.get (word & mask)
+                if mnemonic != None:
+                        return mnemonic
+        return None
+
+# 命令語 word を（ニーモニック名，rd，rs1，rs2，即値）の組に解読する。解読できなければ None を返す。
+# 即値は符号拡張した値を 32ビット符号なし整数で表す。jal 命令と条件分岐命令の即値は，アドレス pc の命令の分岐先アドレスとする。
+
+def decode (word, pc):
+        mnemonic = decode_mnemonic (word)
+        if mnemonic == None:
+                return None
+        opcode = word & 0x7f
+        rd = (word >> 7) & 0x1f
+        rs1 = (word >> 15) & 0x1f
+        rs2 = (word >> 20) & 0x1f
+        if opcode == 0b0100011:
+                # S 形式
+                imm = ((word >> 25) << 5) | ((word >> 7) & 0x1f)
+                imm = ((imm ^ 0x800) - 0x800) & 0xffffffff
+        elif opcode == 0b1100011:
+                # B 形式（PC 相対）
+                imm = ((word >> 31) << 12) | (((word >> 7) & 1) << 11) | (((word >> 25) & 0x3f) << 5) | (((word >> 8) & 0xf) << 1)
+                imm = (pc + (imm ^ 0x1000) - 0x1000) & 0xffffffff
+        elif opcode == 0b1101111:
+                # J 形式（minas.py では 1MB の領域内の絶対アドレス）
+                imm = ((word >> 31) << 20) | (((word >> 12) & 0xff) << 12) | (((word >> 20) & 1) << 11) | (((word >> 21) & 0x3ff) << 1)
+                imm = (pc & 0xfff00000) | (imm & 0x000fffff)
+        elif opcode == 0b0110111 or opcode == 0b0010111:
+                # U 形式
+                imm = word & 0xfffff000
+        elif mnemonic in minas.reg_imm_shift_dict:
+                # シフト量
+                imm = rs2
+        else:
+                # I 形式
+                imm = ((word >> 20) ^ 0x800) - 0x800
+                imm &= 0xffffffff
+        return (mnemonic, rd, rs1, rs2, imm)
+
+#**********************************************************************************************************************
+# 処理関数の生成
+#**********************************************************************************************************************
+
+# ニーモニック名 mnemonic の命令を実行する処理関数の本体（文のリスト）を返す。
+# rd が x0 の場合（write が False の場合）はレジスタに書き込まない。
+# 処理関数は次に実行する命令のアドレスを返す。
+
+def handler_body (mnemonic, write):
+        if mnemonic in alu_exprs or mnemonic in alu_imm_alias:
+                if mnemonic in alu_exprs:
+                        expr = alu_exprs[mnemonic].format (a = "r[rs1]", b = "r[rs2]")
+                else:
+                        expr = alu_exprs[alu_imm_alias[mnemonic]].format (a = "r[rs1]", b = "imm")
+                body = ["r[rd] = " + expr] if write else []
+                return body + ["return pc + 4"]
+        if mnemonic in load_exprs:
+                expr = load_exprs[mnemonic].format (m = "m", addr = "(r[rs1] + imm) & 0xffffffff")
+                return (["r[rd] = " + expr] if write else [expr]) + ["return pc + 4"]
+        if mnemonic in store_stmts:
+                (stmt, size) = store_stmts[mnemonic]
+                return ["addr = (r[rs1] + imm) & 0xffffffff",
+                        stmt.format (m = "m", addr = "addr", b = "r[rs2]"),
+                        "if addr < sim.code_end:",
+                        "        sim.invalidate (addr, {0})".format (size),
+                        "return pc + 4"]
+        if mnemonic in branch_exprs:
+                return ["return imm if " + branch_exprs[mnemonic].format (a = "r[rs1]", b = "r[rs2]") + " else pc + 4"]
+        if mnemonic == "jal":
+                return (["r[rd] = pc + 4"] if write else []) + ["return imm"]
+        if mnemonic == "jalr":
+                return ["target = (r[rs1] + imm) & 0xfffffffe",
+                        "if target & 3:",
+                        "        raise SimulatorError (pc, \"分岐先アドレス 0x{0:08x} が 4 の倍数ではありません。\".format (target))"] + \
+                        (["r[rd] = pc + 4"] if write else []) + ["return target"]
+        if mnemonic == "lui":
+                return (["r[rd] = imm"] if write else []) + ["return pc + 4"]
+        if mnemonic == "auipc":
+                return (["r[rd] = (pc + imm) & 0xffffffff"] if write else []) + ["return pc + 4"]
+        raise KeyError (mnemonic)
+
+# 処理関数の生成関数の辞書：
+# 　（ニーモニック名，レジスタに書き込むか）の組をキー，処理関数の生成関数を値とする辞書。初めて用いるときに作る。
+factory_dict = {}
+
+# ニーモニック名 mnemonic の命令の処理関数の生成関数を返す。
+# 生成関数はシミュレータとオペランドを受け取り，オペランドを閉包に持つ処理関数を返す。
+
+def handler_factory (mnemonic, write):
+        factory = factory_dict.get ((mnemonic, write))
+        if factory == None:
+                source = "def factory (sim, r, m, rd, rs1, rs2, imm):\n"
+                source += "        def handler (pc):\n"
+                for stmt in handler_body (mnemonic, write):
+                        source += "                " + stmt + "\n"
+                source += "        return handler\n"
+                namespace = {}
+                exec (source, globals (), namespace)
+                factory = namespace["factory"]
+                factory_dict[(mnemonic, write)] = factory
+        return factory
+
+#**********************************************************************************************************************
+# 基本ブロックの翻訳
+#**********************************************************************************************************************
+
+# 基本ブロックは，条件分岐命令，jal 命令，jalr 命令のいずれかで終わる命令の列とし，ブロック関数と呼ぶ1つの関数に翻訳する。
+# ブロック関数はブロックで用いるレジスタの値をローカル変数 x1～x31 に読み込んで実行し，最後にレジスタファイルに書き戻して，
+# 次に実行する命令のアドレスを返す。1回の呼び出しで実行した命令数のうち，2命令目以降の数を sim.extra_steps に加える。
+# 　ロード／ストア命令と jalr 命令でエラーが起きた場合は，それまでの値を書き戻してエラーを起こした命令のアドレスで通知する。
+# 　命令語を書き換えるストア命令を実行した場合は，そこでブロックを抜ける。
+
+# レジスタ index の値を表すローカル変数名（x0 なら 0）を返す。
+
+def block_reg (index):
+        return "x{0}".format (index) if index != 0 else "0"
+
+# メモリ memory のアドレス start から始まる基本ブロックのブロック関数の生成関数のソースコードと，
+# ブロックの次に実行しうる命令のアドレス（分岐先とブロックの末尾のアドレス）のリストの組を返す。
+# 先頭の命令を翻訳できなければ None を返す。
+# 解読できない命令，自分自身に分岐する jal 命令，分岐先アドレスが 4 の倍数でない命令は翻訳せず，その直前でブロックを終える。
+
+def block_source (memory, start):
+        # ブロックの命令を解読する。
+        instructions = []
+        pc = start
+        while len (instructions) < block_limit and pc + 4 <= len (memory):
+                fields = decode (load_word (memory, pc)[0], pc)
+                if fields == None:
+                        break
+                (mnemonic, rd, rs1, rs2, imm) = fields
+                if mnemonic == "jal" and imm == pc:
+                        break
+                if (mnemonic == "jal" or mnemonic in branch_exprs) and imm & 3:
+                        break
+                instructions.append ((pc, fields))
+                pc += 4
+                if mnemonic == "jal" or mnemonic == "jalr" or mnemonic in branch_exprs:
+                        break
+        if len (instructions) == 0:
+                return None
+        end = pc
+        successors = [end]
+
+        # 命令ごとの文を生成する。
+        used = set ()
+        written = set ()
+        body = []
+        result = str (end)
+        faulting = False
+        for (n, (pc, (mnemonic, rd, rs1, rs2, imm))) in enumerate (instructions):
+                (a, b) = (block_reg (rs1), block_reg (rs2))
+                dest = block_reg (rd)
+                write = rd != 0
+                if mnemonic in alu_exprs or mnemonic in alu_imm_alias:
+                        if mnemonic in alu_exprs:
+                                expr = alu_exprs[mnemonic].format (a = a, b = b)
+                                used.update ((rs1, rs2))
+                        else:
+                                expr = alu_exprs[alu_imm_alias[mnemonic]].format (a = a, b = imm)
+                                used.add (rs1)
+                        if write:
+                                body.append ("{0} = {1}".format (dest, expr))
+                elif mnemonic in load_exprs:
+                        expr = load_exprs[mnemonic].format (m = "m", addr = "({0} + {1}) & 0xffffffff".format (a, imm))
+                        used.add (rs1)
+                        body.append ("n = {0}".format (n))
+                        body.append ("{0} = {1}".format (dest, expr) if write else expr)
+                        faulting = True
+                elif mnemonic in store_stmts:
+                        (stmt, size) = store_stmts[mnemonic]
+                        used.update ((rs1, rs2))
+                        body.append ("n = {0}".format (n))
+                        body.append ("addr = ({0} + {1}) & 0xffffffff".format (a, imm))
+                        body.append (stmt.format (m = "m", addr = "addr", b = b))
+                        body.append ("if addr < sim.code_end:")
+                        body.append ("        sim.invalidate (addr, {0})".format (size))
+                        body.append ("        {writeback}")
+                        body.append ("        sim.extra_steps += {0}".format (n))
+                        body.append ("        return {0}".format (pc + 4))
+                        faulting = True
+                elif mnemonic in branch_exprs:
+                        used.update ((rs1, rs2))
+                        result = "{0} if {1} else {2}".format (imm, branch_exprs[mnemonic].format (a = a, b = b), pc + 4)
+                        successors.append (imm)
+                elif mnemonic == "jal":
+                        if write:
+                                body.append ("{0} = {1}".format (dest, pc + 4))
+                        result = str (imm)
+                        successors.append (imm)
+                elif mnemonic == "jalr":
+                        used.add (rs1)
+                        body.append ("n = {0}".format (n))
+                        body.append ("target = ({0} + {1}) & 0xfffffffe".format (a, imm))
+                        body.append ("if target & 3:")
+                        body.append ("        raise SimulatorError ({0}, \"分岐先アドレス 0x{{0:08x}} が 4 の倍数ではありません。\".format (target))".format (pc))
+                        if write:
+                                body.append ("{0} = {1}".format (dest, pc + 4))
+                        result = "target"
+                        faulting = True
+                elif mnemonic == "lui":
+                        if write:
+                                body.append ("{0} = {1}".format (dest, imm))
+                elif mnemonic == "auipc":
+                        if write:
+                                body.append ("{0} = {1}".format (dest, (pc + imm) & 0xffffffff))
+                else:
+                        raise KeyError (mnemonic)
+                if write and mnemonic not in store_stmts and mnemonic not in branch_exprs:
+                        written.add (rd)
+        used.discard (0)
+        used |= written
+
+        # ブロック関数の生成関数を組み立てる。
+        writeback = "; ".join ("r[{0}] = x{0}".format (index) for index in sorted (written)) or "pass"
+        source = "def factory (sim, r, m):\n"
+        source += "        def block (pc):\n"
+        for index in sorted (used):
+                source += "                x{0} = r[{0}]\n".format (index)
+        if faulting:
+                source += "                n = 0\n"
+                source += "                try:\n"
+                for stmt in body:
+                        source += "                        " + stmt.replace ("{writeback}", writeback) + "\n"
+                source += "                except (IndexError, struct.error):\n"
+                source += "                        " + writeback + "\n"
+                source += "                        sim.extra_steps += n\n"
+                source += "                        raise SimulatorError ({0} + 4 * n, \"メモリの範囲外をアクセスしました。\") from None\n".format (start)
+                source += "                except SimulatorError:\n"
+                source += "                        " + writeback + "\n"
+                source += "                        sim.extra_steps += n\n"
+                source += "                        raise\n"
+        else:
+                for stmt in body:
+                        source += "                " + stmt + "\n"
+        source += "                " + writeback + "\n"
+        if len (instructions) > 1:
+                source += "                sim.extra_steps += {0}\n".format (len (instructions) - 1)
+        source += "                return " + result + "\n"
+        source += "        return block\n"
+        return (source, successors)
+
+#**********************************************************************************************************************
+# シミュレータ
+#**********************************************************************************************************************
+
+# シミュレーションのエラー：
+# 　pc はエラーを起こした命令のアドレスである。
+
+class SimulatorError (Exception):
+
+        def __init__ (self, pc, message):
+                super ().__init__ ("0x{0:08x}: {1}".format (pc, message))
+                self.pc = pc
+
+# 停止の通知（Simulator の内部で用いる。）
+
+class Halt (Exception):
+        pass
+
+# FURV 形式のオブジェクトイメージ bin_image からバイナリを取り出す。形式が不正なら ValueError を送出する。
+
+def code_section (bin_image):
+        if len (bin_image) < minas.binary_pos:
+                raise ValueError ("FURV 形式ではありません。")
+        (magic, header_pos, binfile_pos, asmfile_pos) = struct.unpack_from ("<8sIII", bin_image, 0)
+        if not magic.startswith (b"FURV") or binfile_pos > asmfile_pos or asmfile_pos > len (bin_image):
+                raise ValueError ("FURV 形式ではありません。")
+        return bytes (bin_image[binfile_pos:asmfile_pos])
+
+# シミュレータ：
+# 　バイナリ code をメモリの 0 番地に置き，0 番地から実行する。
+# 　命令語は初めて実行するときに1回だけ解読し，オペランドを閉包に持つ処理関数としてアドレスごとに保持する。
+# 　メモリに書き込んで命令語が変わった場合は，保持している処理関数を破棄する。
+# 　ra と sp の初期値はメモリの大きさとし，そのアドレスに戻る（最上位の関数から戻る）と停止する。
+# 　自分自身に分岐する jal 命令（無限ループ）を実行しても停止する。
+# 　命令数の上限を指定せずに実行する場合は，分岐先（基本ブロックの先頭）ごとに実行回数を数え，
+# 　hot 回実行した基本ブロックをブロック関数に翻訳して，以後はブロック単位で実行する。hot が None なら翻訳しない。
+
+class Simulator:
+
+        def __init__ (self, code, memory_size = default_memory_size, hot = default_hot_count):
+                if len (code) > memory_size or memory_size % 4 != 0:
+                        raise ValueError ("メモリの大きさが不正です。")
+                # メモリ
+                self.memory = bytearray (memory_size)
+                self.memory[0:len (code)] = code
+                # レジスタファイル（32ビット符号なし整数のリスト）
+                self.regs = [0] * 32
+                self.regs[1] = memory_size
+                self.regs[2] = memory_size
+                # プログラムカウンタ
+                self.pc = 0
+                # 実行した命令数
+                self.steps = 0
+                # 停止したか
+                self.halted = False
+                # 命令キャッシュ：
+                # 　ワードアドレスごとの処理関数のリスト。未解読のワードは miss とし，末尾の1つは停止用とする。
+                self.decoded = [self.miss] * (memory_size // 4) + [self.halt]
+                # 解読したことのある命令語の末尾のアドレス（これより前への書き込みで処理関数を破棄する。）
+                self.code_end = 0
+                # 翻訳する実行回数
+                self.hot = hot
+                # ブロックキャッシュ：
+                # 　ワードアドレスごとの，ブロック関数，実行回数を数える関数，または処理関数のリスト。
+                self.fast = list (self.decoded)
+                # 基本ブロックの先頭のアドレスをキー，実行回数を値とする辞書
+                self.counts = {}
+                # 翻訳した基本ブロックの先頭のアドレスをキー，末尾のアドレスを値とする辞書
+                self.blocks = {}
+                # ブロック関数が2命令目以降として実行した命令数
+                self.extra_steps = 0
+
+        # 停止する。
+        def halt (self, pc):
+                raise Halt (pc)
+
+        # アドレス pc の命令語を解読して命令キャッシュに登録し，実行する。
+        def miss (self, pc):
+                handler = self.translate (pc)
+                self.decoded[pc >> 2] = handler
+                if self.fast[pc >> 2] == self.miss:
+                        self.fast[pc >> 2] = handler
+                if pc + 4 > self.code_end:
+                        self.code_end = pc + 4
+                return handler (pc)
+
+        # アドレス pc の命令語を解読し，処理関数を返す。
+        def translate (self, pc):
+                word = load_word (self.memory, pc)[0]
+                fields = decode (word, pc)
+                if fields == None:
+                        raise SimulatorError (pc, "命令語 0x{0:08x} を解読できません。".format (word))
+                (mnemonic, rd, rs1, rs2, imm) = fields
+                if mnemonic == "jal" and imm == pc:
+                        return self.halt
+                if (mnemonic == "jal" or mnemonic in branch_exprs) and imm & 3:
+                        raise SimulatorError (pc, "分岐先アドレス 0x{0:08x} が 4 の倍数ではありません。".format (imm))
+                # 分岐先と分岐命令の次の命令を基本ブロックの先頭とする。
+                if self.hot != None and (mnemonic == "jal" or mnemonic == "jalr" or mnemonic in branch_exprs):
+                        if mnemonic != "jalr":
+                                self.mark (imm)
+                        self.mark (pc + 4)
+                return handler_factory (mnemonic, rd != 0) (self, self.regs, self.memory, rd, rs1, rs2, imm)
+
+        # アドレス addr を基本ブロックの先頭とし，実行回数を数え始める。
+        def mark (self, addr):
+                if addr < len (self.memory) and addr not in self.counts:
+                        self.counts[addr] = 0
+                        self.fast[addr >> 2] = self.count
+
+        # 基本ブロックの先頭のアドレス pc の実行回数を数えて実行する。hot 回に達したらブロック関数に翻訳する。
+        def count (self, pc):
+                n = self.counts[pc] + 1
+                self.counts[pc] = n
+                if n >= self.hot:
+                        block = self.compile (pc)
+                        if block != None:
+                                self.fast[pc >> 2] = block
+                                return block (pc)
+                        self.fast[pc >> 2] = self.decoded[pc >> 2]
+                return self.decoded[pc >> 2] (pc)
+
+        # アドレス start から始まる基本ブロックをブロック関数に翻訳する。翻訳できなければ None を返す。
+        def compile (self, start):
+                source = block_source (self.memory, start)
+                if source == None:
+                        return None
+                (source, successors) = source
+                namespace = {}
+                exec (source, globals (), namespace)
+                end = successors[0]
+                self.blocks[start] = end
+                if end > self.code_end:
+                        self.code_end = end
+                for addr in successors:
+                        self.mark (addr)
+                return namespace["factory"] (self, self.regs, self.memory)
+
+        # アドレス addr から size バイトへの書き込みで変わった命令語の処理関数と，それを含むブロック関数を破棄する。
+        def invalidate (self, addr, size):
+                for index in range (addr >> 2, ((addr + size - 1) >> 2) + 1):
+                        self.decoded[index] = self.miss
+                        self.fast[index] = self.count if (index << 2) in self.counts else self.miss
+                for (start, end) in list (self.blocks.items ()):
+                        if start < addr + size and addr < end:
+                                del self.blocks[start]
+                                self.counts[start] = 0
+                                self.fast[start >> 2] = self.count
+
+        # 停止するまで，または max_steps 命令（None なら制限なし）を実行する。実行した命令数を返す。
+        # 命令数の上限を指定した場合は，ブロック関数を用いずに1命令ずつ実行する。
+        def run (self, max_steps = None):
+                if self.halted:
+                        return 0
+                decoded = self.fast if max_steps == None and self.hot != None else self.decoded
+                pc = self.pc
+                n = 0
+                self.extra_steps = 0
+                try:
+                        for n in (itertools.count () if max_steps == None else range (max_steps)):
+                                pc = decoded[pc >> 2] (pc)
+                        else:
+                                n = max_steps
+                except Halt:
+                        self.halted = True
+                except (IndexError, struct.error):
+                        raise SimulatorError (pc, "メモリの範囲外をアクセスしました。") from None
+                except SimulatorError as error:
+                        pc = error.pc
+                        raise
+                finally:
+                        self.pc = pc
+                        n += self.extra_steps
+                        self.steps += n
+                return n
+
+        # レジスタ index の値を符号付き整数で返す。
+        def signed (self, index):
+                return (self.regs[index] ^ 0x80000000) - 0x80000000
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
+
+def main ():
+        # 著作権を表示する。
+        print ("RISC-V Minimum Simulator", file = sys.stderr)
+        print ("Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)", file = sys.stderr)
+        print (file = sys.stderr)
+
+        # 引数を解析する。
+        parser = argparse.ArgumentParser (prog = "minsim", description = "FURV 形式のオブジェクトファイルのバイナリを実行する。")
+        parser.add_argument ("bin_filename", help = "オブジェクトファイル（FURV 形式，minas.py --format elf の ELF32 実行ファイル，または --format raw のメモリイメージ。- なら標準入力）")
+        parser.add_argument ("--max-steps", type = int, help = "実行する命令数の上限")
+        parser.add_argument ("--memory", type = lambda text: int (text, 0), default = default_memory_size, help = "メモリの大きさ（バイト）")
+        parser.add_argument ("--no-blocks", action = "store_true", help = "基本ブロックを翻訳せず，1命令ずつ実行する。")
+        args = parser.parse_args ()
+
+        # オブジェクトファイルを写像し，バイナリをコピーせずに読み込む。
+        try:
+                code = minas.map_code (args.bin_filename)
+        except IOError:
+                print ("ファイル {0} をオープンできません。".format (args.bin_filename), file = sys.stderr)
+                return 1
+        except ValueError as error:
+                print ("ファイル {0} を読み込めません。{1}".format (args.bin_filename, error), file = sys.stderr)
+                return 1
+
+        # 実行する。
+        sim = Simulator (code, args.memory, None if args.no_blocks else default_hot_count)
+        start = time.perf_counter ()
+        try:
+                sim.run (args.max_steps)
+        except SimulatorError as error:
+                print (error, file = sys.stderr)
+                return 1
+        elapsed = time.perf_counter () - start
+
+        # 結果を出力する。
+        print ("*** Registers ***", file = sys.stderr)
+        for index in range (32):
+                print ("x%-2d = 0x%08x (%d)" % (index, sim.regs[index], sim.signed (index)), file = sys.stderr)
+        print ("pc  = 0x%08x" % sim.pc, file = sys.stderr)
+        print ("{0} 命令を {1:.3f} 秒で実行しました。（{2}）".format (sim.steps, elapsed, "停止" if sim.halted else "命令数の上限"), file = sys.stderr)
+        return 0
+
+if __name__ == "__main__":
+        sys.exit (main ())
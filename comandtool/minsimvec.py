@@ -0,0 +1,419 @@
+#-*- python -*-
+#**********************************************************************************************************************
+#
+# RISC-V Minimum Lockstep Simulator
+#
+# Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)
+#
+# minas.py が生成したバイナリを，多数のレーン（プログラムと入力の組）で同時に実行する。
+# 全レーンのレジスタファイルを (N, 32) の uint32 配列，メモリを (N, メモリの大きさ) の uint8 配列に持ち，
+# 1ステップごとに全レーンの命令を NumPy の配列演算でまとめて実行する。
+# 命令の意味，停止とエラーの条件は minsim.py と同じである。（minasbench.py --check-lockstep で検査する。）NumPy が必要である。
+#
+#**********************************************************************************************************************
+
+import argparse
+import csv
+import os
+import sys
+
+import numpy
+
+sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+import minas
+import minsim
+
+# 既定のメモリの大きさ（レーンごと）
+default_memory_size = 0x00010000
+
+# レーンの状態
+RUNNING = 0 # 実行中（命令数の上限で止まった場合を含む。）
+HALTED = 1 # 停止
+FAULT = 2 # エラー
+
+#**********************************************************************************************************************
+# 命令の意味
+#**********************************************************************************************************************
+
+# 以下の関数は，オペランド a（uint32 配列），b（uint32 配列または numpy.uint32）から結果（uint32 配列）を求める。
+# 32ビットに収まる演算は uint32 のまま（桁あふれは 2^32 を法として）計算する。
+
+def signed (a):
+        return numpy.asarray (a, dtype = numpy.uint32).astype (numpy.int32).astype (numpy.int64)
+
+def unsigned (a):
+        return numpy.asarray (a, dtype = numpy.uint32).astype (numpy.uint64)
+
+def to_uint32 (a):
+        return numpy.asarray (a).astype (numpy.uint32)
+
+def alu_div (a, b):
+        (a, b) = (signed (a), signed (b))
+        divisor = numpy.where (b == 0, 1, b)
+        q = numpy.abs (a) // numpy.abs (divisor)
+        q = numpy.where ((a < 0) != (divisor < 0), -q, q)
+        return to_uint32 (numpy.where (b == 0, -1, q) & 0xffffffff)
+
+def alu_rem (a, b):
+        (a, b) = (signed (a), signed (b))
+        divisor = numpy.where (b == 0, 1, b)
+        r = numpy.abs (a) % numpy.abs (divisor)
+        r = numpy.where (a < 0, -r, r)
+        return to_uint32 (numpy.where (b == 0, a, r) & 0xffffffff)
+
+def alu_divu (a, b):
+        (a, b) = (unsigned (a), unsigned (b))
+        return to_uint32 (numpy.where (b == 0, 0xffffffff, a // numpy.where (b == 0, 1, b)))
+
+def alu_remu (a, b):
+        (a, b) = (unsigned (a), unsigned (b))
+        return to_uint32 (numpy.where (b == 0, a, a % numpy.where (b == 0, 1, b)))
+
+# 演算命令辞書：
+# 　ニーモニック名をキー，結果を求める関数を値とする辞書。（即値演算命令は minsim.alu_imm_alias で対応づける。）
+alu_funcs = {
+        "add"   : lambda a, b: a + b,
+        "sub"   : lambda a, b: a - b,
+        "and"   : lambda a, b: a & b,
+        "or"    : lambda a, b: a | b,
+        "xor"   : lambda a, b: a ^ b,
+        "slt"   : lambda a, b: to_uint32 (a.view (numpy.int32) < b.view (numpy.int32)),
+        "sltu"  : lambda a, b: to_uint32 (a < b),
+        "sll"   : lambda a, b: a << (b & 31),
+        "srl"   : lambda a, b: a >> (b & 31),
+        "sra"   : lambda a, b: (a.view (numpy.int32) >> (b & 31).view (numpy.int32)).view (numpy.uint32),
+        "mul"   : lambda a, b: a * b,
+        "mulh"  : lambda a, b: to_uint32 ((signed (a) * signed (b)) >> 32),
+        "mulhu" : lambda a, b: to_uint32 ((unsigned (a) * unsigned (b)) >> 32),
+        "mulhsu": lambda a, b: to_uint32 ((signed (a) * unsigned (b).astype (numpy.int64)) >> 32),
+        "div"   : alu_div,
+        "rem"   : alu_rem,
+        "divu"  : alu_divu,
+        "remu"  : alu_remu,
+        }
+
+# 条件分岐命令辞書：
+# 　ニーモニック名をキー，分岐する条件を求める関数を値とする辞書。
+branch_funcs = {
+        "beq" : lambda a, b: a == b,
+        "bne" : lambda a, b: a != b,
+        "blt" : lambda a, b: a.view (numpy.int32) < b.view (numpy.int32),
+        "bge" : lambda a, b: a.view (numpy.int32) >= b.view (numpy.int32),
+        "bltu": lambda a, b: a < b,
+        "bgeu": lambda a, b: a >= b,
+        }
+
+# ロード命令辞書：
+# 　ニーモニック名をキー，（バイト数，符号拡張するか）の組を値とする辞書。
+load_formats = {
+        "lw" : (4, False),
+        "lh" : (2, True),
+        "lhu": (2, False),
+        "lb" : (1, True),
+        "lbu": (1, False),
+        }
+
+# ストア命令辞書：
+# 　ニーモニック名をキー，バイト数を値とする辞書。
+store_sizes = {
+        "sw": 4,
+        "sh": 2,
+        "sb": 1,
+        }
+
+#**********************************************************************************************************************
+# 一斉実行
+#**********************************************************************************************************************
+
+# 一斉実行器：
+# 　codes にレーンごとのバイナリのリストを指定する。各バイナリはそのレーンのメモリの 0 番地に置き，0 番地から実行する。
+# 　regs はレジスタファイル（(N, 32) の uint32 配列），memory はメモリ（(N, memory_size) の uint8 配列）で，
+# 　実行前に入力を書き込んでよい。
+# 　各ステップでは，実行中のレーンのうち PC が最小のレーンを命令語で分け，命令語ごとに1回だけ解読して配列演算で実行する。
+# 　分岐で PC が分かれた場合は，PC が先に進んだレーンを待たせることで，合流点で再び一斉に実行されるようにする。
+# 　停止またはエラーになったレーンは実行しない。
+
+class LockstepExecutor:
+
+        def __init__ (self, codes, memory_size = default_memory_size):
+                lanes = len (codes)
+                if memory_size % 4 != 0 or any (len (code) > memory_size for code in codes):
+                        raise ValueError ("メモリの大きさが不正です。")
+                self.lanes = lanes
+                self.memory_size = memory_size
+                # メモリ
+                self.memory = numpy.zeros ((lanes, memory_size), dtype = numpy.uint8)
+                for lane in range (lanes):
+                        code = codes[lane]
+                        self.memory[lane, 0:len (code)] = numpy.frombuffer (code, dtype = numpy.uint8)
+                self.words = self.memory.view (numpy.uint32)
+                # バイナリの末尾のアドレス（最大）
+                self.code_end = max ([len (code) for code in codes], default = 0)
+                # 全レーンのバイナリが同じで，まだ書き換えられていないか
+                self.shared_code = False
+                # レジスタファイル
+                # 　レジスタごとに全レーンの値が連続するよう (32, N) の配列に置き，その転置を (N, 32) の regs とする。
+                self.regs = numpy.zeros ((32, lanes), dtype = numpy.uint32).T
+                self.regs[:, 1] = memory_size
+                self.regs[:, 2] = memory_size
+                # プログラムカウンタ
+                self.pc = numpy.zeros (lanes, dtype = numpy.uint32)
+                # レーンごとの状態と実行した命令数，エラーメッセージ
+                self.state = numpy.full (lanes, RUNNING, dtype = numpy.uint8)
+                self.steps = numpy.zeros (lanes, dtype = numpy.int64)
+                self.errors = {}
+                # 実行したステップ数（いずれかのレーンで命令を実行した回数）
+                self.step_count = 0
+                # 直前のステップで停止またはエラーになったレーンがあるか
+                self.stopped = False
+                # 解読キャッシュ：（PC，命令語）の組をキー，minsim.decode の結果を値とする辞書。
+                self.decoded = {}
+
+        # レーンの配列 lanes を停止またはエラー（state）とする。
+        # 実行中の命令を実行した命令数に数えない場合は executed を 0 とする。
+        def stop (self, lanes, state, executed, message = None):
+                if len (lanes) == 0:
+                        return
+                self.state[lanes] = state
+                if not executed:
+                        self.steps[lanes] -= 1
+                self.stopped = True
+                if message != None:
+                        for lane in lanes:
+                                self.errors[int (lane)] = "0x{0:08x}: {1}".format (int (self.pc[lane]), message)
+
+        # 実行中のレーンの配列を返す。
+        def running (self):
+                return numpy.flatnonzero (self.state == RUNNING)
+
+        # 全レーンが停止するまで，または各レーンで max_steps 命令（None なら制限なし）を実行するまで実行する。
+        def run (self, max_steps = None):
+                limit = None if max_steps == None else self.steps + max_steps
+                # 全レーンのバイナリが同じなら，命令語をレーンごとに照合しない。
+                code = self.memory[:, 0:self.code_end]
+                self.shared_code = self.lanes > 0 and bool ((code == code[0]).all ())
+                active = self.running ()
+                if max_steps != None:
+                        active = active[self.steps[active] < limit[active]]
+                while len (active) > 0:
+                        # PC が最小のレーンを選ぶ。（全レーンが実行中ならコピーせずにスライスで参照する。）
+                        all_active = len (active) == self.lanes
+                        pcs = self.pc if all_active else self.pc[active]
+                        pc = int (pcs[0])
+                        if (pcs == pc).all ():
+                                group = active
+                        else:
+                                pc = int (pcs.min ())
+                                group = active[pcs == pc]
+                        all_lanes = all_active and group is active
+                        # 最初の ra（メモリの大きさ）のアドレスに達したレーンは，minsim.py と同じく停止する。
+                        if pc == self.memory_size:
+                                self.stop (group, HALTED, 1)
+                        elif pc > self.memory_size:
+                                self.stop (group, FAULT, 1, "メモリの範囲外をアクセスしました。")
+                        else:
+                                # 命令語で分けて実行する。
+                                if self.shared_code:
+                                        words = self.words[group[0:1], pc >> 2]
+                                else:
+                                        words = self.words[:, pc >> 2] if all_lanes else self.words[group, pc >> 2]
+                                word = int (words[0])
+                                if self.shared_code or (words == word).all ():
+                                        self.execute ((pc << 32) | word, group, all_lanes)
+                                else:
+                                        for word in numpy.unique (words):
+                                                self.execute ((pc << 32) | int (word), group[words == word], False)
+                        self.step_count += 1
+                        if max_steps != None and (self.steps[group] >= limit[group]).any ():
+                                self.stopped = True
+                        if self.stopped:
+                                self.stopped = False
+                                active = self.running ()
+                                if max_steps != None:
+                                        active = active[self.steps[active] < limit[active]]
+
+        # （PC，命令語）の組 key の命令を，レーンの配列 lanes で実行する。all_lanes なら lanes は全レーンである。
+        def execute (self, key, lanes, all_lanes):
+                fields = self.decoded.get (key)
+                if fields == None:
+                        fields = minsim.decode (key & 0xffffffff, key >> 32)
+                        if fields != None:
+                                fields += (numpy.uint32 (fields[4]),)
+                        self.decoded[key] = fields
+                pc = key >> 32
+                # 全レーンならスライスで，そうでなければレーンの配列で選ぶ。
+                sel = slice (None) if all_lanes else lanes
+                self.steps[sel] += 1
+                if fields == None:
+                        self.stop (lanes, FAULT, 0, "命令語 0x{0:08x} を解読できません。".format (key & 0xffffffff))
+                        return
+                (mnemonic, rd, rs1, rs2, imm, imm32) = fields
+                regs = self.regs
+
+                if mnemonic in alu_funcs:
+                        if rd != 0:
+                                regs[sel, rd] = alu_funcs[mnemonic] (regs[sel, rs1], regs[sel, rs2])
+                        self.pc[sel] = pc + 4
+                elif mnemonic in minsim.alu_imm_alias:
+                        if rd != 0:
+                                regs[sel, rd] = alu_funcs[minsim.alu_imm_alias[mnemonic]] (regs[sel, rs1], imm32)
+                        self.pc[sel] = pc + 4
+                elif mnemonic in branch_funcs:
+                        # 分岐先アドレスが 4 の倍数でなければ，minsim.py と同じく解読の時点で（分岐するかによらず）エラーとする。
+                        if imm & 3:
+                                self.stop (lanes, FAULT, 0, "分岐先アドレス 0x{0:08x} が 4 の倍数ではありません。".format (imm))
+                                return
+                        taken = branch_funcs[mnemonic] (regs[sel, rs1], regs[sel, rs2])
+                        self.pc[sel] = numpy.where (taken, numpy.uint32 (imm), numpy.uint32 (pc + 4))
+                elif mnemonic == "jal":
+                        if imm == pc:
+                                self.stop (lanes, HALTED, 0)
+                                return
+                        if imm & 3:
+                                self.stop (lanes, FAULT, 0, "分岐先アドレス 0x{0:08x} が 4 の倍数ではありません。".format (imm))
+                                return
+                        if rd != 0:
+                                regs[sel, rd] = pc + 4
+                        self.pc[sel] = imm
+                elif mnemonic == "jalr":
+                        target = (regs[sel, rs1] + numpy.uint32 (imm)) & numpy.uint32 (0xfffffffe)
+                        misaligned = (target & 3) != 0
+                        if misaligned.any ():
+                                for (lane, address) in zip (lanes[misaligned], target[misaligned]):
+                                        self.stop ([lane], FAULT, 0, "分岐先アドレス 0x{0:08x} が 4 の倍数ではありません。".format (int (address)))
+                                target = numpy.where (misaligned, pc, target)
+                                if rd != 0:
+                                        regs[sel, rd] = numpy.where (misaligned, regs[sel, rd], pc + 4)
+                        elif rd != 0:
+                                regs[sel, rd] = pc + 4
+                        self.pc[sel] = target
+                        # 最初の ra（メモリの大きさ）に戻ったレーンは停止する。
+                        returned = (target == self.memory_size) & ~misaligned
+                        if returned.any ():
+                                self.stop (lanes[returned], HALTED, 1)
+                elif mnemonic == "lui":
+                        if rd != 0:
+                                regs[sel, rd] = imm
+                        self.pc[sel] = pc + 4
+                elif mnemonic == "auipc":
+                        if rd != 0:
+                                regs[sel, rd] = (pc + imm) & 0xffffffff
+                        self.pc[sel] = pc + 4
+                elif mnemonic in load_formats or mnemonic in store_sizes:
+                        self.access (mnemonic, lanes, sel, pc, rd, rs1, rs2, imm)
+                else:
+                        raise KeyError (mnemonic)
+
+        # ロード／ストア命令を実行する。
+        def access (self, mnemonic, lanes, sel, pc, rd, rs1, rs2, imm):
+                regs = self.regs
+                if isinstance (sel, slice):
+                        lanes = numpy.arange (self.lanes)
+                addr = (regs[sel, rs1] + numpy.uint32 (imm)).astype (numpy.int64)
+                if mnemonic in load_formats:
+                        (size, sign) = load_formats[mnemonic]
+                else:
+                        size = store_sizes[mnemonic]
+                # 範囲外をアクセスするレーンはエラーとする。
+                outside = addr + size > self.memory_size
+                if outside.any ():
+                        self.stop (lanes[outside], FAULT, 0, "メモリの範囲外をアクセスしました。")
+                        (lanes, addr) = (lanes[~outside], addr[~outside])
+                        sel = lanes
+                if mnemonic in load_formats:
+                        if size == 4 and not (addr & 3).any ():
+                                value = self.words[lanes, addr >> 2]
+                        else:
+                                value = numpy.zeros (len (lanes), dtype = numpy.uint32)
+                                for offset in range (size):
+                                        value |= self.memory[lanes, addr + offset].astype (numpy.uint32) << numpy.uint32 (8 * offset)
+                                if sign:
+                                        value = (value.astype (numpy.int64) ^ (1 << (8 * size - 1))) - (1 << (8 * size - 1))
+                                        value = value.astype (numpy.uint32)
+                        if rd != 0:
+                                regs[sel, rd] = value
+                else:
+                        value = regs[sel, rs2]
+                        if self.shared_code and (addr < self.code_end).any ():
+                                self.shared_code = False
+                        if size == 4 and not (addr & 3).any ():
+                                self.words[lanes, addr >> 2] = value
+                        else:
+                                for offset in range (size):
+                                        self.memory[lanes, addr + offset] = (value >> numpy.uint32 (8 * offset)) & numpy.uint32 (0xff)
+                self.pc[sel] = pc + 4
+
+#**********************************************************************************************************************
+# メインルーチン
+#**********************************************************************************************************************
+
+def main ():
+        # 著作権を表示する。
+        print ("RISC-V Minimum Lockstep Simulator", file = sys.stderr)
+        print ("Copyright (C) 2019 Tsuneo Nakanishi and Tomoaki Ukezono (Fukuoka University)", file = sys.stderr)
+        print (file = sys.stderr)
+
+        # 引数を解析する。
+        parser = argparse.ArgumentParser (prog = "minsimvec", description = "FURV 形式のオブジェクトファイルのバイナリを多数のレーンで一斉に実行する。")
+        parser.add_argument ("bin_filenames", nargs = "+", help = "オブジェクトファイル（1つなら全レーンで同じバイナリを実行する。）")
+        parser.add_argument ("--inputs", metavar = "CSV", help = "レーンごとのレジスタの初期値（見出し行にレジスタ名，1行が1レーン）")
+        parser.add_argument ("--max-steps", type = int, help = "実行するステップ数の上限")
+        parser.add_argument ("--memory", type = lambda text: int (text, 0), default = default_memory_size, help = "レーンごとのメモリの大きさ（バイト）")
+        args = parser.parse_args ()
+
+        # オブジェクトファイルを読み込む。
+        codes = []
+        for bin_filename in args.bin_filenames:
+                try:
+                        with open (bin_filename, "rb") as bin_file:
+                                codes.append (minsim.code_section (bin_file.read ()))
+                except IOError:
+                        print ("ファイル {0} をオープンできません。".format (bin_filename), file = sys.stderr)
+                        return 1
+                except ValueError:
+                        print ("ファイル {0} は FURV 形式ではありません。".format (bin_filename), file = sys.stderr)
+                        return 1
+        sources = list (args.bin_filenames)
+
+        # 入力を読み込む。
+        inputs = []
+        if args.inputs != None:
+                with open (args.inputs, newline = "") as inputs_file:
+                        reader = csv.reader (inputs_file)
+                        header = next (reader)
+                        indexes = []
+                        for name in header:
+                                index = minas.reg_dict.get (name.strip ().lower ())
+                                if index == None:
+                                        print ("不正なレジスタ {0} が指定されています。".format (name), file = sys.stderr)
+                                        return 1
+                                indexes.append (index)
+                        for row in reader:
+                                inputs.append ([(index, int (value, 0) & 0xffffffff) for (index, value) in zip (indexes, row)])
+                if len (codes) == 1:
+                        codes = codes * len (inputs)
+                        sources = sources * len (inputs)
+                elif len (codes) != len (inputs):
+                        print ("オブジェクトファイルと入力の数が一致しません。", file = sys.stderr)
+                        return 1
+
+        # 一斉に実行する。
+        executor = LockstepExecutor (codes, args.memory)
+        for (lane, values) in enumerate (inputs):
+                for (index, value) in values:
+                        if index != 0:
+                                executor.regs[lane, index] = value
+        executor.run (args.max_steps)
+
+        # レーンごとの結果を CSV 形式で出力する。
+        writer = csv.writer (sys.stdout)
+        writer.writerow (["lane", "source", "state", "steps", "pc"] + ["x{0}".format (index) for index in range (1, 32)] + ["error"])
+        state_names = { RUNNING: "running", HALTED: "halted", FAULT: "fault" }
+        for lane in range (executor.lanes):
+                writer.writerow ([lane, sources[lane], state_names[int (executor.state[lane])], int (executor.steps[lane]), "0x%08x" % executor.pc[lane]] +
+                        ["0x%08x" % executor.regs[lane, index] for index in range (1, 32)] + [executor.errors.get (lane, "")])
+        print ("{0} レーン中 {1} レーンが停止しました。（{2} ステップ）".format (executor.lanes, int (numpy.count_nonzero (executor.state == HALTED)), executor.step_count), file = sys.stderr)
+        return 0 if numpy.all (executor.state == HALTED) else 1
+
+if __name__ == "__main__":
+        sys.exit (main ())